@@ -7,8 +7,9 @@ import time
 
 import config
 from channel import channel_factory
-from common import const
+from common import const, tokenizer
 from config import (
+    conf,
     load_config,
     config,
 )
@@ -41,6 +42,8 @@ def start_channel(channel_name: str):
 def run():
     try:
         load_config()
+        # 后台预先加载tiktoken编码器，第一条消息不用等待BPE文件加载
+        tokenizer.preload(list(dict.fromkeys(["gpt-3.5-turbo", "gpt-4", conf().get("model") or "gpt-3.5-turbo"])))
         signal.signal(signal.SIGINT, sigterm_handler)
         signal.signal(signal.SIGTERM, sigterm_handler)
 
@@ -15,13 +15,13 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common import const
+from common import const, token_manager
 from config import conf, load_config
 
 class AliQwenBot(Bot):
     def __init__(self):
         super().__init__()
-        self.api_key_expired_time = self.set_api_key()
+        self.update_api_key_if_expired()
         self.sessions = SessionManager(AliQwenSession, model=conf().get("model", const.QWEN))
 
     def api_key_client(self):
@@ -145,14 +145,13 @@ class AliQwenBot(Bot):
             else:
                 return result
 
-    def set_api_key(self):
+    def create_api_key(self):
         api_key, expired_time = self.api_key_client().create_token(agent_key=self.agent_key())
-        broadscope_bailian.api_key = api_key
-        return expired_time
+        return api_key, expired_time - time.time()
 
     def update_api_key_if_expired(self):
-        if time.time() > self.api_key_expired_time:
-            self.api_key_expired_time = self.set_api_key()
+        # api_key由token_manager缓存，过期前在后台刷新
+        broadscope_bailian.api_key = token_manager.get("qwen", self.create_api_key, key=self.access_key_id())
 
     def convert_messages_format(self, messages) -> Tuple[str, List[ChatQaMessage]]:
         history = []
@@ -1,6 +1,6 @@
 # encoding:utf-8
 
-import requests
+from common import http_client, token_manager
 import json
 from common import const
 from bot.bot import Bot
@@ -73,7 +73,7 @@ class BaiduWenxinBot(Bot):
         try:
             logger.info("[BAIDU] model={}".format(session.model))
             access_token = self.get_access_token()
-            if access_token == 'None':
+            if not access_token:
                 logger.warn("[BAIDU] access token 获取失败")
                 return {
                     "total_tokens": 0,
@@ -85,9 +85,13 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            if response_text.get("error_code") in (110, 111) and retry_count < 1:
+                # access token失效或过期，强制刷新后重试一次
+                token_manager.refresh("baidu_wenxin", self._fetch_access_token, key=BAIDU_API_KEY)
+                return self.reply_text(session, retry_count + 1)
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -110,6 +114,16 @@ class BaiduWenxinBot(Bot):
         使用 AK，SK 生成鉴权签名（Access Token）
         :return: access_token，或是None(如果错误)
         """
+        try:
+            return token_manager.get("baidu_wenxin", self._fetch_access_token, key=BAIDU_API_KEY)
+        except Exception as e:
+            logger.error("[BAIDU] get access token failed: {}".format(e))
+            return None
+
+    def _fetch_access_token(self):
         url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        res = http_client.post(url, params=params).json()
+        if "access_token" not in res:
+            raise Exception(res.get("error_description") or res)
+        return res["access_token"], res.get("expires_in")
@@ -2,16 +2,46 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 
 from bridge.context import Context
 from bridge.reply import Reply
 
 
 class Bot(object):
+    # 是否支持通过context["gpt_model"]为单条消息指定模型(如过载时的降级模型)
+    supports_model_override = False
+
     def reply(self, query, context: Context = None) -> Reply:
         """
         bot auto-reply content
         :param req: received message
         :return: reply content
         """
+        if self.supports_async():
+            # 只实现了areply的bot，同步调用(如插件中)时在共享的事件循环中执行
+            from common import event_loop
+
+            return event_loop.run(self.areply(query, context))
         raise NotImplementedError
+
+    async def areply(self, query, context: Context = None) -> Reply:
+        """
+        async version of reply, bots that support async requests override it,
+        waiting for the upstream response does not occupy a thread
+        default: run reply in a thread
+        """
+        return await self.run_sync(context, self.reply, query, context)
+
+    @staticmethod
+    async def run_sync(context: Context, func, *args):
+        """
+        在线程池中执行会话读写、计算token数等同步步骤，不阻塞事件循环
+        使用channel通过context["executor"]指定的线程池，没有指定时使用事件循环默认的线程池
+        """
+        executor = context.get("executor") if context else None
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    @classmethod
+    def supports_async(cls):
+        return cls.areply is not Bot.areply
@@ -1,17 +1,15 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
-import requests
-
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyType, StreamReply
+from common import async_http_client, http_client
+from common.cancellation import CancellationToken, OperationCancelled, acancellable_sleep, cancellable_sleep
 from common.log import logger
 from common.token_bucket import TokenBucket
 from config import conf, load_config
@@ -19,6 +17,8 @@ from config import conf, load_config
 
 # OpenAI对话模型API (可用)
 class ChatGPTBot(Bot, OpenAIImage):
+    supports_model_override = True
+
     def __init__(self):
         super().__init__()
         # set the default api_key
@@ -46,53 +46,22 @@ class ChatGPTBot(Bot, OpenAIImage):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session = self._text_request(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+
+            api_key, new_args = self._request_args(context)
+            cancel_token = context.get("cancel_token")
+            token_taken = False
+            if context.get("stream") and self._take_rate_limit_token():
+                # reply in stream, 流式请求失败时改用普通请求，使用已经取得的令牌，不再重复计数
+                token_taken = True
+                reply = self.reply_text_stream(session, api_key, args=new_args, cancel_token=cancel_token)
+                if reply:
+                    return reply
+
+            reply_content = self.reply_text(session, api_key, args=new_args, cancel_token=cancel_token, token_taken=token_taken)
+            return self._text_reply(session, reply_content, cancel_token)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -106,16 +75,91 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+    async def areply(self, query, context=None):
+        # 文本对话使用异步请求，其它类型和流式回复仍在线程中执行
+        if context.type != ContextType.TEXT or context.get("stream"):
+            return await super().areply(query, context)
+        # 会话读写在线程池中执行，只有请求openai在事件循环中等待
+        reply, session = await self.run_sync(context, self._text_request, query, context)
+        if reply:
+            return reply
+
+        api_key, new_args = self._request_args(context)
+        cancel_token = context.get("cancel_token")
+        reply_content = await self.areply_text(session, api_key, args=new_args, cancel_token=cancel_token, context=context)
+        return await self.run_sync(context, self._text_reply, session, reply_content, cancel_token)
+
+    def _text_request(self, query, context):
+        """
+        reply和areply共用的请求前步骤：处理管理命令，把提问加入会话
+        :return: (管理命令的回复, 会话)，有回复时直接返回，不再请求
+        """
+        logger.info("[CHATGPT] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        return None, session
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+
+    def _request_args(self, context):
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return api_key, new_args
+
+    def _text_reply(self, session: ChatGPTSession, reply_content: dict, cancel_token: CancellationToken = None) -> Reply:
+        session_id = session.session_id
+        if cancel_token and cancel_token.cancelled:
+            logger.info("[CHATGPT] session {} cancelled, drop reply".format(session_id))
+            return Reply(ReplyType.INFO, "会话已取消")
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, cancel_token: CancellationToken = None, token_taken=False) -> dict:
         """
         call openai's ChatCompletion to get the answer
         :param session: a conversation session
         :param session_id: session id
         :param retry_count: retry count
+        :param cancel_token: stop retrying once cancelled
         :return: {}
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            if not token_taken and not self._take_rate_limit_token():
                 raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
             if args is None:
@@ -123,45 +167,110 @@ class ChatGPTBot(Bot, OpenAIImage):
             response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             # logger.debug("[CHATGPT] response={}".format(response))
             # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            return self._parse_response(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+            result, retry_delay = self._handle_error(e, session, retry_count)
+            if retry_delay is not None and not cancellable_sleep(cancel_token, retry_delay):
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return self.reply_text(session, api_key, args, retry_count + 1, cancel_token=cancel_token)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
-            if need_retry:
+    async def areply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0, cancel_token: CancellationToken = None, context=None) -> dict:
+        """
+        async version of reply_text, waits for openai without occupying a thread
+        :param context: 用于在channel的线程池中执行出错时清除会话等同步步骤
+        """
+        try:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            if not self._take_rate_limit_token():
+                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+            if args is None:
+                args = self.args
+            openai.aiosession.set(async_http_client.get_session())  # 复用连接，否则openai每次请求都会新建连接
+            response = await openai.ChatCompletion.acreate(api_key=api_key, messages=session.messages, **args)
+            return self._parse_response(response)
+        except Exception as e:
+            # 未知错误时会清除会话，不能在事件循环中读写会话存储
+            result, retry_delay = await self.run_sync(context, self._handle_error, e, session, retry_count)
+            if retry_delay is not None and not await acancellable_sleep(cancel_token, retry_delay):
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return await self.areply_text(session, api_key, args, retry_count + 1, cancel_token=cancel_token, context=context)
             else:
                 return result
 
+    def _take_rate_limit_token(self):
+        """
+        每次请求openai前取一个令牌，没有开启限流时总是返回True
+        """
+        return not conf().get("rate_limit_chatgpt") or self.tb4chatgpt.get_token()
+
+    @staticmethod
+    def _parse_response(response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_error(self, e: Exception, session: ChatGPTSession, retry_count):
+        """
+        :return: (出错时回复的内容, 重试前等待的秒数，不重试时为None)
+        """
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        retry_delay = None
+        if isinstance(e, OperationCancelled):
+            logger.info("[CHATGPT] request cancelled")
+            need_retry = False
+        elif isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            retry_delay = 10
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            retry_delay = 5
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return result, retry_delay if need_retry else None
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None, cancel_token: CancellationToken = None) -> StreamReply:
+        """
+        call openai's ChatCompletion in stream mode, deltas are sent to the channel as soon as they arrive
+        the caller takes the rate limit token, and passes it on to reply_text when falling back
+        :return: StreamReply, or None if the request failed and should fall back to reply_text
+        """
+        try:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            if args is None:
+                args = self.args
+            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, stream=True, **args)
+        except Exception as e:
+            logger.warn("[CHATGPT] stream request failed, fallback to normal request: {}".format(e))
+            return None
+
+        def deltas():
+            for chunk in response:
+                if cancel_token and cancel_token.cancelled:
+                    raise OperationCancelled()
+                if chunk["choices"]:
+                    yield chunk["choices"][0]["delta"].get("content")
+
+        return StreamReply(deltas(), lambda content: self.sessions.session_reply(content, session.session_id))
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
@@ -183,13 +292,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -208,7 +317,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 image_url = submission.json()['data'][0]['url']
                 return True, image_url
             except Exception as e:
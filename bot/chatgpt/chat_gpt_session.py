@@ -1,6 +1,8 @@
-from bot.session_manager import Session
+import functools
+
+from bot.session_manager import Session, Tokenizer
+from common import const, tokenizer
 from common.log import logger
-from common import const
 
 """
     e.g.  [
@@ -12,88 +14,96 @@ from common import const
 """
 
 
+# 按OpenAI的消息格式用tiktoken计算token数
+class TiktokenTokenizer(Tokenizer):
+    def __init__(self, model):
+        self.model = model
+        self.reply_tokens = num_tokens_for_reply(model)
+
+    def count(self, message) -> int:
+        return num_tokens_from_message(message, self.model)
+
+    def count_many(self, messages) -> list:
+        model = _token_model(self.model)
+        if model is None:
+            return [len(message["content"]) for message in messages]
+        tokens_per_message, tokens_per_name = _message_overhead(model)
+        lens = iter(tokenizer.encode_lens([value for message in messages for value in message.values()], model))
+        counts = []
+        for message in messages:
+            num_tokens = tokens_per_message
+            for key in message:
+                num_tokens += next(lens)
+                if key == "name":
+                    num_tokens += tokens_per_name
+            counts.append(num_tokens)
+        return counts
+
+
 class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
-        super().__init__(session_id, system_prompt)
+        super().__init__(session_id, system_prompt, tokenizer=TiktokenTokenizer(model))
         self.model = model
         self.reset()
 
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            if cur_tokens is None:
-                raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-        while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = cur_tokens - max_tokens
-                break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
-                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
-                break
-            else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
-        return cur_tokens
-
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
-
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    return sum(num_tokens_from_message(message, model) for message in messages) + num_tokens_for_reply(model)
 
-    if model in ["wenxin", "xunfei", const.GEMINI]:
-        return num_tokens_by_character(messages)
-
-    import tiktoken
 
+@functools.lru_cache(maxsize=None)
+def _token_model(model):
+    """
+    计算token时实际采用的模型，None表示按字符数计算
+    """
+    if model in ["wenxin", "xunfei", const.GEMINI]:
+        return None
     if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+        return "gpt-3.5-turbo"
     elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
                    "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
                    "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
                    const.GPT_4o, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
+        return "gpt-4"
     elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return "gpt-3.5-turbo"
+    elif model not in ["gpt-3.5-turbo", "gpt-4"]:
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        return "gpt-3.5-turbo"
+    return model
+
+
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, without the reply priming tokens."""
+    model = _token_model(model)
+    if model is None:
+        return len(message["content"])
+
+    tokens_per_message, tokens_per_name = _message_overhead(model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += tokenizer.encode_len(value, model)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
+def _message_overhead(model):
     if model == "gpt-3.5-turbo":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
+    else:
         tokens_per_message = 3
         tokens_per_name = 1
-    else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return tokens_per_message, tokens_per_name
+
+
+def num_tokens_for_reply(model):
+    if _token_model(model) is None:
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
 
 
 def num_tokens_by_character(messages):
@@ -102,3 +112,44 @@ def num_tokens_by_character(messages):
     for msg in messages:
         tokens += len(msg["content"])
     return tokens
+
+
+if __name__ == "__main__":
+    # 200条消息的会话裁剪耗时，与逐条pop后重新计算的结果对比: python -m bot.chatgpt.chat_gpt_session
+    import copy
+    import random
+    import time
+
+    def discard_by_recount(messages, model, max_tokens):
+        cur_tokens = num_tokens_from_messages(messages, model)
+        while cur_tokens > max_tokens and len(messages) > 2:
+            messages.pop(1)
+            while len(messages) > 2 and messages[1]["role"] != "user":  # 按轮丢弃
+                messages.pop(1)
+            cur_tokens = num_tokens_from_messages(messages, model)
+        return cur_tokens
+
+    model = "gpt-3.5-turbo"
+    session = ChatGPTSession("bench", system_prompt="You are a helpful assistant.", model=model)
+    for i in range(100):
+        session.add_query(" ".join("question{}".format(random.randrange(1000)) for _ in range(30)))
+        session.add_reply(" ".join("answer{}".format(random.randrange(1000)) for _ in range(60)))
+    max_tokens = session.calc_tokens() // 2
+    messages = copy.deepcopy(session.messages)
+
+    start = time.perf_counter()
+    expected = discard_by_recount(messages, model, max_tokens)
+    recount_cost = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = session.discard_exceeding(max_tokens)
+    cost = time.perf_counter() - start
+    assert actual == expected and session.messages == messages, (actual, expected)
+    print("tokens={}, recount={:.1f}ms, incremental={:.1f}ms".format(actual, recount_cost * 1000, cost * 1000))
+
+    start = time.perf_counter()
+    for i in range(100):
+        session.add_query("question {}".format(i))
+        session.discard_exceeding(max_tokens)
+        session.add_reply("answer {}".format(i))
+        session.discard_exceeding(max_tokens)
+    print("100 turns on a full session: {:.2f}ms per turn".format((time.perf_counter() - start) * 1000 / 100))
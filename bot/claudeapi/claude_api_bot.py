@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -26,6 +27,9 @@ class ClaudeAPIBot(Bot, OpenAIImage):
         self.claudeClient = anthropic.Anthropic(
             api_key=conf().get("claude_api_key")
         )
+        self.asyncClaudeClient = anthropic.AsyncAnthropic(
+            api_key=conf().get("claude_api_key")
+        )
         openai.api_key = conf().get("open_ai_api_key")
         if conf().get("open_ai_api_base"):
             openai.api_base = conf().get("open_ai_api_base")
@@ -39,33 +43,10 @@ class ClaudeAPIBot(Bot, OpenAIImage):
         # acquire reply content
         if context and context.type:
             if context.type == ContextType.TEXT:
-                logger.info("[CLAUDE_API] query={}".format(query))
-                session_id = context["session_id"]
-                reply = None
-                if query == "#清除记忆":
-                    self.sessions.clear_session(session_id)
-                    reply = Reply(ReplyType.INFO, "记忆已清除")
-                elif query == "#清除所有":
-                    self.sessions.clear_all_session()
-                    reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-                else:
-                    session = self.sessions.session_query(query, session_id)
+                reply, session = self._text_request(query, context)
+                if not reply:
                     result = self.reply_text(session)
-                    logger.info(result)
-                    total_tokens, completion_tokens, reply_content = (
-                        result["total_tokens"],
-                        result["completion_tokens"],
-                        result["content"],
-                    )
-                    logger.debug(
-                        "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
-                    )
-
-                    if total_tokens == 0:
-                        reply = Reply(ReplyType.ERROR, reply_content)
-                    else:
-                        self.sessions.session_reply(reply_content, session_id, total_tokens)
-                        reply = Reply(ReplyType.TEXT, reply_content)
+                    reply = self._text_reply(session, result)
                 return reply
             elif context.type == ContextType.IMAGE_CREATE:
                 ok, retstring = self.create_img(query, 0)
@@ -76,53 +57,130 @@ class ClaudeAPIBot(Bot, OpenAIImage):
                     reply = Reply(ReplyType.ERROR, retstring)
                 return reply
 
+    async def areply(self, query, context=None):
+        # 文本对话使用异步请求，其它类型仍在线程中执行
+        if not context or context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        # 会话读写在线程池中执行，只有请求接口在事件循环中等待
+        reply, session = await self.run_sync(context, self._text_request, query, context)
+        if not reply:
+            result = await self.areply_text(session, context=context)
+            reply = await self.run_sync(context, self._text_reply, session, result)
+        return reply
+
+    def _text_request(self, query, context):
+        """
+        reply和areply共用的请求前步骤：处理管理命令，把提问加入会话
+        :return: (管理命令的回复, 会话)，有回复时直接返回，不再请求
+        """
+        logger.info("[CLAUDE_API] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply, None
+        return None, self.sessions.session_query(query, session_id)
+
+    def _command_reply(self, query, session_id):
+        if query == "#清除记忆":
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+
+    def _text_reply(self, session: ChatGPTSession, result: dict) -> Reply:
+        session_id = session.session_id
+        logger.info(result)
+        total_tokens, completion_tokens, reply_content = (
+            result["total_tokens"],
+            result["completion_tokens"],
+            result["content"],
+        )
+        logger.debug(
+            "[CLAUDE_API] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(str(session), session_id, reply_content, completion_tokens)
+        )
+
+        if total_tokens == 0:
+            return Reply(ReplyType.ERROR, reply_content)
+        self.sessions.session_reply(reply_content, session_id, total_tokens)
+        return Reply(ReplyType.TEXT, reply_content)
+
+    def _request_args(self, session: ChatGPTSession):
+        return {
+            "model": self._model_mapping(conf().get("model")),
+            "max_tokens": 1024,
+            # "system": conf().get("system"),
+            "messages": GoogleGeminiBot.filter_messages(session.messages),
+        }
+
     def reply_text(self, session: ChatGPTSession, retry_count=0):
         try:
-            actual_model = self._model_mapping(conf().get("model"))
-            response = self.claudeClient.messages.create(
-                model=actual_model,
-                max_tokens=1024,
-                # system=conf().get("system"),
-                messages=GoogleGeminiBot.filter_messages(session.messages)
-            )
+            response = self.claudeClient.messages.create(**self._request_args(session))
             # response = openai.Completion.create(prompt=str(session), **self.args)
-            res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
-            total_tokens = response.usage.input_tokens+response.usage.output_tokens
-            completion_tokens = response.usage.output_tokens
-            logger.info("[CLAUDE_API] reply={}".format(res_content))
-            return {
-                "total_tokens": total_tokens,
-                "completion_tokens": completion_tokens,
-                "content": res_content,
-            }
+            return self._parse_response(response)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CLAUDE_API] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
+            result, retry_delay = self._handle_error(e, session, retry_count)
+            if retry_delay is not None:
+                time.sleep(retry_delay)
+                logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
+                return self.reply_text(session, retry_count + 1)
             else:
-                logger.warn("[CLAUDE_API] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
-            if need_retry:
+    async def areply_text(self, session: ChatGPTSession, retry_count=0, context=None):
+        """
+        async version of reply_text, waits for the response without occupying a thread
+        :param context: 用于在channel的线程池中执行出错时清除会话等同步步骤
+        """
+        try:
+            response = await self.asyncClaudeClient.messages.create(**self._request_args(session))
+            return self._parse_response(response)
+        except Exception as e:
+            # 未知错误时会清除会话，不能在事件循环中读写会话存储
+            result, retry_delay = await self.run_sync(context, self._handle_error, e, session, retry_count)
+            if retry_delay is not None:
+                await asyncio.sleep(retry_delay)
                 logger.warn("[CLAUDE_API] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, retry_count + 1)
+                return await self.areply_text(session, retry_count + 1, context=context)
             else:
                 return result
 
+    def _parse_response(self, response) -> dict:
+        res_content = response.content[0].text.strip().replace("<|endoftext|>", "")
+        total_tokens = response.usage.input_tokens+response.usage.output_tokens
+        completion_tokens = response.usage.output_tokens
+        logger.info("[CLAUDE_API] reply={}".format(res_content))
+        return {
+            "total_tokens": total_tokens,
+            "completion_tokens": completion_tokens,
+            "content": res_content,
+        }
+
+    def _handle_error(self, e: Exception, session: ChatGPTSession, retry_count):
+        """
+        :return: (出错时回复的内容, 重试前等待的秒数，不重试时为None)
+        """
+        need_retry = retry_count < 2
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        retry_delay = None
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CLAUDE_API] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            retry_delay = 20
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CLAUDE_API] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            retry_delay = 5
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CLAUDE_API] APIConnectionError: {}".format(e))
+            need_retry = False
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.warn("[CLAUDE_API] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return result, retry_delay if need_retry else None
+
     def _model_mapping(self, model) -> str:
         if model == "claude-3-opus":
             return "claude-3-opus-20240229"
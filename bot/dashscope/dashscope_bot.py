@@ -3,7 +3,8 @@
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyType, StreamReply
+from common.cancellation import OperationCancelled
 from common.log import logger
 from config import conf, load_config
 from .dashscope_session import DashscopeSession
@@ -51,6 +52,12 @@ class DashscopeBot(Bot):
             session = self.sessions.session_query(query, session_id)
             logger.debug("[DASHSCOPE] session query={}".format(session.messages))
 
+            if context.get("stream"):
+                # reply in stream
+                reply = self.reply_text_stream(session, context.get("cancel_token"))
+                if reply:
+                    return reply
+
             reply_content = self.reply_text(session)
             logger.debug(
                 "[DASHSCOPE] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
@@ -115,3 +122,42 @@ class DashscopeBot(Bot):
                 return self.reply_text(session, retry_count + 1)
             else:
                 return result
+
+    def reply_text_stream(self, session: DashscopeSession, cancel_token=None) -> StreamReply:
+        """
+        call dashscope's Generation in stream mode, each response only contains the new content
+        :return: StreamReply, or None if the request failed and should fall back to reply_text
+        """
+        try:
+            dashscope.api_key = self.api_key
+            responses = self.client.call(
+                dashscope_models[self.model_name],
+                messages=session.messages,
+                result_format="message",
+                stream=True,
+                incremental_output=True
+            )
+            # 第一段返回前出错时改用非流式请求重试
+            first = next(responses)
+            if first.status_code != HTTPStatus.OK:
+                logger.warn("[DASHSCOPE] stream request failed, status code: %s, error message: %s, fallback to normal request" % (
+                    first.status_code, first.message
+                ))
+                return None
+        except Exception as e:
+            logger.warn("[DASHSCOPE] stream request failed, fallback to normal request: {}".format(e))
+            return None
+
+        def deltas():
+            response = first
+            while True:
+                if response.status_code != HTTPStatus.OK:
+                    raise Exception("dashscope stream error, code: %s, message: %s" % (response.code, response.message))
+                yield response.output.choices[0]["message"]["content"]
+                if cancel_token and cancel_token.cancelled:
+                    raise OperationCancelled()
+                response = next(responses, None)
+                if response is None:
+                    return
+
+        return StreamReply(deltas(), lambda content: self.sessions.session_reply(content, session.session_id))
@@ -3,13 +3,14 @@
 
 import re
 import time
-import requests
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-from bot.session_manager import SessionManager
+from bot.session_manager import CharacterTokenizer, SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import async_http_client, http_client
+from common.cancellation import acancellable_sleep, cancellable_sleep
 from common.log import logger
 from config import conf, pconf
 import threading
@@ -56,125 +57,188 @@ class LinkAIBot(Bot):
             # exit from retry 2 times
             logger.warn("[LINKAI] failed after maximum number of retry times")
             return Reply(ReplyType.TEXT, "请再问我一次吧")
+        cancel_token = context.get("cancel_token")
+        if cancel_token and cancel_token.cancelled:
+            logger.info("[LINKAI] session {} cancelled, drop request".format(context.get("session_id")))
+            return Reply(ReplyType.INFO, "会话已取消")
 
         try:
-            # load config
-            if context.get("generate_breaked_by"):
-                logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
-                app_code = None
-            else:
-                plugin_app_code = self._find_group_mapping_code(context)
-                app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
-            linkai_api_key = conf().get("linkai_api_key")
-
-            session_id = context["session_id"]
-            session_message = self.sessions.session_msg_query(query, session_id)
-            logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
-
-            # image process
-            img_cache = memory.USER_IMAGE_CACHE.get(session_id)
-            if img_cache:
-                messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
-                if messages:
-                    session_message = messages
-
-            model = conf().get("model")
-            # remove system message
-            if session_message[0].get("role") == "system":
-                if app_code or model == "wenxin":
-                    session_message.pop(0)
-            body = {
-                "app_code": app_code,
-                "messages": session_message,
-                "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
-                "temperature": conf().get("temperature"),
-                "top_p": conf().get("top_p", 1),
-                "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
-                "session_id": session_id,
-                "sender_id": session_id,
-                "channel_type": conf().get("channel_type", "wx")
-            }
-            try:
-                from linkai import LinkAIClient
-                client_id = LinkAIClient.fetch_client_id()
-                if client_id:
-                    body["client_id"] = client_id
-                    # start: client info deliver
-                    if context.kwargs.get("msg"):
-                        body["session_id"] = context.kwargs.get("msg").from_user_id
-                        if context.kwargs.get("msg").is_group:
-                            body["is_group"] = True
-                            body["group_name"] = context.kwargs.get("msg").from_user_nickname
-                            body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
-                        else:
-                            if body.get("channel_type") in ["wechatcom_app"]:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_id
-                            else:
-                                body["sender_name"] = context.kwargs.get("msg").from_user_nickname
-
-            except Exception as e:
-                pass
-            file_id = context.kwargs.get("file_id")
-            if file_id:
-                body["file_id"] = file_id
-            logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
-            headers = {"Authorization": "Bearer " + linkai_api_key}
-
+            url, body, headers = self._chat_request(query, context)
             # do http request
-            base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
-            if res.status_code == 200:
-                # execute success
-                response = res.json()
-                reply_content = response["choices"][0]["message"]["content"]
-                total_tokens = response["usage"]["total_tokens"]
-                res_code = response.get('code')
-                logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
-                if res_code == 429:
-                    logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
-                else:
-                    self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
-                agent_suffix = self._fetch_agent_suffix(response)
-                if agent_suffix:
-                    reply_content += agent_suffix
-                if not agent_suffix:
-                    knowledge_suffix = self._fetch_knowledge_search_suffix(response)
-                    if knowledge_suffix:
-                        reply_content += knowledge_suffix
-                # image process
-                if response["choices"][0].get("img_urls"):
-                    thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
-                    thread.start()
-                    if response["choices"][0].get("text_content"):
-                        reply_content = response["choices"][0].get("text_content")
-                reply_content = self._process_url(reply_content)
-                return Reply(ReplyType.TEXT, reply_content)
+            # 会话被取消时中断请求
+            res = http_client.post(url=url, json=body, headers=headers,
+                                   timeout=conf().get("request_timeout", 180), cancel_token=cancel_token)
+            reply = self._chat_response(res, query, context, body)
+            if reply:
+                return reply
+            # server error, need retry
+            cancellable_sleep(cancel_token, 2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return self._chat(query, context, retry_count + 1)
 
-            else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
+        except Exception as e:
+            if cancel_token and cancel_token.cancelled:
+                logger.info("[LINKAI] request cancelled")
+                return Reply(ReplyType.INFO, "会话已取消")
+            logger.exception(e)
+            # retry
+            cancellable_sleep(cancel_token, 2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return self._chat(query, context, retry_count + 1)
 
-                if res.status_code >= 500:
-                    # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+    async def areply(self, query, context: Context = None) -> Reply:
+        # 文本对话使用异步请求，其它类型和带图片的提问仍在线程中执行
+        if context.type != ContextType.TEXT or memory.USER_IMAGE_CACHE.get(context["session_id"]):
+            return await super().areply(query, context)
+        return await self._achat(query, context)
+
+    async def _achat(self, query, context, retry_count=0) -> Reply:
+        """
+        _chat的异步版本，等待响应时不占用线程
+        """
+        if retry_count > 2:
+            # exit from retry 2 times
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return Reply(ReplyType.TEXT, "请再问我一次吧")
+        cancel_token = context.get("cancel_token")
+        if cancel_token and cancel_token.cancelled:
+            logger.info("[LINKAI] session {} cancelled, drop request".format(context.get("session_id")))
+            return Reply(ReplyType.INFO, "会话已取消")
 
-                error_reply = "提问太快啦，请休息一下再问我吧"
-                if res.status_code == 409:
-                    error_reply = "这个问题我还没有学会，请问我其它问题吧"
-                return Reply(ReplyType.TEXT, error_reply)
+        try:
+            # 构造请求和解析响应时读写会话，在线程池中执行，只有请求接口在事件循环中等待
+            url, body, headers = await self.run_sync(context, self._chat_request, query, context)
+            res = await async_http_client.post(url, json=body, headers=headers, timeout=conf().get("request_timeout", 180))
+            reply = await self.run_sync(context, self._chat_response, res, query, context, body)
+            if reply:
+                return reply
+            # server error, need retry
+            await acancellable_sleep(cancel_token, 2)
+            logger.warn(f"[LINKAI] do retry, times={retry_count}")
+            return await self._achat(query, context, retry_count + 1)
 
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
+            await acancellable_sleep(cancel_token, 2)
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return await self._achat(query, context, retry_count + 1)
+
+    def _chat_request(self, query, context):
+        """
+        把提问加入会话，构造对话请求
+        :return: (url, body, headers)
+        """
+        # load config
+        if context.get("generate_breaked_by"):
+            logger.info(f"[LINKAI] won't set appcode because a plugin ({context['generate_breaked_by']}) affected the context")
+            app_code = None
+        else:
+            plugin_app_code = self._find_group_mapping_code(context)
+            app_code = context.kwargs.get("app_code") or plugin_app_code or conf().get("linkai_app_code")
+        linkai_api_key = conf().get("linkai_api_key")
+
+        session_id = context["session_id"]
+        session_message = self.sessions.session_msg_query(query, session_id)
+        logger.debug(f"[LinkAI] session={session_message}, session_id={session_id}")
+
+        # image process
+        img_cache = memory.USER_IMAGE_CACHE.get(session_id)
+        if img_cache:
+            messages = self._process_image_msg(app_code=app_code, session_id=session_id, query=query, img_cache=img_cache)
+            if messages:
+                session_message = messages
+
+        model = conf().get("model")
+        # remove system message
+        if session_message[0].get("role") == "system":
+            if app_code or model == "wenxin":
+                session_message.pop(0)
+        body = {
+            "app_code": app_code,
+            "messages": session_message,
+            "model": model,     # 对话模型的名称, 支持 gpt-3.5-turbo, gpt-3.5-turbo-16k, gpt-4, wenxin, xunfei
+            "temperature": conf().get("temperature"),
+            "top_p": conf().get("top_p", 1),
+            "frequency_penalty": conf().get("frequency_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "presence_penalty": conf().get("presence_penalty", 0.0),  # [-2,2]之间，该值越大则更倾向于产生不同的内容
+            "session_id": session_id,
+            "sender_id": session_id,
+            "channel_type": conf().get("channel_type", "wx")
+        }
+        try:
+            from linkai import LinkAIClient
+            client_id = LinkAIClient.fetch_client_id()
+            if client_id:
+                body["client_id"] = client_id
+                # start: client info deliver
+                if context.kwargs.get("msg"):
+                    body["session_id"] = context.kwargs.get("msg").from_user_id
+                    if context.kwargs.get("msg").is_group:
+                        body["is_group"] = True
+                        body["group_name"] = context.kwargs.get("msg").from_user_nickname
+                        body["sender_name"] = context.kwargs.get("msg").actual_user_nickname
+                    else:
+                        if body.get("channel_type") in ["wechatcom_app"]:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_id
+                        else:
+                            body["sender_name"] = context.kwargs.get("msg").from_user_nickname
+
+        except Exception as e:
+            pass
+        file_id = context.kwargs.get("file_id")
+        if file_id:
+            body["file_id"] = file_id
+        logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
+        headers = {"Authorization": "Bearer " + linkai_api_key}
+        base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
+        return base_url + "/v1/chat/completions", body, headers
+
+    def _chat_response(self, res, query, context, body):
+        """
+        解析同步或异步请求的响应，服务端出错需要重试时返回None
+        """
+        session_id = context["session_id"]
+        if res.status_code == 200:
+            # execute success
+            response = res.json()
+            reply_content = response["choices"][0]["message"]["content"]
+            total_tokens = response["usage"]["total_tokens"]
+            res_code = response.get('code')
+            logger.info(f"[LINKAI] reply={reply_content}, total_tokens={total_tokens}, res_code={res_code}")
+            if res_code == 429:
+                logger.warn(f"[LINKAI] 用户访问超出限流配置，sender_id={body.get('sender_id')}")
+            else:
+                self.sessions.session_reply(reply_content, session_id, total_tokens, query=query)
+            agent_suffix = self._fetch_agent_suffix(response)
+            if agent_suffix:
+                reply_content += agent_suffix
+            if not agent_suffix:
+                knowledge_suffix = self._fetch_knowledge_search_suffix(response)
+                if knowledge_suffix:
+                    reply_content += knowledge_suffix
+            # image process
+            if response["choices"][0].get("img_urls"):
+                thread = threading.Thread(target=self._send_image, args=(context.get("channel"), context, response["choices"][0].get("img_urls")))
+                thread.start()
+                if response["choices"][0].get("text_content"):
+                    reply_content = response["choices"][0].get("text_content")
+            reply_content = self._process_url(reply_content)
+            return Reply(ReplyType.TEXT, reply_content)
+
+        else:
+            response = res.json()
+            error = response.get("error")
+            logger.error(f"[LINKAI] chat failed, status_code={res.status_code}, "
+                         f"msg={error.get('message')}, type={error.get('type')}")
+
+            if res.status_code >= 500:
+                return None
+
+            error_reply = "提问太快啦，请休息一下再问我吧"
+            if res.status_code == 409:
+                error_reply = "这个问题我还没有学会，请问我其它问题吧"
+            return Reply(ReplyType.TEXT, error_reply)
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -262,8 +326,9 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            # 会话被取消时中断请求
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                   timeout=conf().get("request_timeout", 180), cancel_token=cancel_token)
             if res.status_code == 200:
                 # execute success
                 response = res.json()
@@ -284,7 +349,7 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
+                    cancellable_sleep(cancel_token, 2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
                     return self.reply_text(session, app_code, retry_count + 1)
 
@@ -306,7 +371,7 @@ class LinkAIBot(Bot):
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +392,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -429,7 +494,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -444,31 +509,22 @@ class LinkAISessionManager(SessionManager):
         return messages
 
     def session_reply(self, reply, session_id, total_tokens=None, query=None):
-        session = self.build_session(session_id)
-        if query:
-            session.add_query(query)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 2500)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.session_lock(session_id):
+            session = self.build_session(session_id)
+            if query:
+                session.add_query(query)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 2500)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self._save_session(session)
         return session
 
 
 class LinkAISession(ChatGPTSession):
-    def calc_tokens(self):
-        if not self.messages:
-            return 0
-        return len(str(self.messages))
-
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        cur_tokens = self.calc_tokens()
-        if cur_tokens > max_tokens:
-            for i in range(0, len(self.messages)):
-                if i > 0 and self.messages[i].get("role") == "assistant" and self.messages[i - 1].get("role") == "user":
-                    self.messages.pop(i)
-                    self.messages.pop(i - 1)
-                    return self.calc_tokens()
-        return cur_tokens
+    def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
+        super().__init__(session_id, system_prompt, model)
+        self.tokenizer = CharacterTokenizer()  # 应用实际使用的模型由LinkAI决定，按字符数估算
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -12,7 +13,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import async_http_client, http_client
 from common import const
 
 
@@ -45,55 +46,94 @@ class MinimaxBot(Bot):
 
     def reply(self, query, context: Context = None) -> Reply:
         # acquire reply content
-        logger.info("[Minimax_AI] query={}".format(query))
         if context.type == ContextType.TEXT:
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session = self._text_request(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[Minimax_AI] session query={}".format(session))
 
-            model = context.get("Minimax_model")
-            new_args = self.args.copy()
-            if model:
-                new_args["model"] = model
+            new_args = self._request_args(context)
             # if context.get('stream'):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[Minimax_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._text_reply(session, reply_content)
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context: Context = None) -> Reply:
+        # 文本对话使用异步请求，其它类型仍在线程中执行
+        if context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        # 会话读写在线程池中执行，只有请求接口在事件循环中等待
+        reply, session = await self.run_sync(context, self._text_request, query, context)
+        if reply:
+            return reply
+
+        reply_content = await self.areply_text(session, args=self._request_args(context))
+        return await self.run_sync(context, self._text_reply, session, reply_content)
+
+    def _text_request(self, query, context):
+        """
+        reply和areply共用的请求前步骤：处理管理命令，把提问加入会话
+        :return: (管理命令的回复, 会话)，有回复时直接返回，不再请求
+        """
+        logger.info("[Minimax_AI] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[Minimax_AI] session query={}".format(session))
+        return None, session
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+
+    def _request_args(self, context):
+        model = context.get("Minimax_model")
+        new_args = self.args.copy()
+        if model:
+            new_args["model"] = model
+        return new_args
+
+    def _text_reply(self, session: MinimaxSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[Minimax_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def _request(self, session: MinimaxSession):
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
+        # 每次请求使用新的body，并发请求之间互不影响
+        request_body = dict(self.request_body, messages=list(session.messages))
+        logger.info("[Minimax_AI] request_body={}".format(request_body))
+        return headers, request_body
+
     def reply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -103,44 +143,15 @@ class MinimaxBot(Bot):
         :return: {}
         """
         try:
-            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
-            self.request_body["messages"].extend(session.messages)
-            logger.info("[Minimax_AI] request_body={}".format(self.request_body))
+            headers, request_body = self._request(session)
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
-
-            # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["total_tokens"],
-                    "content": response["reply"],
-                }
+            res = http_client.post(self.base_url, headers=headers, json=request_body)
+            result, need_retry = self._parse_response(res, retry_count)
+            if need_retry:
+                time.sleep(3)
+                return self.reply_text(session, args, retry_count + 1)
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
-
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
+                return result
         except Exception as e:
             logger.exception(e)
             need_retry = retry_count < 2
@@ -149,3 +160,56 @@ class MinimaxBot(Bot):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    async def areply_text(self, session: MinimaxSession, args=None, retry_count=0) -> dict:
+        """
+        async version of reply_text, waits for the response without occupying a thread
+        """
+        try:
+            headers, request_body = self._request(session)
+            res = await async_http_client.post(self.base_url, headers=headers, json=request_body)
+            result, need_retry = self._parse_response(res, retry_count)
+            if need_retry:
+                await asyncio.sleep(3)
+                return await self.areply_text(session, args, retry_count + 1)
+            else:
+                return result
+        except Exception as e:
+            logger.exception(e)
+            need_retry = retry_count < 2
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            if need_retry:
+                return await self.areply_text(session, args, retry_count + 1)
+            else:
+                return result
+
+    def _parse_response(self, res, retry_count):
+        """
+        解析同步或异步请求的响应
+        :return: (回复内容, 是否需要重试)
+        """
+        if res.status_code == 200:
+            response = res.json()
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["total_tokens"],
+                "content": response["reply"],
+            }, False
+        response = res.json()
+        error = response.get("error")
+        logger.error(f"[Minimax_AI] chat failed, status_code={res.status_code}, " f"msg={error.get('message')}, type={error.get('type')}")
+
+        result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        need_retry = False
+        if res.status_code >= 500:
+            # server error, need retry
+            logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
+            need_retry = retry_count < 2
+        elif res.status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif res.status_code == 429:
+            result["content"] = "请求过于频繁，请稍后再试"
+            need_retry = retry_count < 2
+        else:
+            need_retry = False
+        return result, need_retry
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -7,11 +8,12 @@ import openai.error
 from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
-from bridge.reply import Reply, ReplyType
+from bridge.reply import Reply, ReplyType, StreamReply
 from common.log import logger
 from config import conf, load_config
 from .moonshot_session import MoonshotSession
-import requests
+from common import async_http_client, http_client
+from common.cancellation import OperationCancelled
 
 
 # ZhipuAI对话模型API
@@ -30,55 +32,94 @@ class MoonshotBot(Bot):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[MOONSHOT_AI] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session = self._text_request(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
 
-            model = context.get("moonshot_model")
-            new_args = self.args.copy()
-            if model:
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
+            new_args = self._request_args(context)
+            if context.get("stream"):
+                # reply in stream
+                reply = self.reply_text_stream(session, args=new_args, cancel_token=context.get("cancel_token"))
+                if reply:
+                    return reply
 
             reply_content = self.reply_text(session, args=new_args)
-            logger.debug(
-                "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._text_reply(session, reply_content)
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context=None):
+        # 文本对话使用异步请求，其它类型和流式回复仍在线程中执行
+        if context.type != ContextType.TEXT or context.get("stream"):
+            return await super().areply(query, context)
+        # 会话读写在线程池中执行，只有请求接口在事件循环中等待
+        reply, session = await self.run_sync(context, self._text_request, query, context)
+        if reply:
+            return reply
+
+        reply_content = await self.areply_text(session, args=self._request_args(context))
+        return await self.run_sync(context, self._text_reply, session, reply_content)
+
+    def _text_request(self, query, context):
+        """
+        reply和areply共用的请求前步骤：处理管理命令，把提问加入会话
+        :return: (管理命令的回复, 会话)，有回复时直接返回，不再请求
+        """
+        logger.info("[MOONSHOT_AI] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[MOONSHOT_AI] session query={}".format(session.messages))
+        return None, session
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+
+    def _request_args(self, context):
+        model = context.get("moonshot_model")
+        new_args = self.args.copy()
+        if model:
+            new_args["model"] = model
+        return new_args
+
+    def _text_reply(self, session: MoonshotSession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[MOONSHOT_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[MOONSHOT_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
+    def _headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + self.api_key
+        }
+
     def reply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -88,51 +129,20 @@ class MoonshotBot(Bot):
         :return: {}
         """
         try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + self.api_key
-            }
-            body = args
-            body["messages"] = session.messages
+            body = dict(args, messages=session.messages)
             # logger.debug("[MOONSHOT_AI] response={}".format(response))
             # logger.info("[MOONSHOT_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
-                headers=headers,
+                headers=self._headers(),
                 json=body
             )
-            if res.status_code == 200:
-                response = res.json()
-                return {
-                    "total_tokens": response["usage"]["total_tokens"],
-                    "completion_tokens": response["usage"]["completion_tokens"],
-                    "content": response["choices"][0]["message"]["content"]
-                }
+            result, need_retry = self._parse_response(res, retry_count)
+            if need_retry:
+                time.sleep(3)
+                return self.reply_text(session, args, retry_count + 1)
             else:
-                response = res.json()
-                error = response.get("error")
-                logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
-                             f"msg={error.get('message')}, type={error.get('type')}")
-
-                result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
-                need_retry = False
-                if res.status_code >= 500:
-                    # server error, need retry
-                    logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
-                elif res.status_code == 401:
-                    result["content"] = "授权失败，请检查API Key是否正确"
-                elif res.status_code == 429:
-                    result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
-                else:
-                    need_retry = False
-
-                if need_retry:
-                    time.sleep(3)
-                    return self.reply_text(session, args, retry_count + 1)
-                else:
-                    return result
+                return result
         except Exception as e:
             logger.exception(e)
             need_retry = retry_count < 2
@@ -141,3 +151,83 @@ class MoonshotBot(Bot):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
+
+    async def areply_text(self, session: MoonshotSession, args=None, retry_count=0) -> dict:
+        """
+        async version of reply_text, waits for the response without occupying a thread
+        """
+        try:
+            body = dict(args, messages=session.messages)
+            res = await async_http_client.post(self.base_url, headers=self._headers(), json=body)
+            result, need_retry = self._parse_response(res, retry_count)
+            if need_retry:
+                await asyncio.sleep(3)
+                return await self.areply_text(session, args, retry_count + 1)
+            else:
+                return result
+        except Exception as e:
+            logger.exception(e)
+            need_retry = retry_count < 2
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            if need_retry:
+                return await self.areply_text(session, args, retry_count + 1)
+            else:
+                return result
+
+    def _parse_response(self, res, retry_count):
+        """
+        解析同步或异步请求的响应
+        :return: (回复内容, 是否需要重试)
+        """
+        if res.status_code == 200:
+            response = res.json()
+            return {
+                "total_tokens": response["usage"]["total_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "content": response["choices"][0]["message"]["content"]
+            }, False
+        response = res.json()
+        error = response.get("error")
+        logger.error(f"[MOONSHOT_AI] chat failed, status_code={res.status_code}, "
+                     f"msg={error.get('message')}, type={error.get('type')}")
+
+        result = {"completion_tokens": 0, "content": "提问太快啦，请休息一下再问我吧"}
+        need_retry = False
+        if res.status_code >= 500:
+            # server error, need retry
+            logger.warn(f"[MOONSHOT_AI] do retry, times={retry_count}")
+            need_retry = retry_count < 2
+        elif res.status_code == 401:
+            result["content"] = "授权失败，请检查API Key是否正确"
+        elif res.status_code == 429:
+            result["content"] = "请求过于频繁，请稍后再试"
+            need_retry = retry_count < 2
+        else:
+            need_retry = False
+        return result, need_retry
+
+    def reply_text_stream(self, session: MoonshotSession, args=None, cancel_token=None) -> StreamReply:
+        """
+        call moonshot's chat completions in stream mode
+        :return: StreamReply, or None if the request failed and should fall back to reply_text
+        """
+        try:
+            body = dict(args, messages=session.messages, stream=True)
+            res = http_client.post(self.base_url, headers=self._headers(), json=body, stream=True, cancel_token=cancel_token)
+            if res.status_code != 200:
+                logger.warn(f"[MOONSHOT_AI] stream request failed, status_code={res.status_code}, fallback to normal request")
+                res.close()
+                return None
+        except Exception as e:
+            logger.warn(f"[MOONSHOT_AI] stream request failed, fallback to normal request: {e}")
+            return None
+
+        def deltas():
+            with res:
+                for chunk in http_client.iter_sse(res):
+                    if cancel_token and cancel_token.cancelled:
+                        raise OperationCancelled()
+                    if chunk.get("choices"):
+                        yield chunk["choices"][0].get("delta", {}).get("content")
+
+        return StreamReply(deltas(), lambda content: self.sessions.session_reply(content, session.session_id))
@@ -1,10 +1,32 @@
-from bot.session_manager import Session
-from common.log import logger
+from bot.session_manager import Session, Tokenizer
+from common import tokenizer
+
+
+# 按对话模型输入中每条消息对应的片段计算token数
+class PromptTokenizer(Tokenizer):
+    def __init__(self, model):
+        self.model = model
+
+    def count(self, message) -> int:
+        return num_tokens_from_string(prompt_item(message), self.model)
+
+    def count_many(self, messages) -> list:
+        return tokenizer.encode_lens([prompt_item(message) for message in messages], self.model, disallowed_special=())
+
+
+def prompt_item(item):
+    if item["role"] == "system":
+        return item["content"] + "<|endoftext|>\n\n\n"
+    elif item["role"] == "user":
+        return "Q: " + item["content"] + "\n"
+    elif item["role"] == "assistant":
+        return "\n\nA: " + item["content"] + "<|endoftext|>\n"
+    return ""
 
 
 class OpenAISession(Session):
     def __init__(self, session_id, system_prompt=None, model="text-davinci-003"):
-        super().__init__(session_id, system_prompt)
+        super().__init__(session_id, system_prompt, tokenizer=PromptTokenizer(model))
         self.model = model
         self.reset()
 
@@ -15,59 +37,13 @@ class OpenAISession(Session):
               A: xxx
               Q: xxx
         """
-        prompt = ""
-        for item in self.messages:
-            if item["role"] == "system":
-                prompt += item["content"] + "<|endoftext|>\n\n\n"
-            elif item["role"] == "user":
-                prompt += "Q: " + item["content"] + "\n"
-            elif item["role"] == "assistant":
-                prompt += "\n\nA: " + item["content"] + "<|endoftext|>\n"
-
+        prompt = "".join(prompt_item(item) for item in self.messages)
         if len(self.messages) > 0 and self.messages[-1]["role"] == "user":
             prompt += "A: "
         return prompt
 
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            if cur_tokens is None:
-                raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-        while cur_tokens > max_tokens:
-            if len(self.messages) > 1:
-                self.messages.pop(0)
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
-                self.messages.pop(0)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = len(str(self))
-                break
-            elif len(self.messages) == 1 and self.messages[0]["role"] == "user":
-                logger.warn("user question exceed max_tokens. total_tokens={}".format(cur_tokens))
-                break
-            else:
-                logger.debug("max_tokens={}, total_tokens={}, len(conversation)={}".format(max_tokens, cur_tokens, len(self.messages)))
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = len(str(self))
-        return cur_tokens
-
-    def calc_tokens(self):
-        return num_tokens_from_string(str(self), self.model)
-
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string, disallowed_special=()))
-    return num_tokens
+    return tokenizer.encode_len(string, model, disallowed_special=())
@@ -0,0 +1,102 @@
+"""
+会话历史的滚动摘要，裁剪会话时被丢弃的对话交给一个便宜的模型异步生成摘要，摘要附加在system prompt之后
+不阻塞回复，同一会话同时只有一个摘要任务，执行期间新丢弃的对话合并到下一次
+"""
+
+import threading
+
+from common import http_client, metrics
+from common.log import logger
+from common.thread_pool import AdaptiveThreadPool
+from config import conf
+
+SUMMARY_PROMPT = "你是对话摘要助手。请把已有摘要和新的对话合并成一份新的摘要，保留用户的身份、偏好、需求以及已经给出的重要结论，使用第三人称，不超过{}字，只输出摘要内容。"
+ROLE_NAMES = {"user": "用户", "assistant": "助手", "USER": "用户", "BOT": "助手"}
+
+
+def summarize(summary, messages):
+    """
+    调用session_summary_model(OpenAI兼容接口)合并已有摘要和新的对话
+    """
+    lines = []
+    for message in messages:
+        role = message.get("role") or message.get("sender_type")
+        content = message.get("content") or message.get("text") or ""
+        lines.append("{}: {}".format(ROLE_NAMES.get(role, role), content))
+    body = {
+        "model": conf().get("session_summary_model"),
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT.format(conf().get("session_summary_max_chars", 300))},
+            {"role": "user", "content": "已有摘要：\n{}\n\n新的对话：\n{}".format(summary or "无", "\n".join(lines))},
+        ],
+        "temperature": 0,
+    }
+    api_base = conf().get("session_summary_api_base") or conf().get("open_ai_api_base")
+    api_key = conf().get("session_summary_api_key") or conf().get("open_ai_api_key")
+    res = http_client.post(
+        api_base.rstrip("/") + "/chat/completions",
+        headers={"Authorization": "Bearer " + api_key, "Content-Type": "application/json"},
+        json=body,
+        timeout=conf().get("request_timeout", 180),
+        proxy=conf().get("proxy"),
+    )
+    res.raise_for_status()
+    return res.json()["choices"][0]["message"]["content"].strip()
+
+
+class SessionCompactor:
+    def __init__(self, apply, summarize_func=summarize, executor=None):
+        self.apply = apply  # apply(session_id, generation, messages, summarize_func)，由SessionManager读取已有摘要并写回新摘要
+        self.summarize = summarize_func
+        self.executor = executor or AdaptiveThreadPool(name="session-compactor", min_workers=1, max_workers=2)
+        self.lock = threading.Lock()
+        self.pending = {}  # session_id -> (generation, 等待摘要的消息)
+        self.running = set()
+        self.generations = {}  # session_id -> 重置次数，会话被重置后丢弃之前的摘要任务，只记录有摘要任务在执行的会话
+        self.compacted_cnt = metrics.counter("session_compactor.messages")
+        self.error_cnt = metrics.counter("session_compactor.errors")
+
+    def generation(self, session_id):
+        return self.generations.get(session_id, 0)
+
+    def submit(self, session_id, messages):
+        with self.lock:
+            generation = self.generation(session_id)
+            pending = self.pending.get(session_id)
+            if pending and pending[0] == generation:
+                pending[1].extend(messages)
+            else:
+                self.pending[session_id] = (generation, list(messages))
+            if session_id in self.running:
+                return
+            self.running.add(session_id)
+        self.executor.submit(self._run, session_id)
+
+    def cancel(self, session_id):
+        with self.lock:
+            self.pending.pop(session_id, None)
+            if session_id in self.running:  # 没有执行中的任务时不需要记录，避免每个重置过的会话都留下一条记录
+                self.generations[session_id] = self.generation(session_id) + 1
+
+    def cancel_all(self):
+        with self.lock:
+            for session_id in self.running:
+                self.generations[session_id] = self.generation(session_id) + 1
+            self.pending.clear()
+
+    def _run(self, session_id):
+        while True:
+            with self.lock:
+                item = self.pending.pop(session_id, None)
+                if item is None:
+                    # 任务全部结束，之后提交的任务从0开始计数
+                    self.running.discard(session_id)
+                    self.generations.pop(session_id, None)
+                    return
+            generation, messages = item
+            try:
+                self.apply(session_id, generation, messages, self.summarize)
+                self.compacted_cnt.inc(len(messages))
+            except Exception as e:
+                self.error_cnt.inc()
+                logger.warning("[session_compactor] summarize session {} failed: {}".format(session_id, e))
@@ -1,12 +1,46 @@
+import contextlib
+import sys
+import threading
+
+from bot.session_store import create_session_store
+from common import metrics
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
 
 
+# 计算单条消息token数的分词器，各模型可以实现自己的计数方式
+class Tokenizer(object):
+    reply_tokens = 0  # 除消息外，每次请求额外占用的token数
+
+    def count(self, message) -> int:
+        raise NotImplementedError
+
+    def count_many(self, messages) -> list:
+        return [self.count(message) for message in messages]
+
+
+# 按字符数粗略估算token数
+class CharacterTokenizer(Tokenizer):
+    def __init__(self, key="content"):
+        self.key = key
+
+    def count(self, message) -> int:
+        return len(message[self.key])
+
+
 class Session(object):
-    def __init__(self, session_id, system_prompt=None):
+    role_key = "role"  # 消息中表示角色的字段
+    user_role = "user"  # 用户消息的角色，按轮丢弃历史消息时以用户消息作为一轮的开始
+    pin_system_prompt = True  # 丢弃历史消息时保留第一条system消息
+    summary_prefix = "\n\n以下是之前对话的摘要：\n"  # 历史对话的摘要附加在system消息之后
+
+    def __init__(self, session_id, system_prompt=None, tokenizer: Tokenizer = None):
         self.session_id = session_id
         self.messages = []
+        self.tokenizer = tokenizer or CharacterTokenizer()
+        self.token_cache = {}  # id(message) -> (message, 消息内容, token数)，每条消息只计算一次
+        self.on_discard = None  # 丢弃历史消息时的回调 on_discard(session, messages)，用于生成摘要
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -16,6 +50,7 @@ class Session(object):
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
         self.messages = [system_item]
+        self.token_cache.clear()
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
@@ -29,22 +64,133 @@ class Session(object):
         assistant_item = {"role": "assistant", "content": reply}
         self.messages.append(assistant_item)
 
+    def message_tokens(self, message):
+        """
+        单条消息的token数，使用缓存，消息内容被修改时重新计算
+        """
+        return self.messages_tokens([message])[0]
+
+    def messages_tokens(self, messages=None):
+        """
+        每条消息的token数，未缓存的消息交给tokenizer批量计算
+        """
+        if messages is None:
+            messages = self.messages
+        counts = []
+        missing = []
+        for i, message in enumerate(messages):
+            cached = self.token_cache.get(id(message))
+            if cached is not None and cached[1] == tuple(message.items()):
+                counts.append(cached[2])
+            else:
+                counts.append(None)
+                missing.append(i)
+        if missing:
+            if len(self.token_cache) > 2 * len(self.messages) + 8:  # 清理已经不在会话中的消息
+                alive = set(id(m) for m in self.messages)
+                self.token_cache = {k: v for k, v in self.token_cache.items() if k in alive}
+            tokens = self.tokenizer.count_many([messages[i] for i in missing])
+            for i, n in zip(missing, tokens):
+                counts[i] = n
+                self.token_cache[id(messages[i])] = (messages[i], tuple(messages[i].items()), n)
+        return counts
+
+    def size_bytes(self):
+        """
+        会话中消息占用内存的粗略估算
+        """
+        return sum(sys.getsizeof(message) + sum(sys.getsizeof(value) for value in message.values()) for message in self.messages)
+
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
-        raise NotImplementedError
+        """
+        超出max_tokens时按轮(一条用户消息及其后的回复)丢弃最早的历史消息，保留system prompt和当前的提问
+        """
+        precise = True
+        try:
+            counts = self.messages_tokens()
+            cur_tokens = sum(counts) + self.tokenizer.reply_tokens
+        except Exception as e:
+            precise = False
+            if cur_tokens is None:
+                raise e
+            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        start = 1 if self.pin_system_prompt and self.messages and self.messages[0].get("role") == "system" else 0
+        end = start  # messages[start:end]为要丢弃的消息，最后一次性删除
+        while cur_tokens > max_tokens:
+            if end >= len(self.messages):
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                break
+            turn_end = end + 1
+            while turn_end < len(self.messages) and self.messages[turn_end].get(self.role_key) != self.user_role:
+                turn_end += 1
+            if turn_end == len(self.messages) and self.messages[-1].get(self.role_key) == self.user_role:
+                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
+                break
+            if precise:
+                cur_tokens = cur_tokens - sum(counts[end:turn_end])
+            else:
+                cur_tokens = cur_tokens - max_tokens
+            end = turn_end
+        if end > start:
+            if self.on_discard:
+                self.on_discard(self, self.messages[start:end])
+            del self.messages[start:end]
+        return cur_tokens
+
+    def _system_message(self):
+        if self.pin_system_prompt and self.messages and self.messages[0].get("role") == "system":
+            return self.messages[0]
+        return None
+
+    def get_summary(self):
+        """
+        附加在system消息中的历史对话摘要，没有时返回空字符串
+        """
+        message = self._system_message()
+        if message is None:
+            return ""
+        content = message.get("content") or ""
+        index = content.find(self.summary_prefix)
+        return content[index + len(self.summary_prefix) :] if index >= 0 else ""
+
+    def set_summary(self, summary):
+        """
+        更新system消息中的历史对话摘要，没有system消息时返回False
+        """
+        message = self._system_message()
+        if message is None:
+            return False
+        content = self.system_prompt + self.summary_prefix + summary if summary else self.system_prompt
+        self.messages[0] = {"role": "system", "content": content}  # 替换为新的消息，token缓存按新消息重新计算
+        return True
 
     def calc_tokens(self):
-        raise NotImplementedError
+        return sum(self.messages_tokens()) + self.tokenizer.reply_tokens
 
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
-        if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
-        else:
-            sessions = dict()
-        self.sessions = sessions
+        # 按最近访问排序，超出内存预算时淘汰最久未访问的会话
+        self.sessions = ExpiredDict(conf().get("expires_in_seconds") or None, on_evict=self._on_evict)
         self.sessioncls = sessioncls
         self.session_args = session_args
+        # 会话的持久化存储，内存中没有的会话在第一次访问时从存储中加载
+        self.store = create_session_store(conf().get("session_store", ""))
+        self.namespace = sessioncls.__name__
+        # 会话占用内存的统计，session_memory_budget_mb为0时不限制
+        self.memory_budget = int(conf().get("session_memory_budget_mb", 0) * 1024 * 1024)
+        self.session_bytes = {}  # session_id -> 估算的字节数
+        self.total_bytes = 0
+        self.bytes_lock = threading.Lock()
+        self.evicted = metrics.meter("session_manager.evicted", bot=self.namespace)
+        metrics.gauge("session_manager.sessions", lambda: len(self.session_bytes), bot=self.namespace)
+        metrics.gauge("session_manager.bytes", lambda: self.total_bytes, bot=self.namespace)
+        # 配置session_summary_model时，被丢弃的历史对话在后台压缩成摘要，而不是直接丢弃
+        self.compactor = None
+        if conf().get("session_summary_model"):
+            from bot.session_compactor import SessionCompactor
+
+            self.compactor = SessionCompactor(self._apply_summary)
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,38 +200,160 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
+        if system_prompt is not None and self.compactor:  # 会话被重置，之前的对话不再需要摘要
+            self.compactor.cancel(session_id)
+        if self.store and self.store.shared:  # 多进程共享的会话每次都读取最新的内容，不在本地缓存
+            session = self._load_session(session_id, system_prompt)
+            if system_prompt is not None:
+                self._save_session(session)
+            return session
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            self.sessions[session_id] = self._load_session(session_id, system_prompt)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
         session = self.sessions[session_id]
         return session
 
+    def _load_session(self, session_id, system_prompt=None):
+        data = self.store.load(self.namespace, session_id) if self.store else None
+        if data is None or system_prompt is not None:
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            if self.compactor:
+                session.on_discard = self._on_discard
+            return session
+        return self._restore_session(session_id, data)
+
+    def _restore_session(self, session_id, data):
+        session = self.sessioncls(session_id, data["system_prompt"], **self.session_args)
+        session.messages = data["messages"]
+        if self.compactor:
+            session.on_discard = self._on_discard
+        return session
+
+    def _on_discard(self, session, messages):
+        if session.session_id is not None and session._system_message() is not None:
+            self.compactor.submit(session.session_id, messages)
+
+    def _apply_summary(self, session_id, generation, messages, summarize):
+        """
+        在后台线程中执行，调用模型时不持有会话锁，写回前确认会话没有被重置
+        """
+        with self.session_lock(session_id):
+            session = self._existing_session(session_id)
+            if session is None:
+                return
+            system_prompt, previous = session.system_prompt, session.get_summary()
+        summary = summarize(previous, messages)
+        with self.session_lock(session_id):
+            session = self._existing_session(session_id)
+            if session is None or generation != self.compactor.generation(session_id) or session.system_prompt != system_prompt:
+                return
+            if session.set_summary(summary):
+                self._save_session(session)
+                logger.debug("[SessionManager] summarize {} messages of session {}: {}".format(len(messages), session_id, summary))
+
+    def _existing_session(self, session_id):
+        # 只处理仍然存在的会话，已过期或被淘汰的会话不再写回摘要
+        if self.store and self.store.shared:
+            data = self.store.load(self.namespace, session_id)
+            return self._restore_session(session_id, data) if data is not None else None
+        return self.sessions.get(session_id)
+
+    def _save_session(self, session):
+        if self.store and session.session_id is not None:
+            self.store.save(self.namespace, session.session_id, session.system_prompt, session.messages)
+        if session.session_id is not None and not (self.store and self.store.shared):
+            self._account(session.session_id, session.size_bytes())
+
+    def _account(self, session_id, size):
+        with self.bytes_lock:
+            self.total_bytes += size - self.session_bytes.get(session_id, 0)
+            self.session_bytes[session_id] = size
+        # 超出内存预算时淘汰最久未访问的会话，当前会话刚被访问过，不会被淘汰
+        while self.memory_budget and self.total_bytes > self.memory_budget and len(self.sessions) > 1:
+            try:
+                evicted_id, _ = self.sessions.popitem()
+            except KeyError:
+                break
+            self._forget(evicted_id)
+            self.evicted.mark()
+            logger.debug("[SessionManager] evict session {}, total_bytes={}".format(evicted_id, self.total_bytes))
+
+    def _forget(self, session_id):
+        with self.bytes_lock:
+            self.total_bytes -= self.session_bytes.pop(session_id, 0)
+
+    def _on_evict(self, session_id, session):  # 会话过期
+        self._forget(session_id)
+
+    def peek_session(self, session_id):
+        """
+        返回已存在的会话，不存在时返回None，不会创建新的会话
+        """
+        if session_id is None:
+            return None
+        session = self._existing_session(session_id)
+        if session is None and self.store and not self.store.shared:  # 已从内存中淘汰，但仍保存在存储中
+            data = self.store.load(self.namespace, session_id)
+            if data is not None:
+                session = self._restore_session(session_id, data)
+        return session
+
+    def has_history(self, session):
+        """
+        会话中是否已有对话消息(system消息和历史摘要之外)
+        """
+        return any(message.get(session.role_key) != "system" for message in session.messages)
+
+    def session_lock(self, session_id):
+        """
+        修改会话期间持有的锁，共享存储时多个进程之间互斥
+        """
+        if self.store and session_id is not None:
+            return self.store.lock(self.namespace, session_id)
+        return contextlib.nullcontext()
+
     def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        with self.session_lock(session_id):
+            session = self.build_session(session_id)
+            session.add_query(query)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+            self._save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
-        session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with self.session_lock(session_id):
+            session = self.build_session(session_id)
+            session.add_reply(reply)
+            try:
+                max_tokens = conf().get("conversation_max_tokens", 1000)
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            except Exception as e:
+                logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+            self._save_session(session)
         return session
 
     def clear_session(self, session_id):
+        if self.compactor:
+            self.compactor.cancel(session_id)
         if session_id in self.sessions:
             del self.sessions[session_id]
+        self._forget(session_id)
+        if self.store:
+            self.store.delete(self.namespace, session_id)
 
     def clear_all_session(self):
+        if self.compactor:
+            self.compactor.cancel_all()
         self.sessions.clear()
+        with self.bytes_lock:
+            self.session_bytes.clear()
+            self.total_bytes = 0
+        if self.store:
+            self.store.clear(self.namespace)
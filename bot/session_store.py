@@ -0,0 +1,228 @@
+"""
+会话的持久化存储，重启后恢复会话上下文
+写入先放入内存中的待写队列，由后台线程定期批量写入，不增加处理消息时的磁盘延迟
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common import metrics
+from common.kv_store import KVStore, get_kv_store
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    shared = False  # 是否在多个进程间共享，共享的存储每次访问会话都重新读取
+
+    def load(self, namespace, session_id):
+        """
+        读取会话，返回{"system_prompt": str, "messages": list}，不存在或已过期时返回None
+        """
+        raise NotImplementedError
+
+    def save(self, namespace, session_id, system_prompt, messages):
+        raise NotImplementedError
+
+    def delete(self, namespace, session_id):
+        raise NotImplementedError
+
+    def clear(self, namespace):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def lock(self, namespace, session_id):
+        """
+        读取-修改-保存会话期间持有的锁
+        """
+        return contextlib.nullcontext()
+
+
+_DELETED = object()
+
+
+# 基于SQLite的会话存储，不同bot的会话通过namespace区分
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path, expires_in_seconds=0, flush_interval=1):
+        self.path = path
+        self.expires_in_seconds = expires_in_seconds  # 超过该时间未更新的会话视为过期，0表示不过期
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "namespace TEXT NOT NULL, session_id TEXT NOT NULL, system_prompt TEXT, messages TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (namespace, session_id))"
+        )
+        self.conn.commit()
+        self.db_lock = threading.Lock()  # 保护数据库连接
+        self._pending_lock = threading.Lock()  # 保护待写队列，lock是会话锁方法，不能用这个名字
+        self.pending = {}  # (namespace, session_id) -> (system_prompt, messages, updated_at) 或 _DELETED
+        self.flushing = {}  # 正在写入数据库的一批数据，写入完成前读取时仍以它为准
+        self.flush_lock = threading.Lock()  # 保证批量写入和清空操作依次执行
+        self.event = threading.Event()
+        self.last_purge = 0
+        self.write_cnt = metrics.counter("session_store.writes")
+        self.load_cnt = metrics.counter("session_store.loads")
+        metrics.gauge("session_store.pending", lambda: len(self.pending))
+        self.thread = threading.Thread(target=self._run, name="session-store", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _expired(self, updated_at):
+        return self.expires_in_seconds and time.time() - updated_at > self.expires_in_seconds
+
+    def load(self, namespace, session_id):
+        with self._pending_lock:
+            key = (namespace, session_id)
+            item = self.pending.get(key, self.flushing.get(key))
+        if item is _DELETED:
+            return None
+        if item is None:
+            with self.db_lock:
+                row = self.conn.execute(
+                    "SELECT system_prompt, messages, updated_at FROM sessions WHERE namespace=? AND session_id=?",
+                    (namespace, session_id),
+                ).fetchone()
+            if row is None:
+                return None
+            item = (row[0], json.loads(row[1]), row[2])
+        if self._expired(item[2]):
+            return None
+        self.load_cnt.inc()
+        return {"system_prompt": item[0], "messages": list(item[1])}
+
+    def save(self, namespace, session_id, system_prompt, messages):
+        # 只复制消息列表，序列化在后台线程中进行
+        with self._pending_lock:
+            self.pending[(namespace, session_id)] = (system_prompt, list(messages), time.time())
+        self.event.set()
+
+    def delete(self, namespace, session_id):
+        with self._pending_lock:
+            self.pending[(namespace, session_id)] = _DELETED
+        self.event.set()
+
+    def clear(self, namespace):
+        with self.flush_lock:
+            with self._pending_lock:
+                for key in [key for key in self.pending if key[0] == namespace]:
+                    del self.pending[key]
+            with self.db_lock:
+                self.conn.execute("DELETE FROM sessions WHERE namespace=?", (namespace,))
+                self.conn.commit()
+
+    def flush(self):
+        with self.flush_lock:
+            with self._pending_lock:
+                pending = self.flushing = self.pending
+                self.pending = {}
+            try:
+                if pending:
+                    self._write(pending)
+            finally:
+                with self._pending_lock:
+                    self.flushing = {}
+
+    def _write(self, pending):
+        upserts = []
+        deletes = []
+        for (namespace, session_id), item in pending.items():
+            if item is _DELETED:
+                deletes.append((namespace, session_id))
+            else:
+                system_prompt, messages, updated_at = item
+                upserts.append((namespace, session_id, system_prompt, json.dumps(messages, ensure_ascii=False), updated_at))
+        with self.db_lock:
+            if upserts:
+                self.conn.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", upserts)
+            if deletes:
+                self.conn.executemany("DELETE FROM sessions WHERE namespace=? AND session_id=?", deletes)
+            self.conn.commit()
+        self.write_cnt.inc(len(pending))
+
+    def purge(self):
+        """
+        删除已过期的会话
+        """
+        if not self.expires_in_seconds:
+            return
+        with self.db_lock:
+            cursor = self.conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.expires_in_seconds,))
+            self.conn.commit()
+        if cursor.rowcount:
+            logger.debug("[session_store] purge {} expired sessions".format(cursor.rowcount))
+
+    def _run(self):
+        while True:
+            self.event.wait()
+            time.sleep(self.flush_interval)  # 等待一段时间，合并这期间的写入
+            self.event.clear()
+            try:
+                self.flush()
+                if time.time() - self.last_purge > 600:
+                    self.last_purge = time.time()
+                    self.purge()
+            except Exception as e:
+                logger.exception("[session_store] flush error: {}".format(e))
+
+
+# 保存在共享KV存储(如redis)中的会话，多个进程处理同一会话的消息时通过会话锁保证读写的一致性
+class KVSessionStore(SessionStore):
+    shared = True
+
+    def __init__(self, kv: KVStore, expires_in_seconds=0):
+        self.kv = kv
+        self.expires_in_seconds = expires_in_seconds
+
+    def _key(self, namespace, session_id):
+        return "session:{}:{}".format(namespace, session_id)
+
+    def load(self, namespace, session_id):
+        return self.kv.get(self._key(namespace, session_id))
+
+    def save(self, namespace, session_id, system_prompt, messages):
+        data = {"system_prompt": system_prompt, "messages": messages}
+        self.kv.set(self._key(namespace, session_id), data, ttl=self.expires_in_seconds or None)
+
+    def delete(self, namespace, session_id):
+        self.kv.delete(self._key(namespace, session_id))
+
+    def clear(self, namespace):
+        self.kv.delete_prefix("session:{}:".format(namespace))
+
+    def lock(self, namespace, session_id):
+        return self.kv.lock(self._key(namespace, session_id))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def create_session_store(store_type) -> SessionStore:
+    """
+    根据配置创建会话存储，同一类型的存储在所有bot之间共享，未配置时返回None
+    """
+    if not store_type:
+        return None
+    with _stores_lock:
+        if store_type not in _stores:
+            if store_type == "sqlite":
+                _stores[store_type] = SqliteSessionStore(
+                    os.path.join(get_appdata_dir(), "sessions.db"),
+                    expires_in_seconds=conf().get("expires_in_seconds", 0) or 0,
+                    flush_interval=conf().get("session_store_flush_interval", 1),
+                )
+            elif store_type == "kv":
+                _stores[store_type] = KVSessionStore(get_kv_store(), expires_in_seconds=conf().get("expires_in_seconds", 0) or 0)
+            else:
+                raise RuntimeError("unknown session store: {}".format(store_type))
+        return _stores[store_type]
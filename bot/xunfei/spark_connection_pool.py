@@ -0,0 +1,148 @@
+# encoding:utf-8
+
+"""
+讯飞星火websocket连接池
+- 请求在调用线程中直接读取自己连接上的响应帧，不需要额外的线程和全局队列
+- 星火接口通常在一次问答结束后由服务端关闭连接，连接仍然打开时放回连接池复用，
+  复用的连接在收到第一帧之前失败时换一个新连接重试一次
+- 同时进行的请求数不超过max_connections，等待超过timeout秒抛出SparkTimeout
+- 每一帧最多等待timeout秒，超时、出错、被取消或调用方提前停止读取时关闭连接
+"""
+
+import json
+import ssl
+import threading
+import time
+
+import websocket
+
+from common import metrics
+from common.cancellation import CancellationToken, OperationCancelled
+from common.log import logger
+
+
+class SparkError(Exception):
+    def __init__(self, code, message):
+        super().__init__("code={}, message={}".format(code, message))
+        self.code = code
+
+
+class SparkTimeout(Exception):
+    pass
+
+
+class SparkConnectionPool(object):
+    def __init__(self, url_func, max_connections=10, timeout=30, max_idle_time=60):
+        """
+        :param url_func: 生成带鉴权参数的连接地址，每次新建连接时调用
+        :param max_connections: 同时进行的请求数上限
+        :param timeout: 等待空闲名额、建立连接以及等待每一帧响应的超时秒数
+        :param max_idle_time: 空闲连接超过该时间不再复用
+        """
+        self.url_func = url_func
+        self.timeout = timeout
+        self.max_idle_time = max_idle_time
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []  # [(ws, 放回的时间)]
+
+    def request(self, data: dict, cancel_token: CancellationToken = None):
+        """
+        发送一次请求，逐帧返回解析后的响应，最后一帧的payload.choices.status为2
+        调用方需要读完或者关闭返回的生成器，连接才会被释放
+        """
+        start = time.monotonic()
+        if not self.semaphore.acquire(timeout=self.timeout):
+            metrics.counter("xunfei.connection", result="full").inc()
+            raise SparkTimeout("no free connection in {}s".format(self.timeout))
+        metrics.histogram("xunfei.connection_wait_ms").observe((time.monotonic() - start) * 1000)
+        ws = None
+        finished = False
+        try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            ws, frame = self._send(data, cancel_token)
+            while True:
+                message = self._parse(frame)
+                yield message
+                if message["payload"]["choices"]["status"] == 2:
+                    finished = True
+                    return
+                frame = self._recv(ws, cancel_token)
+        finally:
+            if ws is not None:
+                if cancel_token is not None:
+                    cancel_token.unregister(ws.abort)
+                if finished and ws.connected:
+                    self._release(ws)
+                else:
+                    _close(ws)
+            self.semaphore.release()
+
+    def _send(self, data, cancel_token):
+        # 发送请求并等待第一帧，复用的连接可能已被服务端关闭，此时换新连接重试一次
+        while True:
+            ws, reused = self._connect()
+            if cancel_token is not None:
+                cancel_token.register(ws.abort)
+            try:
+                ws.send(json.dumps(data))
+                return ws, self._recv(ws, cancel_token)
+            except Exception as e:
+                if cancel_token is not None:
+                    cancel_token.unregister(ws.abort)
+                _close(ws)
+                if not reused or not isinstance(e, (websocket.WebSocketConnectionClosedException, ConnectionError)):
+                    raise
+                logger.debug("[XunFei] reused connection closed, reconnect: {}".format(e))
+
+    def _connect(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                ws, since = self.idle.pop()
+                if ws.connected and now - since < self.max_idle_time:
+                    metrics.counter("xunfei.connection", result="reused").inc()
+                    return ws, True
+                _close(ws)
+        metrics.counter("xunfei.connection", result="new").inc()
+        ws = websocket.create_connection(self.url_func(), timeout=self.timeout, sslopt={"cert_reqs": ssl.CERT_NONE})
+        return ws, False
+
+    def _recv(self, ws, cancel_token):
+        try:
+            frame = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            raise SparkTimeout("no response in {}s".format(self.timeout))
+        except Exception:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise OperationCancelled()
+            raise
+        if not frame:
+            raise ConnectionError("connection closed by server")
+        return frame
+
+    @staticmethod
+    def _parse(frame):
+        message = json.loads(frame)
+        code = message["header"]["code"]
+        if code != 0:
+            raise SparkError(code, message["header"].get("message"))
+        return message
+
+    def _release(self, ws):
+        with self.lock:
+            self.idle.append((ws, time.monotonic()))
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ws, _ in idle:
+            _close(ws)
+
+
+def _close(ws):
+    try:
+        ws.close(timeout=0)
+    except Exception:
+        pass
@@ -1,5 +1,6 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
@@ -10,6 +11,7 @@ from bot.zhipuai.zhipu_ai_image import ZhipuAIImage
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import async_http_client
 from common.log import logger
 from config import conf, load_config
 from zhipuai import ZhipuAI
@@ -17,6 +19,8 @@ from zhipuai import ZhipuAI
 
 # ZhipuAI对话模型API
 class ZHIPUAIBot(Bot, ZhipuAIImage):
+    supports_model_override = True
+
     def __init__(self):
         super().__init__()
         self.sessions = SessionManager(ZhipuAISession, model=conf().get("model") or "ZHIPU_AI")
@@ -30,53 +34,18 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[ZHIPU_AI] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session = self._text_request(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
 
             api_key = context.get("openai_api_key") or openai.api_key
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
+            new_args = self._request_args(context)
             # if context.get('stream'):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
             reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            return self._text_reply(session, reply_content)
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
             reply = None
@@ -90,6 +59,72 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def areply(self, query, context=None):
+        # 文本对话使用异步请求，其它类型仍在线程中执行
+        if context.type != ContextType.TEXT:
+            return await super().areply(query, context)
+        # 会话读写在线程池中执行，只有请求接口在事件循环中等待
+        reply, session = await self.run_sync(context, self._text_request, query, context)
+        if reply:
+            return reply
+
+        reply_content = await self.areply_text(session, args=self._request_args(context), context=context)
+        return await self.run_sync(context, self._text_reply, session, reply_content)
+
+    def _text_request(self, query, context):
+        """
+        reply和areply共用的请求前步骤：处理管理命令，把提问加入会话
+        :return: (管理命令的回复, 会话)，有回复时直接返回，不再请求
+        """
+        logger.info("[ZHIPU_AI] query={}".format(query))
+        session_id = context["session_id"]
+        reply = self._command_reply(query, session_id)
+        if reply:
+            return reply, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
+        return None, session
+
+    def _command_reply(self, query, session_id):
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+
+    def _request_args(self, context):
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return new_args
+
+    def _text_reply(self, session: ZhipuAISession, reply_content: dict) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[ZHIPU_AI] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: ZhipuAISession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -147,3 +182,44 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 return self.reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
+
+    async def areply_text(self, session: ZhipuAISession, args=None, retry_count=0, context=None) -> dict:
+        """
+        async version of reply_text, zhipuai sdk has no asyncio client,
+        call the openai compatible api directly, the api key can be used as bearer token
+        :param context: 用于在channel的线程池中执行出错时清除会话等同步步骤
+        """
+        try:
+            if args is None:
+                args = self.args
+            url = conf().get("zhipu_ai_api_base", "https://open.bigmodel.cn/api/paas/v4") + "/chat/completions"
+            headers = {"Authorization": "Bearer " + conf().get("zhipu_ai_api_key")}
+            res = await async_http_client.post(url, headers=headers, json=dict(args, messages=session.messages))
+            if res.status_code == 200:
+                response = res.json()
+                return {
+                    "total_tokens": response["usage"]["total_tokens"],
+                    "completion_tokens": response["usage"]["completion_tokens"],
+                    "content": response["choices"][0]["message"]["content"],
+                }
+            logger.error(f"[ZHIPU_AI] chat failed, status_code={res.status_code}, msg={res.text}")
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            need_retry = retry_count < 2
+            if res.status_code == 429:
+                result["content"] = "提问太快啦，请休息一下再问我吧"
+                retry_delay = 20
+            elif res.status_code >= 500:
+                result["content"] = "请再问我一次"
+                retry_delay = 10
+            else:
+                need_retry = False
+        except Exception as e:
+            logger.exception("[ZHIPU_AI] Exception: {}".format(e))
+            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+            need_retry = False
+            await self.run_sync(context, self.sessions.clear_session, session.session_id)
+        if need_retry:
+            logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
+            await asyncio.sleep(retry_delay)
+            return await self.areply_text(session, args, retry_count + 1, context=context)
+        return result
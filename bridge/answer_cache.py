@@ -0,0 +1,131 @@
+"""
+相同问题的回复缓存，群聊中经常重复出现的问题直接返回之前的回答，不再调用模型
+只缓存没有历史对话的提问(新会话或会话已清除)，key由归一化后的问题、人格描述和模型组成
+answer_cache_ttl为0时不启用
+"""
+
+import hashlib
+import re
+import unicodedata
+
+from bot.bot import Bot
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType, StreamReply
+from common import metrics
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf
+
+_PUNCTUATION = re.compile(r"[\s,.!?~，。！？～、…]+$")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """
+    全角转半角、忽略大小写、合并空白、去掉末尾的标点
+    """
+    query = unicodedata.normalize("NFKC", query).strip().lower()
+    return _PUNCTUATION.sub("", _SPACES.sub(" ", query))
+
+
+class AnswerCache(object):
+    def __init__(self, ttl, max_size=1000):
+        self.answers = ExpiredDict(ttl, max_size=max_size, sliding=False)  # 从写入开始计时，过期后重新向模型提问
+        self.hit_cnt = metrics.counter("answer_cache.lookup", result="hit")
+        self.miss_cnt = metrics.counter("answer_cache.lookup", result="miss")
+        self.bypass_cnt = metrics.counter("answer_cache.lookup", result="bypass")
+        metrics.gauge("answer_cache.size", lambda: len(self.answers.data))
+
+    def cache_key(self, bot_type, bot, query, context: Context):
+        """
+        可以缓存时返回key，会话中已有历史对话等情况返回None
+        """
+        if context is None or context.type != ContextType.TEXT or not query:
+            return None
+        if query in conf().get("clear_memory_commands", ["#清除记忆"]) or query.startswith("#"):
+            return None
+        if context.get("openai_api_key") or context.get("generate_breaked_by"):  # 用户使用自己的key或者插件修改过提问时不共享回答
+            return None
+        sessions = getattr(bot, "sessions", None)
+        if sessions is None:
+            return None
+        session = sessions.peek_session(context.get("session_id"))
+        if session is not None:
+            if sessions.has_history(session):
+                return None
+            system_prompt = session.system_prompt
+        else:
+            system_prompt = conf().get("character_desc", "")
+        model = context.get("gpt_model") or conf().get("model") or ""
+        raw = "\0".join([bot_type, model, context.get("app_code") or "", system_prompt or "", normalize_query(query)])
+        return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+    def fetch(self, bot_type, bot, query, context: Context, reply_func):
+        """
+        命中缓存时把问答写入会话并返回缓存的回复，否则调用reply_func并缓存文本回复
+        """
+        key, reply = self._lookup(bot_type, bot, query, context)
+        if reply is not None:
+            return reply
+        return self._store(key, bot, context, reply_func())
+
+    async def afetch(self, bot_type, bot, query, context: Context, areply_func):
+        """
+        fetch的异步版本，areply_func返回协程，查找和保存缓存时读写会话，在线程池中执行
+        """
+        key, reply = await Bot.run_sync(context, self._lookup, bot_type, bot, query, context)
+        if reply is not None:
+            return reply
+        reply = await areply_func()
+        return await Bot.run_sync(context, self._store, key, bot, context, reply)
+
+    def _lookup(self, bot_type, bot, query, context: Context):
+        """
+        :return: (缓存的key，不能缓存时为None, 命中缓存时的回复)
+        """
+        key = self.cache_key(bot_type, bot, query, context)
+        if key is None:
+            self.bypass_cnt.inc()
+            return None, None
+        content = self.answers.get(key)
+        if content is not None:
+            self.hit_cnt.inc()
+            logger.debug("[answer_cache] hit, query={}".format(query))
+            session_id = context.get("session_id")
+            bot.sessions.session_query(query, session_id)  # 保持会话完整，后续提问仍能看到这一轮对话
+            bot.sessions.session_reply(content, session_id)
+            return key, Reply(ReplyType.TEXT, content)
+        self.miss_cnt.inc()
+        return key, None
+
+    def _store(self, key, bot, context: Context, reply):
+        if key is None:
+            return reply
+        if isinstance(reply, StreamReply):
+            # 流式回复生成结束、写入会话后再缓存
+            on_complete = reply.on_complete
+
+            def cache_on_complete(content):
+                if on_complete:
+                    on_complete(content)
+                self.answers[key] = content
+
+            reply.on_complete = cache_on_complete
+        elif reply and reply.type == ReplyType.TEXT and reply.content and self._answered(bot, context.get("session_id"), reply.content):
+            self.answers[key] = reply.content
+        return reply
+
+    def _answered(self, bot, session_id, content):
+        # 只缓存bot写入了会话的回复，出错时返回的提示文本不会写入会话
+        session = bot.sessions.peek_session(session_id)
+        return session is not None and bool(session.messages) and content in session.messages[-1].values()
+
+    def clear(self):
+        self.answers.clear()
+
+
+def create_answer_cache():
+    ttl = conf().get("answer_cache_ttl", 0)
+    if not ttl:
+        return None
+    return AnswerCache(ttl, max_size=conf().get("answer_cache_size", 1000))
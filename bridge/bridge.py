@@ -1,10 +1,11 @@
 from bot.bot_factory import create_bot
-from common import const
+from common import const, metrics
 from common.log import logger
 from common.singleton import singleton
 from config import config
 from translate.factory import create_translator
 from voice.factory import create_voice
+from .answer_cache import create_answer_cache
 from .context import Context
 from .reply import Reply
 
@@ -71,6 +72,7 @@ class Bridge(object):
 
         self.bots = {}
         self.chat_bots = {}
+        self.answer_cache = create_answer_cache()
 
     def get_bot(self, typename):
         if self.bots.get(typename) is None:
@@ -87,13 +89,38 @@ class Bridge(object):
         return self.btype.get(typename)
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        with metrics.timer("bridge.reply_ms", bot=self.btype["chat"]):
+            bot = self.get_bot("chat")
+            if self.answer_cache:
+                return self.answer_cache.fetch(self.btype["chat"], bot, query, context, lambda: bot.reply(query, context))
+            return bot.reply(query, context)
+
+    async def afetch_reply_content(self, query, context: Context) -> Reply:
+        with metrics.timer("bridge.reply_ms", bot=self.btype["chat"]):
+            bot = self.get_bot("chat")
+            if self.answer_cache:
+                return await self.answer_cache.afetch(self.btype["chat"], bot, query, context, lambda: bot.areply(query, context))
+            return await bot.areply(query, context)
+
+    def supports_model_override(self):
+        """
+        对话bot是否支持通过context["gpt_model"]为单条消息指定模型
+        """
+        return self.get_bot("chat").supports_model_override
+
+    def supports_async_reply(self):
+        """
+        对话bot是否实现了异步请求，等待回复时不占用线程
+        """
+        return self.get_bot("chat").supports_async()
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
-        return self.get_bot("voice_to_text").voiceToText(voiceFile)
+        with metrics.timer("bridge.voice_to_text_ms", voice=self.btype["voice_to_text"]):
+            return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
     def fetch_text_to_voice(self, text) -> Reply:
-        return self.get_bot("text_to_voice").textToVoice(text)
+        with metrics.timer("bridge.text_to_voice_ms", voice=self.btype["text_to_voice"]):
+            return self.get_bot("text_to_voice").textToVoice(text)
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
         return self.get_bot("translate").translate(text, from_lang, to_lang)
@@ -29,3 +29,30 @@ class Reply:
 
     def __str__(self):
         return "Reply(type={}, content={})".format(self.type, self.content)
+
+
+class StreamReply(Reply):
+    """
+    流式回复，bot边生成边返回，channel遍历得到每段增量文本，遍历结束后content为完整回复
+    on_complete在完整回复生成后调用，bot在这里把回复写入会话
+    """
+
+    def __init__(self, deltas, on_complete=None):
+        super().__init__(ReplyType.TEXT, "")
+        self.deltas = deltas
+        self.on_complete = on_complete
+
+    def __iter__(self):
+        for delta in self.deltas:
+            if not delta:
+                continue
+            self.content += delta
+            yield delta
+        if self.on_complete and self.content:
+            self.on_complete(self.content)
+
+    def close(self):
+        # 提前结束时关闭bot的生成器，释放连接
+        close = getattr(self.deltas, "close", None)
+        if close:
+            close()
@@ -1,40 +1,107 @@
+import asyncio
+import functools
+import json
 import os
-import re
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import CancelledError, Future
 
 from bridge.context import *
 from bridge.reply import *
+from bridge.bridge import Bridge
 from channel.channel import Channel
-from common.dequeue import Dequeue
-from common import memory
+from channel.message_coalescer import MessageCoalescer
+from channel.overload_policy import create_overload_policy
+from channel.stream_writer import SentenceStreamWriter, StreamWriter
+from channel.trigger_rules import get_rules, mention_pattern
+from common import async_http_client, event_loop, memory, metrics
+from common.cancellation import CancellationToken, OperationCancelled
+from common.delay_queue import DelayQueue
+from common.reorder_buffer import ReorderBuffer
+from common.retry_scheduler import RetryScheduler
+from common.session_scheduler import SessionScheduler
+from common.thread_pool import AdaptiveThreadPool
 from plugins import *
-from config import config
+from config import conf, get_appdata_dir, global_config
 
 try:
     from voice.audio_convert import any_to_wav
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+
+# 统计ChatChannel各处理阶段的耗时，按阶段和channel类型记录到chat_channel.stage_ms
+def _stage_timer(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with metrics.timer("chat_channel.stage_ms", stage=stage, channel=self.channel_type):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
-    futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
-    sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉
+    cancel_tokens = {}  # 记录每个session_id正在处理的消息的取消令牌, 用于重置会话时中止正在执行的任务
+    lock = threading.Lock()  # 用于控制对futures和cancel_tokens的访问
 
     def __init__(self):
+        # 会话调度器，控制每个session_id同时处理的context数量，有消息或任务完成时才唤醒消费者
+        self.scheduler = SessionScheduler(
+            concurrency=lambda: conf().get("concurrency_in_session", 4),
+            max_queue=conf().get("max_queue_size", 0),
+            max_session_queue=conf().get("max_session_queue_size", 0),
+        )
+        # 排队消息超出上限时的处理策略
+        self.overload_policy = create_overload_policy(conf().get("overload_policy", "drop_oldest"))
+        # 会话内并发处理时，按消息到达顺序发送回复
+        self.reorder_buffer = ReorderBuffer()
+        # 每个channel独立的处理消息的线程池，根据排队数量和处理耗时自动扩缩容
+        self.handler_pool = AdaptiveThreadPool(
+            name=self.__class__.__name__,
+            min_workers=conf().get("handler_pool_min_workers", 2),
+            max_workers=conf().get("handler_pool_max_workers", 32),
+            idle_timeout=conf().get("handler_pool_idle_timeout", 60),
+            initializer=self._init_handler_thread,
+        )
+        self.admin_pool = AdaptiveThreadPool(name=self.__class__.__name__ + "-admin", min_workers=1, max_workers=2)
+        # 延时任务队列，用于合并消息的计时和发送失败后的重试
+        self.delay_queue = DelayQueue(self.__class__.__name__ + "-delay")
+        self.send_retry = RetryScheduler(
+            self.__class__.__name__ + "-send",
+            self.handler_pool,
+            delay_queue=self.delay_queue,
+            max_retries=conf().get("send_retry_times", 2),
+            base_delay=conf().get("send_retry_base_delay", 3),
+            max_delay=conf().get("send_retry_max_delay", 60),
+            jitter=conf().get("send_retry_jitter", 0.1),
+        )
+        # 合并同一用户短时间内连续发送的文本消息，减少模型调用次数
+        self.coalescer = None
+        if conf().get("coalesce_window", 0) > 0:
+            self.coalescer = MessageCoalescer(
+                self._enqueue,
+                delay_queue=self.delay_queue,
+                window=conf().get("coalesce_window"),
+                max_wait=conf().get("coalesce_max_wait", 6),
+                max_size=conf().get("coalesce_max_messages", 5),
+            )
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
 
+    # 处理消息的线程启动时调用，channel需要为处理线程准备资源(如asyncio事件循环)时重写
+    def _init_handler_thread(self):
+        pass
+
     # 根据消息构造context，消息内容相关的触发项写在这里
+    @_stage_timer("compose_context")
     def _compose_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
@@ -45,33 +112,20 @@ class ChatChannel(Channel):
             context["origin_ctype"] = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
+        rules = get_rules()
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             cmsg = context["msg"]
-            user_data = config.get_user_data(cmsg.from_user_id)
+            user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
             context["gpt_model"] = user_data.get("gpt_model")
             if context.get("isgroup", False):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = config.get("group_chat_in_one_session", [])
+                if rules.is_group_enabled(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if rules.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
@@ -85,7 +139,7 @@ class ChatChannel(Channel):
             context = e_context["context"]
             if e_context.is_pass() or context is None:
                 return context
-            if cmsg.from_user_id == self.user_id and not config.get("trigger_by_self", True):
+            if cmsg.from_user_id == self.user_id and not conf().get("trigger_by_self", True):
                 logger.debug("[chat_channel]self message skipped")
                 return None
 
@@ -96,11 +150,11 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = config.get("nick_name_black_list", [])
+            nick_name_black_list = rules.nick_name_black_list
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, config.get("group_chat_prefix"))
-                match_contain = check_contain(content, config.get("group_chat_keyword"))
+                match_prefix = rules.group_chat_prefix.match(content)
+                match_contain = rules.group_chat_keyword.match(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -115,18 +169,15 @@ class ChatChannel(Channel):
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not config.get("group_at_off", False):
+                        if not conf().get("group_at_off", False):
                             flag = True
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = mention_pattern(self.name).sub(r"", content)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = mention_pattern(at).sub(r"", subtract_res)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -139,7 +190,7 @@ class ChatChannel(Channel):
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, config.get("single_chat_prefix", [""]))
+                match_prefix = rules.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -147,26 +198,40 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, config.get("image_create_prefix",[""]))
+            img_match_prefix = rules.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and config.get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and config.get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
     def _handle(self, context: Context):
         if context is None or not context.content:
             return
+        if "dispatch_time" in context:  # 提交到线程池后等待空闲线程的时间
+            self._observe_stage("pool_wait", context["dispatch_time"])
         logger.debug("[chat_channel] ready to handle context: {}".format(context))
         # reply的构建步骤
         reply = self._generate_reply(context)
+        if self._is_cancelled(context):
+            logger.info("[chat_channel] session {} cancelled, drop reply: {}".format(context.get("session_id"), reply))
+            return
+
+        if isinstance(reply, StreamReply):
+            # 流式回复边生成边发送，结束后仍经过包装步骤，插件能看到完整的回复，但不再重复发送
+            streamed = self._stream_reply(context, reply)
+            if streamed is not reply:
+                reply = streamed
+            elif reply.content:
+                self._decorate_reply(context, reply)
+                return
 
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
@@ -174,9 +239,57 @@ class ChatChannel(Channel):
         if reply and reply.content:
             reply = self._decorate_reply(context, reply)
 
-            # reply的发送步骤
+            # reply的发送步骤，有序模式下交给回调按消息到达顺序发送
+            if "reply_seq" in context:
+                return reply
             self._send_reply(context, reply)
 
+    async def _ahandle(self, context: Context):
+        """
+        异步处理文本消息，等待bot回复时不占用线程，插件、包装和发送等同步步骤仍在处理消息的线程池中执行
+        """
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        context["executor"] = self.handler_pool  # bot读写会话等同步步骤也在线程池中执行，不阻塞事件循环
+
+        def run(func, *args):
+            return asyncio.wrap_future(self.handler_pool.submit(func, *args))
+
+        e_context = await run(
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": Reply()},
+            ),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            if context.type == ContextType.TEXT:
+                context["channel"] = e_context["channel"]
+                reply = await Bridge().afetch_reply_content(context.content, context)
+            else:  # 插件修改了消息类型
+                reply = await run(self._build_reply, context, e_context)
+        if self._is_cancelled(context):
+            logger.info("[chat_channel] session {} cancelled, drop reply: {}".format(context.get("session_id"), reply))
+            return
+
+        if reply and reply.content:
+            reply = await run(self._decorate_reply, context, reply)
+            if "reply_seq" in context:
+                return reply
+            await run(self._send_reply, context, reply)
+
+    def _async_enabled(self, context: Context):
+        # 流式回复需要在线程中逐段发送，不使用异步处理
+        return (
+            conf().get("async_reply", False)
+            and context.type == ContextType.TEXT
+            and not self._stream_enabled(context)
+            and async_http_client.available()
+            and Bridge().supports_async_reply()
+        )
+
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
         e_context = PluginManager().emit_event(
             EventContext(
@@ -186,51 +299,61 @@ class ChatChannel(Channel):
         )
         reply = e_context["reply"]
         if not e_context.is_pass():
-            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
-            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
-                context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
-            elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[chat_channel]delete temp file error: " + str(e))
+            reply = self._build_reply(context, e_context)
+        return reply
 
-                if reply.type == ReplyType.TEXT:
-                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
-                    if new_context:
-                        reply = self._generate_reply(new_context)
-                    else:
-                        return
-            elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
-                memory.USER_IMAGE_CACHE[context["session_id"]] = {
-                    "path": context.content,
-                    "msg": context.get("msg")
-                }
-            elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
-                pass
-            elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+    # 插件没有处理的消息，按消息类型生成回复
+    def _build_reply(self, context: Context, e_context: EventContext) -> Reply:
+        reply = e_context["reply"]
+        logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+        if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+            context["channel"] = e_context["channel"]
+            if self._stream_enabled(context):
+                context["stream"] = True  # 支持流式输出的bot返回StreamReply
+            reply = super().build_reply_content(context.content, context)
+        elif context.type == ContextType.VOICE:  # 语音消息
+            cmsg = context["msg"]
+            cmsg.prepare()
+            file_path = context.content
+            wav_path = os.path.splitext(file_path)[0] + ".wav"
+            try:
+                with metrics.timer("chat_channel.stage_ms", stage="any_to_wav", channel=self.channel_type):
+                    any_to_wav(file_path, wav_path)
+            except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+                logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
+                wav_path = file_path
+            # 语音识别
+            reply = super().build_voice_to_text(wav_path)
+            # 删除临时文件
+            try:
+                os.remove(file_path)
+                if wav_path != file_path:
+                    os.remove(wav_path)
+            except Exception as e:
                 pass
-            else:
-                logger.warning("[chat_channel] unknown context type: {}".format(context.type))
-                return
+                # logger.warning("[chat_channel]delete temp file error: " + str(e))
+
+            if reply.type == ReplyType.TEXT:
+                new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
+                if new_context:
+                    reply = self._generate_reply(new_context)
+                else:
+                    return
+        elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
+            memory.USER_IMAGE_CACHE[context["session_id"]] = {
+                "path": context.content,
+                "msg": context.get("msg")
+            }
+        elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
+            pass
+        elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+            pass
+        else:
+            logger.warning("[chat_channel] unknown context type: {}".format(context.type))
+            return
         return reply
 
+    @_stage_timer("decorate_reply")
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -252,13 +375,10 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
-                    if context.get("isgroup", False):
-                        if not context.get("no_need_at", False):
-                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = config.get("group_chat_reply_prefix", "") + reply_text + config.get("group_chat_reply_suffix", "")
-                    else:
-                        reply_text = config.get("single_chat_reply_prefix", "") + reply_text + config.get("single_chat_reply_suffix", "")
-                    reply.content = reply_text
+                    if context.get("isgroup", False) and not context.get("no_need_at", False):
+                        reply_text = reply_text.strip()
+                    prefix, suffix = self._text_affixes(context)
+                    reply.content = prefix + reply_text + suffix
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -270,7 +390,81 @@ class ChatChannel(Channel):
                 logger.warning("[chat_channel] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply
 
+    # 文本回复的前缀和后缀，群聊中@提问的用户
+    def _text_affixes(self, context: Context):
+        if context.get("isgroup", False):
+            prefix = conf().get("group_chat_reply_prefix", "")
+            if not context.get("no_need_at", False):
+                prefix += "@" + context["msg"].actual_user_nickname + "\n"
+            return prefix, conf().get("group_chat_reply_suffix", "")
+        return conf().get("single_chat_reply_prefix", ""), conf().get("single_chat_reply_suffix", "")
+
+    def _stream_enabled(self, context: Context):
+        # 有序回复需要等前面的回复发送后才能发送，语音回复需要完整的文本，都不使用流式回复
+        return (
+            conf().get("stream_reply", False)
+            and context.type == ContextType.TEXT
+            and "reply_seq" not in context
+            and context.get("desire_rtype") != ReplyType.VOICE
+        )
+
+    def create_stream_writer(self, context: Context) -> StreamWriter:
+        """
+        流式回复的发送方式，默认按句子分段发送，能更新已发送消息的channel可以重写
+        分段直接发送，失败时不进入延时重试，避免后面的分段先到达，剩余内容在结束时作为一条回复发送
+        """
+        return SentenceStreamWriter(
+            lambda text: self.send(Reply(ReplyType.TEXT, text), context),
+            conf().get("stream_min_chars", 50),
+            fallback_func=lambda text: self._send(Reply(ReplyType.TEXT, text), context),
+        )
+
+    @_stage_timer("stream")
+    def _stream_reply(self, context: Context, reply: StreamReply):
+        """
+        边生成边发送，返回发送完的reply，会话被取消时返回None，出错时返回错误提示
+        生成途中出错时已发送的部分不写入会话，结束已发送的消息后再发送错误提示，避免不完整的回复被当作完整回复
+        """
+        writer = self.create_stream_writer(context)
+        prefix, suffix = self._text_affixes(context)
+        first = True
+        try:
+            for delta in reply:
+                if self._is_cancelled(context):
+                    raise OperationCancelled()
+                if first:
+                    if "dispatch_time" in context:  # 用户等待第一段回复的时间
+                        self._observe_stage("first_token", context["dispatch_time"])
+                    delta = prefix + delta.lstrip()
+                    first = False
+                writer.write(delta)
+        except OperationCancelled:
+            logger.info("[chat_channel] session {} cancelled, stop streaming".format(context.get("session_id")))
+            writer.abort()
+            return None
+        except Exception as e:
+            logger.exception("[chat_channel] stream reply error: {}".format(e))
+            if first:
+                writer.abort()
+                return Reply(ReplyType.ERROR, "我现在有点累了，等会再来吧")
+            writer.close()
+            return Reply(ReplyType.ERROR, "回复中断了，请再问我一次")
+        finally:
+            reply.close()
+        if first:
+            return None
+        if suffix:
+            writer.write(suffix)
+        writer.close()
+        return reply
+
+    def _is_cancelled(self, context: Context):
+        cancel_token = context.get("cancel_token")
+        return cancel_token is not None and cancel_token.cancelled
+
     def _send_reply(self, context: Context, reply: Reply):
+        if self._is_cancelled(context):
+            return
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -283,6 +477,7 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
                 self._send(reply, context)
 
+    @_stage_timer("send")
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
             self.send(reply, context)
@@ -291,9 +486,27 @@ class ChatChannel(Channel):
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+            # 延时重试，等待期间不占用处理消息的线程
+            if not self.send_retry.retry(retry_cnt, self._send, reply, context, retry_cnt + 1):
+                self._dead_letter(reply, context, e)
+
+    # 重试多次仍发送失败的回复记录到数据目录下的dead_letter.log
+    def _dead_letter(self, reply: Reply, context: Context, exception):
+        logger.error("[chat_channel] send failed after retries, session_id={}, reply={}".format(context.get("session_id"), reply))
+        try:
+            record = {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "channel": self.channel_type,
+                "session_id": context.get("session_id"),
+                "receiver": context.get("receiver"),
+                "reply_type": str(reply.type),
+                "content": reply.content if isinstance(reply.content, str) else str(reply.content),
+                "error": str(exception),
+            }
+            with open(os.path.join(get_appdata_dir(), "dead_letter.log"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning("[chat_channel] write dead letter error: {}".format(e))
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -303,78 +516,153 @@ class ChatChannel(Channel):
 
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
+            reply = None
             try:
                 worker_exception = worker.exception()
                 if worker_exception:
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
                 else:
+                    reply = worker.result()
                     self._success_callback(session_id, **kwargs)
             except CancelledError as e:
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
+            context = kwargs.get("context")
+            if context is not None and "reply_seq" in context:
+                # 按序释放回复，没有回复的任务也要释放序号，避免阻塞后续回复
+                send_func = functools.partial(self._send_reply, context, reply) if reply else None
+                self.reorder_buffer.release(session_id, context["reply_seq"], send_func)
             with self.lock:
-                self.sessions[session_id][1].release()
-
-        return func
+                futures = self.futures.get(session_id, [])
+                if worker in futures:
+                    futures.remove(worker)
+                if not futures:
+                    self.futures.pop(session_id, None)
+                cancel_tokens = self.cancel_tokens.get(session_id)
+                if cancel_tokens and context is not None:
+                    cancel_tokens.discard(context.get("cancel_token"))
+                    if not cancel_tokens:
+                        del self.cancel_tokens[session_id]
+            self.scheduler.task_done(session_id)  # 唤醒消费者处理该会话的下一条消息
+
+        def callback(worker: Future):
+            if event_loop.in_loop_thread():
+                # 异步处理的任务在事件循环线程中完成，按序发送回复等同步步骤交给线程池，不阻塞事件循环
+                self.handler_pool.submit(func, worker)
+            else:
+                func(worker)
+
+        return callback
+
+    # 会话的调度权重，管理员、私聊、群聊以及指定群可以在session_weights和group_weights中配置不同的权重
+    def _session_weight(self, context: Context):
+        weights = conf().get("session_weights", {})
+        cmsg = context.get("msg")
+        if context.get("isgroup", False):
+            user_id = cmsg.actual_user_id if cmsg else None
+            weight = conf().get("group_weights", {}).get(cmsg.other_user_nickname if cmsg else None, weights.get("group", 1))
+        else:
+            user_id = cmsg.from_user_id if cmsg else None
+            weight = weights.get("single", 1)
+        if user_id and user_id in global_config["admin_users"]:
+            weight = max(weight, weights.get("admin", 1))
+        return weight
 
     def produce(self, context: Context):
+        self._cancel_on_reset(context)
+        if self.coalescer:
+            self.coalescer.put(context["session_id"], context)
+        else:
+            self._enqueue(context)
+
+    # 重置会话的命令在收到时立即中止该会话正在处理和排队的消息，不等命令本身被调度执行
+    def _cancel_on_reset(self, context: Context):
+        if context.type != ContextType.TEXT or not context.content.startswith("#"):
+            return
+        content = context.content.strip()
+        cmd = content[1:].strip().split()
+        cmd = cmd[0] if cmd else ""
+        # 与godcmd的reset和resetall指令保持一致，clear_memory_commands会加入reset的别名
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if content in clear_memory_commands or cmd in ["reset", "重置会话"]:
+            self.cancel_session(context["session_id"])
+        elif content == "#清除所有":
+            self.cancel_all_session()
+        elif cmd in ["resetall", "重置所有会话"]:
+            # 管理员指令，只在私聊中由管理员执行
+            if not context.get("isgroup", False) and context.get("receiver") in global_config["admin_users"]:
+                self.cancel_all_session()
+
+    def _enqueue(self, context: Context):
         session_id = context["session_id"]
-        with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(config.get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
-            else:
-                self.sessions[session_id][0].put(context)
+        context["enqueue_time"] = time.monotonic()
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            self.scheduler.put(session_id, context, priority=True)  # 管理命令进入优先通道，不受排队上限限制
+            return
+        if self.scheduler.is_full(session_id):
+            context = self.overload_policy.handle(self, context)
+            if context is None:
+                return
+        self.scheduler.put(session_id, context, weight=self._session_weight(context))
+
+    def _observe_stage(self, stage, start):
+        metrics.histogram("chat_channel.stage_ms", stage=stage, channel=self.channel_type).observe((time.monotonic() - start) * 1000)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，阻塞等待就绪的会话，取出消息并提交到线程池处理
     def consume(self):
         while True:
+            session_id, context, priority = self.scheduler.get()
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            self._observe_stage("queue_wait", context["enqueue_time"])
+            context["dispatch_time"] = time.monotonic()
+            if conf().get("reply_in_order", False) and conf().get("concurrency_in_session", 4) > 1:
+                context["reply_seq"] = self.reorder_buffer.acquire(session_id)
+            # 管理命令使用独立的线程池，处理消息的线程池满载时也能及时响应
+            pool = self.admin_pool if priority else self.handler_pool
             with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[chat_channel] consume context: {}".format(context))
-                            future: Future = handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
-
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+                if not priority:  # 管理命令本身不会被重置会话取消
+                    context["cancel_token"] = CancellationToken()
+                    self.cancel_tokens.setdefault(session_id, set()).add(context["cancel_token"])
+                if not priority and self._async_enabled(context):
+                    # 在共享的事件循环中处理，大量消息同时等待回复时不需要同样多的线程
+                    future: Future = event_loop.submit(self._ahandle(context))
+                else:
+                    future: Future = pool.submit(self._handle, context)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+
+    # 取消session_id对应的所有任务，排队的消息和未执行的任务直接取消，正在执行的任务通过cancel_token通知bot中止并丢弃回复
     def cancel_session(self, session_id):
         with self.lock:
-            if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            futures = list(self.futures.get(session_id, []))
+            for cancel_token in self.cancel_tokens.pop(session_id, set()):
+                cancel_token.cancel()
+        # 未开始执行的future被取消时会在当前线程中调用完成回调，回调需要获取self.lock，因此在锁外取消
+        for future in futures:
+            future.cancel()
+        cnt = self.scheduler.cancel(session_id)
+        if self.coalescer:
+            cnt += self.coalescer.cancel(session_id)
+        if cnt > 0:
+            logger.info("Cancel {} messages in session {}".format(cnt, session_id))
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            futures = [future for session_futures in self.futures.values() for future in session_futures]
+            for cancel_tokens in self.cancel_tokens.values():
+                for cancel_token in cancel_tokens:
+                    cancel_token.cancel()
+            self.cancel_tokens.clear()
+        for future in futures:
+            future.cancel()
+        if self.coalescer:
+            self.coalescer.cancel_all()
+        for session_id, cnt in self.scheduler.cancel_all().items():
+            if cnt > 0:
+                logger.info("Cancel {} messages in session {}".format(cnt, session_id))
 
 
 def check_prefix(content, prefix_list):
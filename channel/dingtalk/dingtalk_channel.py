@@ -19,8 +19,9 @@ from dingtalk_stream.card_replier import CardReplier
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
+from channel.stream_writer import UpdatingStreamWriter
 from channel.dingtalk.dingtalk_message import DingTalkMessage
-from common.expired_dict import ExpiredDict
+from common.kv_store import is_duplicate
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
@@ -65,10 +66,9 @@ AICardReplier.start = CustomAICardReplier.start
 def _check(func):
     def wrapper(self, cmsg: DingTalkMessage):
         msgId = cmsg.msg_id
-        if msgId in self.receivedMsgs:
+        if is_duplicate("dingtalk", msgId, conf().get("expires_in_seconds") or 3600):
             logger.info("DingTalk message {} already received, ignore".format(msgId))
             return
-        self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if conf().get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
             logger.debug("[DingTalk] History message {} skipped".format(msgId))
@@ -99,8 +99,6 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         super().__init__()
         super(dingtalk_stream.ChatbotHandler, self).__init__()
         self.logger = self.setup_logger()
-        # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds"))
         logger.info("[DingTalk] client_id={}, client_secret={} ".format(
             self.dingtalk_client_id, self.dingtalk_client_secret))
         # 无需群校验和前缀
@@ -200,6 +198,33 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             self.reply_text(reply.content, incoming_message)
 
 
+    def create_stream_writer(self, context: Context):
+        # 配置了AI卡片模板时，创建卡片后流式更新卡片内容，否则按句子分段发送
+        card_template_id = conf().get("dingtalk_stream_card_template_id")
+        if not card_template_id:
+            return super().create_stream_writer(context)
+        content_key = conf().get("dingtalk_stream_card_content_key", "content")
+        replier = AICardReplier(self.dingtalk_client, context.kwargs['msg'].incoming_message)
+
+        def create(text):
+            card_instance_id = replier.start(card_template_id, {})
+            if card_instance_id:
+                replier.streaming(card_instance_id, content_key, text, append=False, finished=False, failed=False)
+            return card_instance_id
+
+        def update(card_instance_id, text, finished):
+            replier.streaming(card_instance_id, content_key, text, append=False, finished=finished, failed=False)
+            if finished:
+                replier.finish(card_instance_id, {content_key: text})
+
+        return UpdatingStreamWriter(
+            create,
+            update,
+            interval=conf().get("stream_update_interval", 1),
+            max_updates=conf().get("stream_max_updates", 100),
+            always_finish=True,
+        )
+
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
         promptEn = context.kwargs.get("promptEn")
@@ -1,11 +1,11 @@
 import os
 
-import requests
 from dingtalk_stream import ChatbotMessage
 
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
 # -*- coding=utf-8 -*-
+from common import http_client
 from common.log import logger
 from common.tmp_dir import TmpDir
 
@@ -63,7 +63,7 @@ def download_image_file(image_url, temp_dir):
     # 设置代理
     # self.proxies
     # , proxies=self.proxies
-    response = requests.get(image_url, headers=headers, stream=True, timeout=60 * 5)
+    response = http_client.get(image_url, headers=headers, stream=True, timeout=60 * 5)
     if response.status_code == 200:
 
         # 生成文件名
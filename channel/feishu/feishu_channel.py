@@ -8,7 +8,7 @@
 # -*- coding=utf-8 -*-
 import uuid
 
-import requests
+from common import http_client
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
@@ -16,10 +16,11 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.singleton import singleton
 from config import conf
-from common.expired_dict import ExpiredDict
+from common.kv_store import is_duplicate
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
-from common import utils
+from channel.stream_writer import UpdatingStreamWriter
+from common import token_manager, utils
 import json
 import os
 
@@ -34,8 +35,6 @@ class FeiShuChanel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        # 历史消息id暂存，用于幂等控制
-        self.receivedMsgs = ExpiredDict(60 * 60 * 7.1)
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
@@ -51,16 +50,8 @@ class FeiShuChanel(ChatChannel):
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def send(self, reply: Reply, context: Context):
-        msg = context.get("msg")
-        is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
-        headers = {
-            "Authorization": "Bearer " + access_token,
-            "Content-Type": "application/json",
-        }
+        access_token = self._access_token(context)
+        headers = self._headers(access_token)
         msg_type = "text"
         logger.info(f"[FeiShu] start send reply message, type={context.type}, content={reply.content}")
         reply_content = reply.content
@@ -73,31 +64,78 @@ class FeiShuChanel(ChatChannel):
                 return
             msg_type = "image"
             content_key = "image_key"
-        if is_group:
+        self._send_message(context, headers, msg_type, json.dumps({content_key: reply_content}))
+
+    def _access_token(self, context: Context):
+        # 消息中保存的token在排队较久时可能已经过期，统一使用缓存中最新的token
+        return self.fetch_access_token()
+
+    def _headers(self, access_token):
+        return {
+            "Authorization": "Bearer " + access_token,
+            "Content-Type": "application/json",
+        }
+
+    def _send_message(self, context: Context, headers, msg_type, content):
+        """
+        发送消息，成功时返回消息id
+        """
+        if context["isgroup"]:
             # 群聊中直接回复
-            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
+            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{context.get('msg').msg_id}/reply"
             data = {
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": content
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
             data = {
                 "receive_id": context.get("receiver"),
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": content
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
+            return res.get("data", {}).get("message_id")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
 
+    def create_stream_writer(self, context: Context):
+        # 先发送一条文本消息，再随着生成编辑这条消息，飞书限制每条消息最多编辑20次
+        headers = self._headers(self._access_token(context))
+
+        def create(text):
+            return self._send_message(context, headers, "text", json.dumps({"text": text}))
+
+        def update(message_id, text, finished):
+            url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+            data = {"msg_type": "text", "content": json.dumps({"text": text})}
+            res = http_client.request("PUT", url, headers=headers, json=data, timeout=(5, 10)).json()
+            if res.get("code") != 0:
+                logger.error(f"[FeiShu] update message failed, code={res.get('code')}, msg={res.get('msg')}")
+
+        return UpdatingStreamWriter(
+            create,
+            update,
+            interval=conf().get("stream_update_interval", 1),
+            max_updates=min(conf().get("stream_max_updates", 100), 19),  # 留一次给最后的完整内容
+        )
 
     def fetch_access_token(self) -> str:
+        """
+        获取tenant_access_token，缓存到过期前，每条消息和每次发送都调用也不会重复请求
+        """
+        try:
+            return token_manager.get("feishu", self._fetch_tenant_access_token, key=self.feishu_app_id)
+        except Exception as e:
+            logger.error(f"[FeiShu] fetch token error, {e}")
+            return ""
+
+    def _fetch_tenant_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,21 +145,18 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
-        if response.status_code == 200:
-            res = response.json()
-            if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+        response = http_client.post(url=url, data=data, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"res={response}")
+        res = response.json()
+        if res.get("code") != 0:
+            raise Exception(f"get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
+        return res.get("tenant_access_token"), res.get("expire")
 
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -138,7 +173,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
@@ -181,10 +216,9 @@ class FeishuController:
                 msg = event.get("message")
 
                 # 幂等判断
-                if channel.receivedMsgs.get(msg.get("message_id")):
+                if is_duplicate("feishu", msg.get("message_id"), 60 * 60 * 7.1):
                     logger.warning(f"[FeiShu] repeat msg filtered, event_id={header.get('event_id')}")
                     return self.SUCCESS_MSG
-                channel.receivedMsgs[msg.get("message_id")] = True
 
                 is_group = False
                 chat_type = msg.get("chat_type")
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from common import metrics
+from common.delay_queue import DelayQueue
+from common.log import logger
+
+
+class PendingMessages:
+    def __init__(self, context: Context):
+        self.contexts = [context]
+        self.sender = _sender(context)
+        self.first_time = time.monotonic()
+        self.timer = None
+
+
+def _sender(context: Context):
+    cmsg = context.get("msg")
+    if cmsg is None:
+        return None
+    return cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
+
+
+# 合并同一用户短时间内连续发送的多条文本消息，窗口内没有新消息、等待超过max_wait或合并条数达到max_size时，
+# 将这些消息合并成一条context交给flush处理
+class MessageCoalescer:
+    def __init__(self, flush, window=2, max_wait=6, max_size=5, delay_queue: DelayQueue = None):
+        self.flush = flush  # 处理合并后context的函数
+        self.window = window
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.pending = {}  # session_id -> PendingMessages
+        self.lock = threading.Lock()
+        # 同一会话的取出和处理在同一把锁中完成，定时器和put同时触发时也按取出的顺序处理
+        # 按session_id分段加锁，不同会话之间基本不会互相等待
+        self.flush_locks = [threading.Lock() for _ in range(64)]
+        self.delay_queue = delay_queue or DelayQueue("coalescer")
+        self.merged_cnt = metrics.counter("chat_channel.coalesced")  # 被合并掉的消息数
+
+    def put(self, session_id, context: Context):
+        """
+        放入消息，不参与合并的消息会先把该会话中等待合并的消息处理掉，再直接处理，保证顺序
+        """
+        with self._flush_lock(session_id):
+            flushes = []
+            with self.lock:
+                pending = self.pending.get(session_id)
+                if context.type != ContextType.TEXT or context.content.startswith("#"):
+                    if pending:
+                        flushes.append(self._pop(session_id))
+                    flushes.append(context)
+                elif pending and pending.sender == _sender(context):
+                    pending.contexts.append(context)
+                    if len(pending.contexts) >= self.max_size:
+                        flushes.append(self._pop(session_id))
+                    else:
+                        self._schedule(session_id, pending)
+                else:
+                    if pending:
+                        flushes.append(self._pop(session_id))
+                    pending = self.pending[session_id] = PendingMessages(context)
+                    self._schedule(session_id, pending)
+            for item in flushes:
+                self.flush(item)
+
+    def _flush_lock(self, session_id):
+        return self.flush_locks[hash(session_id) % len(self.flush_locks)]
+
+    def _schedule(self, session_id, pending: PendingMessages):
+        if pending.timer:
+            pending.timer.cancel()
+        delay = min(self.window, pending.first_time + self.max_wait - time.monotonic())
+        pending.timer = self.delay_queue.call_later(max(delay, 0), self._on_timer, session_id, pending)
+
+    def _on_timer(self, session_id, pending: PendingMessages):
+        with self._flush_lock(session_id):
+            with self.lock:
+                if self.pending.get(session_id) is not pending:
+                    return
+                context = self._pop(session_id)
+            self.flush(context)
+
+    def _pop(self, session_id) -> Context:
+        pending = self.pending.pop(session_id)
+        if pending.timer:
+            pending.timer.cancel()
+        context = pending.contexts[0]
+        if len(pending.contexts) > 1:
+            context.content = "\n".join(c.content for c in pending.contexts)
+            self.merged_cnt.inc(len(pending.contexts) - 1)
+            logger.debug("[coalescer] merge {} messages in session {}".format(len(pending.contexts), session_id))
+        return context
+
+    def cancel(self, session_id):
+        with self.lock:
+            pending = self.pending.pop(session_id, None)
+        if pending and pending.timer:
+            pending.timer.cancel()
+        return len(pending.contexts) if pending else 0
+
+    def cancel_all(self):
+        with self.lock:
+            pendings, self.pending = self.pending, {}
+        for pending in pendings.values():
+            if pending.timer:
+                pending.timer.cancel()
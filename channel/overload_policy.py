@@ -0,0 +1,89 @@
+"""
+Overload policies, decide what to do with a context when the message queue is full
+"""
+
+from bridge.bridge import Bridge
+from bridge.context import Context
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.log import logger
+from config import conf
+
+
+class OverloadPolicy(object):
+    name = ""
+
+    def handle(self, channel, context: Context):
+        """
+        handle a context that exceeds the queue limit
+        :param channel: the ChatChannel which received the context
+        :param context: the overflowing context
+        :return: the context to enqueue, or None to shed it
+        """
+        raise NotImplementedError
+
+    def shed(self, context: Context):
+        metrics.counter("chat_channel.shed", policy=self.name).inc()
+        logger.warning("[overload] shed message by {}, session_id={}, content={}".format(self.name, context.get("session_id"), context.content))
+
+
+# 丢弃最早的排队消息，接收新消息
+class DropOldestPolicy(OverloadPolicy):
+    name = "drop_oldest"
+
+    def handle(self, channel, context: Context):
+        dropped = channel.scheduler.drop_oldest(context["session_id"])
+        if not dropped:
+            # 队列中只有优先通道的消息，没有可以丢弃的，丢弃新消息以保证不超出上限
+            self.shed(context)
+            return None
+        self.shed(dropped[1])
+        return context
+
+
+# 拒绝新消息，并回复提示
+class RejectPolicy(OverloadPolicy):
+    name = "reject"
+
+    def handle(self, channel, context: Context):
+        self.shed(context)
+        reply = Reply(ReplyType.INFO, conf().get("overload_reply", "当前消息太多，请稍后再试"))
+        channel.handler_pool.submit(lambda: channel._send_reply(context, channel._decorate_reply(context, reply)))
+        return None
+
+
+# 使用更快更便宜的模型处理新消息，排队数超过上限的两倍后拒绝
+# 只对支持按消息指定模型的bot(ChatGPT、智谱等读取context["gpt_model"]的bot)生效，其它bot直接拒绝
+class DegradePolicy(RejectPolicy):
+    name = "degrade"
+
+    def handle(self, channel, context: Context):
+        model = conf().get("overload_degrade_model")
+        scheduler = channel.scheduler
+        if model and not Bridge().supports_model_override():
+            logger.warning("[overload] chat bot does not support overload_degrade_model, reject instead")
+            model = None
+        if model and _under(scheduler.qsize(), scheduler.max_queue) and _under(scheduler.qsize(context["session_id"]), scheduler.max_session_queue):
+            metrics.counter("chat_channel.degraded", model=model).inc()
+            context["gpt_model"] = model
+            return context
+        return super().handle(channel, context)
+
+
+def _under(size, limit):
+    return limit <= 0 or size < limit * 2
+
+
+def create_overload_policy(policy_name) -> OverloadPolicy:
+    """
+    create an overload policy instance
+    :param policy_name: drop_oldest, reject or degrade
+    :return: policy instance
+    """
+    if policy_name == DropOldestPolicy.name:
+        return DropOldestPolicy()
+    elif policy_name == RejectPolicy.name:
+        return RejectPolicy()
+    elif policy_name == DegradePolicy.name:
+        return DegradePolicy()
+    raise RuntimeError("unknown overload policy: {}".format(policy_name))
@@ -0,0 +1,130 @@
+"""
+流式回复的发送方式
+    SentenceStreamWriter: 不能更新已发送消息的channel，按句子分段发送
+    UpdatingStreamWriter: 能更新已发送消息的channel，先发送一条消息，再随着生成不断更新这条消息
+channel重写ChatChannel.create_stream_writer选择使用哪一种
+"""
+
+import re
+import time
+
+from common.log import logger
+
+_sentence_end = re.compile(r"[。！？!?\n]")
+
+
+class StreamWriter(object):
+    def write(self, delta):
+        """
+        收到一段增量文本
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        回复生成结束，发送剩余的内容
+        """
+        pass
+
+    def abort(self):
+        """
+        会话被取消，丢弃未发送的内容
+        """
+        pass
+
+
+class SentenceStreamWriter(StreamWriter):
+    def __init__(self, send_func, min_chars=50, fallback_func=None):
+        """
+        :param send_func: 发送一段文本，失败时抛出异常
+        :param min_chars: 每段至少的字数，避免短句拆成过多的消息
+        :param fallback_func: 某一段发送失败后不再分段发送，生成结束时用它把剩余内容作为一条消息发送(可以延时重试)，
+                              后面的分段不会先于失败的分段到达，默认使用send_func
+        """
+        self.send_func = send_func
+        self.min_chars = min_chars
+        self.fallback_func = fallback_func or send_func
+        self.buffer = ""
+        self.failed = False
+
+    def write(self, delta):
+        self.buffer += delta
+        if len(self.buffer) < self.min_chars:
+            return
+        # 在最后一个句子结尾处截断，后面未完成的句子留到下一段
+        end = None
+        for end in _sentence_end.finditer(self.buffer, self.min_chars - 1):
+            pass
+        if end is not None:
+            self._flush(end.end())
+
+    def _flush(self, pos):
+        if self.failed:
+            return
+        text = self.buffer[:pos].strip()
+        if text:
+            try:
+                self.send_func(text)
+            except Exception as e:
+                logger.warning("[stream_writer] send failed, send the rest as one message when finished: {}".format(e))
+                self.failed = True
+                return
+        self.buffer = self.buffer[pos:]
+
+    def close(self):
+        self._flush(len(self.buffer))
+        text = self.buffer.strip()
+        if self.failed and text:
+            self.buffer = ""
+            self.fallback_func(text)
+
+    def abort(self):
+        self.buffer = ""
+
+
+class UpdatingStreamWriter(StreamWriter):
+    def __init__(self, create_func, update_func, interval=1, max_updates=100, always_finish=False):
+        """
+        :param create_func: create_func(text)发送消息，返回用于更新的消息标识，失败时返回None
+        :param update_func: update_func(handle, text, finished)把消息更新为完整的text
+        :param interval: 更新的最小间隔秒数，大部分平台限制了更新消息的频率
+        :param max_updates: 最多更新的次数，超过后等生成结束再更新
+        :param always_finish: 结束时内容没有变化也更新一次，用于需要标记生成结束的消息(如钉钉AI卡片)
+        """
+        self.create_func = create_func
+        self.update_func = update_func
+        self.interval = interval
+        self.max_updates = max_updates
+        self.always_finish = always_finish
+        self.text = ""
+        self.sent_text = ""
+        self.handle = None
+        self.updates = 0
+        self.last_update = 0
+
+    def write(self, delta):
+        self.text += delta
+        if self.handle is None:
+            # 第一段内容立即发送，用户最早看到回复
+            if not self.sent_text:
+                self.sent_text = self.text
+                self.handle = self.create_func(self.text)
+                self.last_update = time.monotonic()
+            return
+        if self.updates < self.max_updates and time.monotonic() - self.last_update >= self.interval:
+            self._update(False)
+
+    def _update(self, finished):
+        self.sent_text = self.text
+        self.updates += 1
+        self.last_update = time.monotonic()
+        self.update_func(self.handle, self.text, finished)
+
+    def close(self):
+        if self.handle is None:
+            if self.text:
+                # 创建消息失败，最后再完整发送一次
+                logger.warning("[stream_writer] create message failed, send whole reply")
+                self.create_func(self.text)
+        elif self.text != self.sent_text or self.always_finish:
+            self._update(True)
@@ -4,6 +4,7 @@ from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from channel.stream_writer import StreamWriter
 from common.log import logger
 from config import conf
 
@@ -26,9 +27,36 @@ class TerminalMessage(ChatMessage):
         self.other_user_id = other_user_id
 
 
+class TerminalStreamWriter(StreamWriter):
+    """
+    流式回复直接逐段打印
+    """
+
+    def __init__(self):
+        self.started = False
+
+    def write(self, delta):
+        if not self.started:
+            print("\nBot:")
+            self.started = True
+        print(delta, end="")
+        sys.stdout.flush()
+
+    def close(self):
+        if self.started:
+            print("\n\nUser:", end="")
+            sys.stdout.flush()
+
+    def abort(self):
+        self.close()
+
+
 class TerminalChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
 
+    def create_stream_writer(self, context: Context):
+        return TerminalStreamWriter()
+
     def send(self, reply: Reply, context: Context):
         print("\nBot:")
         if reply.type == ReplyType.IMAGE:
@@ -42,11 +70,11 @@ class TerminalChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             import io
 
-            import requests
+            from common import http_client
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
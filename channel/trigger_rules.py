@@ -0,0 +1,92 @@
+"""
+Trigger rules used by ChatChannel._compose_context, compiled once per config load
+"""
+
+import functools
+import re
+
+from common.string_matcher import KeywordMatcher, PrefixMatcher
+from config import conf
+
+
+class TriggerRules:
+    def __init__(self, config):
+        self.config = config
+        group_name_white_list = config.get("group_name_white_list", [])
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_name_white_list = set(group_name_white_list)
+        self.group_name_keyword_white_list = KeywordMatcher(config.get("group_name_keyword_white_list", []))
+        group_chat_in_one_session = config.get("group_chat_in_one_session", [])
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.group_chat_in_one_session = set(group_chat_in_one_session)
+        self.nick_name_black_list = set(config.get("nick_name_black_list", []))
+        self.group_chat_prefix = PrefixMatcher(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordMatcher(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixMatcher(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixMatcher(config.get("image_create_prefix", [""]))
+
+    def is_group_enabled(self, group_name):
+        return self.all_group or group_name in self.group_name_white_list or self.group_name_keyword_white_list.match(group_name) is not None
+
+    def is_group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+
+_rules = None
+
+
+def get_rules() -> TriggerRules:
+    """
+    获取当前配置对应的规则，重新加载配置(#更新配置、#reconf)会生成新的配置对象，此时重新编译规则并整体替换
+    """
+    global _rules
+    rules = _rules
+    config = conf()
+    if rules is None or rules.config is not config:
+        rules = _rules = TriggerRules(config)
+    return rules
+
+
+@functools.lru_cache(maxsize=4096)
+def mention_pattern(name):
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+if __name__ == "__main__":
+    # _compose_context 吞吐测试: python -m channel.trigger_rules
+    import random
+    import time
+
+    from bridge.context import ContextType
+    from channel.chat_channel import ChatChannel
+    from channel.chat_message import ChatMessage
+
+    config = conf()
+    config["group_name_white_list"] = ["group_{}".format(i) for i in range(2000)]
+    config["group_chat_in_one_session"] = ["group_{}".format(i) for i in range(0, 2000, 2)]
+    config["nick_name_black_list"] = ["black_{}".format(i) for i in range(2000)]
+    config["group_chat_prefix"] = ["@bot"] + ["prefix_{}".format(i) for i in range(200)]
+    config["group_chat_keyword"] = ["keyword_{}".format(i) for i in range(1000)]
+
+    class BenchChannel(ChatChannel):
+        name = "bot"
+        user_id = "bot_id"
+
+    channel = BenchChannel()
+    messages = []
+    for i in range(10000):
+        msg = ChatMessage(None)
+        msg.from_user_id = msg.other_user_id = "group_id_{}".format(i % 2500)
+        msg.other_user_nickname = "group_{}".format(i % 2500)
+        msg.actual_user_id = "user_{}".format(i)
+        msg.actual_user_nickname = "user_{}".format(i)
+        msg.to_user_id = "bot_id"
+        msg.is_at = i % 3 == 0
+        msg.at_list = ["user_{}".format(random.randrange(100)) for _ in range(3)]
+        content = "@bot @user_1 hello world, this is message {} with keyword_{}".format(i, random.randrange(2000))
+        messages.append((content, msg))
+    start = time.perf_counter()
+    for content, msg in messages:
+        channel._compose_context(ContextType.TEXT, content, isgroup=True, msg=msg)
+    cost = time.perf_counter() - start
+    print("messages={}, throughput={:.0f} msg/s".format(len(messages), len(messages) / cost))
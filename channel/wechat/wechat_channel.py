@@ -10,14 +10,12 @@ import os
 import threading
 import time
 
-import requests
-
 from bridge.context import *
 from bridge.reply import *
-from channel import chat_channel
 from channel.chat_channel import ChatChannel
 from channel.wechat.wechat_message import *
-from common.expired_dict import ExpiredDict
+from common import http_client
+from common.kv_store import is_duplicate
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
@@ -54,10 +52,9 @@ def handler_group_msg(msg):
 def _check(func):
     def wrapper(self, cmsg: ChatMessage):
         msgId = cmsg.msg_id
-        if msgId in self.receivedMsgs:
+        if is_duplicate("wx", msgId, config.get("expires_in_seconds") or 3600):
             logger.info("Wechat message {} already received, ignore".format(msgId))
             return
-        self.receivedMsgs[msgId] = True
         create_time = cmsg.create_time  # 消息时间戳
         if config.get("hot_reload") == True and int(create_time) < int(time.time()) - 60:  # 跳过1分钟前的历史消息
             logger.debug("[WX]history message {} skipped".format(msgId))
@@ -112,7 +109,6 @@ class WechatChannel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        self.receivedMsgs = ExpiredDict(config.get("expires_in_seconds"))
         self.auto_login_times = 0
 
     def startup(self):
@@ -145,7 +141,7 @@ class WechatChannel(ChatChannel):
                 time.sleep(2)
                 self.auto_login_times += 1
                 if self.auto_login_times < 100:
-                    chat_channel.handler_pool._shutdown = False
+                    self.handler_pool._shutdown = False
                     self.startup()
         except Exception as e:
             pass
@@ -224,7 +220,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = http_client.get(img_url, stream=True)
             image_storage = io.BytesIO()
             size = 0
             for block in pic_res.iter_content(1024):
@@ -250,7 +246,7 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
+            video_res = http_client.get(video_url, stream=True)
             video_storage = io.BytesIO()
             size = 0
             for block in video_res.iter_content(1024):
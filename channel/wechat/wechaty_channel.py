@@ -42,14 +42,17 @@ class WechatyChannel(ChatChannel):
         asyncio.run(self.main())
 
     async def main(self):
-        loop = asyncio.get_event_loop()
-        # 将asyncio的loop传入处理线程
-        self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        # 处理线程在收到第一条消息时才启动，启动时通过_init_handler_thread设置这个loop
+        self.loop = asyncio.get_event_loop()
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
         await self.bot.start()
 
+    def _init_handler_thread(self):
+        # 将asyncio的loop传入处理线程
+        asyncio.set_event_loop(self.loop)
+
     async def on_login(self, contact: Contact):
         self.user_id = contact.contact_id
         self.name = contact.name
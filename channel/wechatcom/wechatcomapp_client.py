@@ -1,21 +1,16 @@
-import threading
-import time
-
 from wechatpy.enterprise import WeChatClient
 
+from common import token_manager
+
 
 class WechatComAppClient(WeChatClient):
-    def __init__(self, corp_id, secret, access_token=None, session=None, timeout=None, auto_retry=True):
-        super(WechatComAppClient, self).__init__(corp_id, secret, access_token, session, timeout, auto_retry)
-        self.fetch_access_token_lock = threading.Lock()
+    @property
+    def access_token(self):  # 重载父类属性，由token_manager缓存和刷新，多线程同时请求时只获取一次
+        return token_manager.get("wechatcom", self._fetch_token, key=(self.corp_id, self.secret))
+
+    def fetch_access_token(self):  # 重载父类方法，wechatpy在上游返回token失效时调用，并发调用只刷新一次
+        token_manager.refresh("wechatcom", self._fetch_token, key=(self.corp_id, self.secret))
 
-    def fetch_access_token(self):  # 重载父类方法，加锁避免多线程重复获取access_token
-        with self.fetch_access_token_lock:
-            access_token = self.session.get(self.access_token_key)
-            if access_token:
-                if not self.expires_at:
-                    return access_token
-                timestamp = time.time()
-                if self.expires_at - timestamp > 60:
-                    return access_token
-            return super().fetch_access_token()
+    def _fetch_token(self):
+        result = super().fetch_access_token()
+        return result["access_token"], result.get("expires_in", 7200)
@@ -0,0 +1,101 @@
+"""
+异步HTTP客户端，在事件循环中等待上游响应，不占用线程，一个进程可以同时进行上千个请求
+    from common import async_http_client
+    res = await async_http_client.post(url, json=body, headers=headers, timeout=(5, 60))
+返回的Response与requests.Response的常用属性相同(status_code、headers、content、text、json())，
+同步和异步请求可以共用解析响应的代码
+需要安装aiohttp
+"""
+
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+from common import metrics
+from config import conf
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_session = None  # 只在事件循环线程中访问，不需要加锁
+_session_loop = None
+
+
+class Response(object):
+    def __init__(self, status_code, headers, content: bytes, encoding=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or "utf-8"
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def available():
+    return aiohttp is not None
+
+
+def get_session() -> "aiohttp.ClientSession":
+    """
+    共享的aiohttp.ClientSession，连接池属于创建它的事件循环，通常只有common.event_loop中的一个循环
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for async requests, please run: pip install aiohttp")
+        connector = aiohttp.TCPConnector(limit=conf().get("async_http_max_connections", 1000), limit_per_host=0)
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+def _timeout(timeout):
+    # 与requests相同，timeout可以是总秒数，或者(连接超时, 读取超时)
+    if isinstance(timeout, (tuple, list)):
+        return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def request(method, url, proxy=None, timeout=None, **kwargs) -> Response:
+    """
+    :param proxy: 代理地址
+    :param timeout: 超时秒数，默认使用http_timeout
+    :param kwargs: 与aiohttp.ClientSession.request相同，常用的有headers、params、json、data
+    """
+    if timeout is None:
+        timeout = conf().get("http_timeout", 180)
+    start = time.monotonic()
+    try:
+        async with get_session().request(method, url, proxy=proxy or None, timeout=_timeout(timeout), **kwargs) as res:
+            content = await res.read()
+            return Response(res.status, res.headers, content, res.charset)
+    finally:
+        metrics.histogram("http_client.request_ms", host=urlsplit(url).hostname).observe((time.monotonic() - start) * 1000)
+
+
+async def get(url, **kwargs) -> Response:
+    return await request("GET", url, **kwargs)
+
+
+async def post(url, **kwargs) -> Response:
+    return await request("POST", url, **kwargs)
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
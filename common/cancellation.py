@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+# 取消令牌，随Context传递，重置会话时由channel取消，bot在重试之间检查并中止正在进行的请求
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def register(self, callback):
+        """
+        注册取消时执行的回调，已取消时立即执行
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def wait(self, timeout):
+        """
+        等待timeout秒，期间被取消则立即返回True
+        """
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise OperationCancelled()
+
+
+def cancellable_sleep(token: CancellationToken, seconds):
+    """
+    可被取消的sleep，被取消时返回True
+    """
+    if token is None:
+        time.sleep(seconds)
+        return False
+    return token.wait(seconds)
+
+
+async def acancellable_sleep(token: CancellationToken, seconds):
+    """
+    协程版本的cancellable_sleep，等待期间不占用线程，被取消时返回True
+    """
+    if token is None:
+        await asyncio.sleep(seconds)
+        return False
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def callback():
+        loop.call_soon_threadsafe(event.set)
+
+    token.register(callback)
+    try:
+        await asyncio.wait_for(event.wait(), seconds)
+        return True
+    except asyncio.TimeoutError:
+        return token.cancelled
+    finally:
+        token.unregister(callback)
@@ -0,0 +1,55 @@
+import heapq
+import itertools
+import threading
+import time
+
+from common.log import logger
+
+
+class DelayedCall:
+    def __init__(self, deadline, func, args, kwargs):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# 延时任务队列，所有任务由一个后台线程按到期时间依次执行，任务中不要执行耗时操作
+class DelayQueue:
+    def __init__(self, name="delay_queue"):
+        self.name = name
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, func, *args, **kwargs) -> DelayedCall:
+        call = DelayedCall(time.monotonic() + delay, func, args, kwargs)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (call.deadline, next(self.counter), call))
+            if self.heap[0][2] is call:  # 新任务最先到期，唤醒后台线程重新计算等待时间
+                self.cond.notify()
+        return call
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, call = heapq.heappop(self.heap)
+            if call.cancelled:
+                continue
+            try:
+                call.func(*call.args, **call.kwargs)
+            except Exception as e:
+                logger.exception("[{}] delayed call error: {}".format(self.name, e))
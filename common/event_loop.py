@@ -0,0 +1,53 @@
+"""
+进程内共享的后台事件循环，在独立线程中运行，其它线程提交协程后得到concurrent.futures.Future
+    from common import event_loop
+    future = event_loop.submit(bot.areply(query, context))
+    reply = event_loop.run(bot.areply(query, context))  # 同步代码(如插件)中等待协程的结果
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+_lock = threading.Lock()
+_loop = None
+_thread = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _thread
+    if _loop is not None:
+        return _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_run, args=(loop,), name="event-loop", daemon=True)
+            _thread.start()
+            _loop = loop
+    return _loop
+
+
+def _run(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def in_loop_thread():
+    return _thread is not None and threading.current_thread() is _thread
+
+
+def submit(coro) -> Future:
+    """
+    在事件循环中执行协程，返回的future被取消时协程也会被取消
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run(coro, timeout=None):
+    """
+    阻塞等待协程执行完成，不能在事件循环线程中调用
+    """
+    if in_loop_thread():
+        coro.close()
+        raise RuntimeError("event_loop.run() cannot be called from the event loop thread")
+    return submit(coro).result(timeout)
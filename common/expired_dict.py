@@ -1,28 +1,75 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
-        self.expires_in_seconds = expires_in_seconds
+# 带过期时间的字典，过期的key在读写时按过期顺序批量清理，每个key只清理一次，均摊O(1)
+# sliding=True时每次读取都会刷新过期时间，否则从写入时开始计算
+# max_size>0时超出数量会淘汰最久未访问的key
+class ExpiredDict(MutableMapping):
+    def __init__(self, expires_in_seconds, max_size=0, sliding=True, on_evict=None):
+        self.expires_in_seconds = expires_in_seconds  # 为空时不过期
+        self.max_size = max_size
+        self.sliding = sliding
+        self.on_evict = on_evict  # key因过期或超出数量被清理时的回调 on_evict(key, value)
+        self.data = OrderedDict()  # key -> [value, 过期时间]，按最近访问排序，sliding时也就是按过期时间排序
+        self.expiry_queue = deque()  # 非sliding时按写入顺序记录(过期时间, key)，ttl固定，因此也是按过期时间排序
+        self.lock = threading.RLock()
+
+    def _expiry_time(self, now):
+        return now + self.expires_in_seconds if self.expires_in_seconds else None
+
+    def _sweep(self, now):
+        if not self.expires_in_seconds:
+            return
+        if self.sliding:
+            while self.data:
+                key, item = next(iter(self.data.items()))
+                if item[1] > now:
+                    break
+                del self.data[key]
+                self._evicted(key, item[0])
+        else:
+            while self.expiry_queue and self.expiry_queue[0][0] <= now:
+                expiry_time, key = self.expiry_queue.popleft()
+                item = self.data.get(key)
+                if item is not None and item[1] == expiry_time:  # key被重新写入过时以最新的过期时间为准
+                    del self.data[key]
+                    self._evicted(key, item[0])
+
+    def _evicted(self, key, value):
+        if self.on_evict:
+            self.on_evict(key, value)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        now = time.monotonic()
+        with self.lock:
+            item = self.data[key]
+            if item[1] is not None and item[1] <= now:
+                self._sweep(now)
+                raise KeyError("expired {}".format(key))
+            if self.sliding:
+                item[1] = self._expiry_time(now)
+            self.data.move_to_end(key)
+            return item[0]
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        now = time.monotonic()
+        with self.lock:
+            self._sweep(now)
+            expiry_time = self._expiry_time(now)
+            self.data[key] = [value, expiry_time]
+            self.data.move_to_end(key)
+            if not self.sliding and expiry_time is not None:
+                self.expiry_queue.append((expiry_time, key))
+            if self.max_size and len(self.data) > self.max_size:
+                key, item = self.data.popitem(last=False)
+                self._evicted(key, item[0])
 
-    def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
-            return default
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
 
     def __contains__(self, key):
         try:
@@ -31,12 +78,76 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def __len__(self):
+        with self.lock:
+            self._sweep(time.monotonic())
+            return len(self.data)
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self.lock:
+            self._sweep(time.monotonic())
+            return list(self.data.keys())
+
+    def values(self):
+        with self.lock:
+            self._sweep(time.monotonic())
+            return [item[0] for item in self.data.values()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self.lock:
+            self._sweep(time.monotonic())
+            return [(key, item[0]) for key, item in self.data.items()]
 
     def __iter__(self):
-        return self.keys().__iter__()
+        return iter(self.keys())
+
+    def popitem(self, last=False):
+        """
+        弹出最久未访问(last=True时为最近访问)的key
+        """
+        with self.lock:
+            self._sweep(time.monotonic())
+            key, item = self.data.popitem(last=last)
+            return key, item[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.expiry_queue.clear()
+
+    def __repr__(self):
+        return "ExpiredDict({})".format(dict(self.items()))
+
+
+if __name__ == "__main__":
+    # 吞吐和内存测试: python -m common.expired_dict
+    import tracemalloc
+
+    n = 100000
+    for sliding in [True, False]:
+        tracemalloc.start()
+        d = ExpiredDict(3600, max_size=n // 2, sliding=sliding)
+        start = time.perf_counter()
+        for i in range(n):
+            d[i] = i
+        set_cost = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(n):
+            d.get(i)
+        get_cost = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(
+            "sliding={}, size={}, set={:.0f} ops/s, get={:.0f} ops/s, memory={:.1f} bytes/key".format(
+                sliding, len(d), n / set_cost, n / get_cost, memory / len(d)
+            )
+        )
+
+    # 大量过期key的清理
+    d = ExpiredDict(0.5)
+    for i in range(n):
+        d[i] = i
+    time.sleep(0.6)
+    start = time.perf_counter()
+    d["new"] = 1
+    print("sweep {} expired keys: {:.1f}ms, size={}".format(n, (time.perf_counter() - start) * 1000, len(d)))
@@ -0,0 +1,176 @@
+"""
+共享的HTTP客户端，按上游host复用keep-alive连接，避免每次请求都重新建立TCP和TLS连接
+    from common import http_client
+    res = http_client.post(url, json=body, timeout=(5, 60))
+用法与requests.get/post相同，另外支持:
+    proxy: 使用代理，不同代理的连接池相互独立
+    cancel_token: CancellationToken被取消时中断正在进行的请求(stream=True时只中断到收到响应头为止)
+流式接口使用stream=True，再用iter_sse逐条读取
+"""
+
+import http.cookiejar
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import metrics
+from common.cancellation import CancellationToken
+from config import conf
+
+_lock = threading.Lock()
+_sessions = {}  # proxy -> requests.Session
+_local = threading.local()  # 当前线程正在进行的请求的cancel_token
+_connection_classes = {}
+
+
+def _cancellable_connection_class(base):
+    # 连接池中的连接在发送请求时注册到当前请求的cancel_token上，请求结束后注销，连接可以继续复用
+    cls = _connection_classes.get(base)
+    if cls is None:
+
+        class CancellableConnection(base):
+            def request(self, *args, **kwargs):
+                token = getattr(_local, "cancel_token", None)
+                if token is not None:
+                    if self.sock is None:
+                        self.connect()
+                    _local.callbacks.append(self.abort)
+                    token.register(self.abort)
+                return super().request(*args, **kwargs)
+
+            def abort(self):
+                # 关闭socket，阻塞在读取响应上的请求会立即抛出异常，连接不会再放回连接池
+                sock = self.sock
+                if sock:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        cls = _connection_classes[base] = CancellableConnection
+    return cls
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        new_pool = self.poolmanager._new_pool
+
+        def _new_pool(scheme, host, port, request_context=None):
+            pool = new_pool(scheme, host, port, request_context)
+            pool.ConnectionCls = _cancellable_connection_class(pool.ConnectionCls)
+            return pool
+
+        self.poolmanager._new_pool = _new_pool
+
+
+def get_session(proxy=None) -> requests.Session:
+    """
+    获取共享的Session，每个host最多保持http_pool_maxsize个连接
+    """
+    session = _sessions.get(proxy)
+    if session is not None:
+        return session
+    with _lock:
+        session = _sessions.get(proxy)
+        if session is None:
+            session = requests.Session()
+            # 所有模块共用同一个Session，不保存cookie，避免某个上游设置的cookie被带到其它模块的请求中
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = _PooledAdapter(
+                pool_connections=conf().get("http_pool_connections", 20),
+                pool_maxsize=conf().get("http_pool_maxsize", 20),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if proxy:
+                session.proxies = {"http": proxy, "https": proxy}
+            _sessions[proxy] = session
+    return session
+
+
+def request(method, url, proxy=None, cancel_token: CancellationToken = None, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", conf().get("http_timeout", 180))
+    start = time.monotonic()
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+        _local.cancel_token, _local.callbacks = cancel_token, []
+    try:
+        return get_session(proxy).request(method, url, **kwargs)
+    finally:
+        if cancel_token is not None:
+            for callback in _local.callbacks:
+                cancel_token.unregister(callback)
+            _local.cancel_token = None
+        metrics.histogram("http_client.request_ms", host=urlsplit(url).hostname).observe((time.monotonic() - start) * 1000)
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def iter_sse(response: requests.Response):
+    """
+    逐条解析server-sent events的data字段，用于OpenAI兼容接口的流式输出(stream=True)，收到[DONE]时结束
+    """
+    for line in response.iter_lines():
+        if not line or not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip().decode("utf-8")
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
+
+
+def close():
+    """
+    关闭所有连接，配置变化后调用，下次请求时按新的配置创建连接池
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+if __name__ == "__main__":
+    # 连接复用前后的耗时对比: python -m common.http_client
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # 支持keep-alive
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1/chat/completions".format(server.server_port)
+    n = 1000
+    for name, func in [("requests.post", requests.post), ("http_client.post", post)]:
+        func(url, json={"warmup": True})
+        start = time.perf_counter()
+        for _ in range(n):
+            func(url, json={"messages": []}).json()
+        cost = time.perf_counter() - start
+        print("{}: {:.3f}ms/request".format(name, cost / n * 1000))
+    print(metrics.snapshot("http_client"))
+    server.shutdown()
@@ -0,0 +1,162 @@
+"""
+键值存储，用于在多个进程之间共享会话和消息去重等状态
+    memory: 进程内存储，单进程部署时使用
+    redis: 多个进程连接同一个redis，配置kv_store_url，如 redis://127.0.0.1:6379/0
+值需要能被json序列化
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+from common.log import logger
+from config import conf
+
+
+class KVStore(object):
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def set_if_absent(self, key, value, ttl=None):
+        """
+        key不存在时写入并返回True，已存在时返回False，用于消息去重
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        raise NotImplementedError
+
+    def lock(self, key, timeout=60):
+        """
+        对key加锁，返回上下文管理器，同一时间只有一个线程(进程)持有
+        """
+        raise NotImplementedError
+
+
+class MemoryKVStore(KVStore):
+    def __init__(self):
+        self.data = {}  # key -> (value, 过期时间)
+        self.mutex = threading.Lock()
+        self.key_locks = {}  # key -> [threading.Lock, 引用计数]
+        self.writes = 0
+
+    def _sweep(self):
+        # 每写入一定次数清理一次过期的key，避免只写不读的key(如消息去重)一直占用内存
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            now = time.monotonic()
+            for key in [key for key, item in self.data.items() if item[1] is not None and item[1] < now]:
+                del self.data[key]
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] < time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self.mutex:
+            item = self._alive(key)
+        return item[0] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self.mutex:
+            self._sweep()
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def set_if_absent(self, key, value, ttl=None):
+        with self.mutex:
+            if self._alive(key):
+                return False
+            self._sweep()
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+            return True
+
+    def delete(self, key):
+        with self.mutex:
+            self.data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self.mutex:
+            for key in [key for key in self.data if key.startswith(prefix)]:
+                del self.data[key]
+
+    @contextlib.contextmanager
+    def lock(self, key, timeout=60):
+        with self.mutex:
+            entry = self.key_locks.get(key)
+            if entry is None:
+                entry = self.key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.mutex:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.key_locks[key]
+
+
+class RedisKVStore(KVStore):
+    def __init__(self, url, prefix="cow:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None)
+
+    def set_if_absent(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.prefix + prefix + "*", count=500))
+        for i in range(0, len(keys), 500):
+            self.client.delete(*keys[i : i + 500])
+
+    def lock(self, key, timeout=60):
+        # 锁超时自动释放，避免持有锁的进程退出后死锁
+        return self.client.lock(self.prefix + "lock:" + key, timeout=timeout)
+
+
+_kv_store = None
+_kv_lock = threading.Lock()
+
+
+def get_kv_store() -> KVStore:
+    global _kv_store
+    with _kv_lock:
+        if _kv_store is None:
+            store_type = conf().get("kv_store", "memory")
+            if store_type == "redis":
+                _kv_store = RedisKVStore(conf().get("kv_store_url", "redis://127.0.0.1:6379/0"), prefix=conf().get("kv_store_prefix", "cow:"))
+                logger.info("[kv_store] using redis: {}".format(conf().get("kv_store_url")))
+            else:
+                _kv_store = MemoryKVStore()
+        return _kv_store
+
+
+def is_duplicate(namespace, msg_id, ttl):
+    """
+    消息第一次出现时记录并返回False，ttl秒内再次出现时返回True，多进程部署时通过共享的存储去重
+    """
+    return not get_kv_store().set_if_absent("dedupe:{}:{}".format(namespace, msg_id), 1, ttl)
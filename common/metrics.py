@@ -0,0 +1,199 @@
+"""
+进程内的运行指标，counter为累加值，meter为累加值和最近一分钟的速率，gauge为采集时调用函数获取的瞬时值，histogram为耗时分布(毫秒)
+    metrics.counter("chat_channel.shed", policy="drop_oldest").inc()
+    metrics.gauge("handler_pool.workers", lambda: len(pool.workers), pool="wx")
+    with metrics.timer("bridge.reply_ms", bot="chatGPT"):
+        ...
+    metrics.snapshot() -> {"chat_channel.shed{policy=drop_oldest}": 3, ...}
+"""
+
+import bisect
+import threading
+import time
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+def _key(name, tags):
+    if not tags:
+        return name
+    return "{}{{{}}}".format(name, ",".join("{}={}".format(k, tags[k]) for k in sorted(tags)))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get(self):
+        return self.value
+
+
+class Meter:
+    """
+    累计次数以及最近一分钟内的每秒速率
+    """
+
+    WINDOW = 60
+
+    def __init__(self):
+        self.count = 0
+        self.slots = [0] * self.WINDOW  # 每秒一个槽，按秒数取模循环使用
+        self.slot_secs = [0] * self.WINDOW
+        self.lock = threading.Lock()
+
+    def mark(self, n=1):
+        sec = int(time.monotonic())
+        i = sec % self.WINDOW
+        with self.lock:
+            self.count += n
+            if self.slot_secs[i] != sec:
+                self.slot_secs[i] = sec
+                self.slots[i] = 0
+            self.slots[i] += n
+
+    def rate(self):
+        now = int(time.monotonic())
+        with self.lock:
+            total = sum(n for n, sec in zip(self.slots, self.slot_secs) if now - sec < self.WINDOW)
+        return round(total / self.WINDOW, 2)
+
+    def get(self):
+        return {"count": self.count, "rate": self.rate()}
+
+
+class Gauge:
+    def __init__(self, func):
+        self.func = func
+
+    def get(self):
+        try:
+            return self.func()
+        except Exception:
+            return None
+
+
+# 耗时分布的桶上限(毫秒)，按对数刻度划分，覆盖从本地处理到模型调用的耗时
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶记录超过最大上限的值
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        估算分位数，在所在桶内按线性分布插值，落在最后一个桶时返回观测到的最大值
+        """
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        acc = 0
+        for i, cnt in enumerate(self.counts):
+            if cnt > 0 and acc + cnt >= rank:
+                if i == len(self.buckets):
+                    return round(self.max, 1)
+                lower = self.buckets[i - 1] if i > 0 else 0
+                upper = min(self.buckets[i], self.max)
+                return round(lower + (upper - lower) * (rank - acc) / cnt, 1)
+            acc += cnt
+        return round(self.max, 1)
+
+    def get(self):
+        with self.lock:
+            if self.count == 0:
+                return {"count": 0}
+            return {
+                "count": self.count,
+                "avg": round(self.sum / self.count, 1),
+                "p50": self.quantile(0.5),
+                "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "max": round(self.max, 1),
+            }
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe((time.perf_counter() - self.start) * 1000)
+        return False
+
+
+def counter(name, **tags) -> Counter:
+    key = _key(name, tags)
+    metric = _metrics.get(key)
+    if metric is not None:
+        return metric
+    with _lock:
+        if key not in _metrics:
+            _metrics[key] = Counter()
+        return _metrics[key]
+
+
+def gauge(name, func, **tags) -> Gauge:
+    key = _key(name, tags)
+    with _lock:
+        _metrics[key] = Gauge(func)
+        return _metrics[key]
+
+
+def meter(name, **tags) -> Meter:
+    key = _key(name, tags)
+    metric = _metrics.get(key)
+    if metric is not None:
+        return metric
+    with _lock:
+        if key not in _metrics:
+            _metrics[key] = Meter()
+        return _metrics[key]
+
+
+def histogram(name, **tags) -> Histogram:
+    key = _key(name, tags)
+    metric = _metrics.get(key)
+    if metric is not None:
+        return metric
+    with _lock:
+        if key not in _metrics:
+            _metrics[key] = Histogram()
+        return _metrics[key]
+
+
+def timer(name, **tags) -> Timer:
+    """
+    统计with代码块的耗时，记录到对应的histogram中
+    """
+    return Timer(histogram(name, **tags))
+
+
+def snapshot(prefix="") -> dict:
+    with _lock:
+        items = [(key, metric) for key, metric in _metrics.items() if key.startswith(prefix)]
+    return {key: metric.get() for key, metric in sorted(items)}
@@ -0,0 +1,47 @@
+import threading
+
+from common.log import logger
+
+
+# 重排缓冲区，并发处理的任务按acquire的顺序依次执行其释放函数，先完成的任务会等待前序任务
+class ReorderBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_seq = {}  # key -> 下一个分配的序号
+        self.next_release = {}  # key -> 下一个待释放的序号
+        self.pending = {}  # key -> {seq: func}
+        self.flushing = set()  # 正在释放中的key，同一key同时只有一个线程执行释放函数
+
+    def acquire(self, key):
+        with self.lock:
+            seq = self.next_seq.get(key, 0)
+            self.next_seq[key] = seq + 1
+            return seq
+
+    def release(self, key, seq, func=None):
+        """
+        标记序号seq已完成，func为按序执行的释放函数，为None时仅占位
+        """
+        with self.lock:
+            self.pending.setdefault(key, {})[seq] = func
+            if key in self.flushing:
+                return
+            self.flushing.add(key)
+        while True:
+            with self.lock:
+                pending = self.pending[key]
+                seq = self.next_release.get(key, 0)
+                if seq not in pending:
+                    self.flushing.discard(key)
+                    if not pending and self.next_seq.get(key) == seq:  # 所有序号都已释放，清理key
+                        del self.pending[key]
+                        del self.next_seq[key]
+                        self.next_release.pop(key, None)
+                    return
+                func = pending.pop(seq)
+                self.next_release[key] = seq + 1
+            if func:
+                try:
+                    func()
+                except Exception as e:
+                    logger.exception("[reorder_buffer] release error: {}".format(e))
@@ -0,0 +1,36 @@
+import random
+
+from common import metrics
+from common.delay_queue import DelayQueue
+
+
+# 失败任务的延时重试，等待期间不占用工作线程，到期后交给executor重新执行
+class RetryScheduler:
+    def __init__(self, name, executor, delay_queue: DelayQueue = None, max_retries=2, base_delay=3, max_delay=60, jitter=0.1):
+        self.name = name
+        self.executor = executor  # 执行重试任务的线程池，需要实现submit方法
+        self.delay_queue = delay_queue or DelayQueue(name)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter  # 随机抖动的比例，避免大量任务同时重试
+        self.retry_cnt = metrics.counter("retry.scheduled", task=name)
+        self.dead_letter_cnt = metrics.counter("retry.dead_letter", task=name)
+
+    def backoff(self, retry_cnt):
+        """
+        第retry_cnt次失败后的等待时间，指数退避: base_delay * 2^retry_cnt，再加上随机抖动
+        """
+        delay = min(self.base_delay * (2**retry_cnt), self.max_delay)
+        return delay + random.uniform(0, delay * self.jitter)
+
+    def retry(self, retry_cnt, func, *args, **kwargs):
+        """
+        安排第retry_cnt+1次执行func，超过最大重试次数时返回False，由调用方处理死信
+        """
+        if retry_cnt >= self.max_retries:
+            self.dead_letter_cnt.inc()
+            return False
+        self.retry_cnt.inc()
+        self.delay_queue.call_later(self.backoff(retry_cnt), self.executor.submit, func, *args, **kwargs)
+        return True
@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+
+
+class SessionState:
+    def __init__(self, concurrency):
+        self.queue = deque()  # 待处理的消息
+        self.priority = deque()  # 待处理的优先消息(管理命令)
+        self.running = 0  # 正在处理中的消息数
+        self.concurrency = concurrency  # 同一会话最多同时处理的消息数
+        self.weight = 1.0  # 调度权重，权重越大分到的处理机会越多
+        self.finish = 0.0  # 该会话上一条消息的虚拟完成时间
+
+
+# 基于就绪队列的会话调度器，只有"有待处理消息且未达到并发上限"的会话才会进入就绪队列，
+# 生产者和任务完成回调负责唤醒消费者，空闲的会话不会被扫描
+# 就绪队列分为两条通道：优先通道按FIFO处理管理命令，不受会话并发上限限制；普通通道按会话权重做加权公平调度(start-time fair queuing)，
+# 每处理会话的一条消息，该会话的虚拟时间前进1/weight，总是先处理虚拟时间最小的会话
+class SessionScheduler:
+    def __init__(self, concurrency=1, max_queue=0, max_session_queue=0):
+        self.concurrency = concurrency  # 新建会话的并发上限，可以是int或返回int的函数
+        self.max_queue = max_queue  # 所有会话排队消息总数上限，0表示不限制
+        self.max_session_queue = max_session_queue  # 单个会话排队消息数上限，0表示不限制
+        self.queued = 0  # 所有会话排队中的消息总数
+        self.sessions = {}  # session_id -> SessionState
+        self.priority_ready = deque()  # 优先通道中就绪的session_id
+        self.priority_set = set()
+        self.fair_ready = []  # 普通通道的小顶堆，元素为(虚拟开始时间, 序号, session_id)
+        self.fair_set = set()
+        self.vtime = 0.0  # 全局虚拟时间，即最近一次处理的消息的虚拟开始时间
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def _new_state(self):
+        concurrency = self.concurrency() if callable(self.concurrency) else self.concurrency
+        return SessionState(max(int(concurrency), 1))
+
+    def _mark_ready(self, session_id, state):
+        # 管理命令不受会话并发上限限制，会话中有消息正在处理时也能立即执行
+        if state.priority:
+            if session_id not in self.priority_set:
+                self.priority_ready.append(session_id)
+                self.priority_set.add(session_id)
+                self.cond.notify()
+        elif state.queue and state.running < state.concurrency and session_id not in self.fair_set:
+            heapq.heappush(self.fair_ready, (max(self.vtime, state.finish), next(self.counter), session_id))
+            self.fair_set.add(session_id)
+            self.cond.notify()
+
+    def put(self, session_id, item, priority=False, weight=None):
+        """
+        将消息放入会话队列，priority为True时进入优先通道(用于管理命令)，weight为会话的调度权重
+        """
+        with self.cond:
+            state = self.sessions.get(session_id)
+            if state is None:
+                state = self.sessions[session_id] = self._new_state()
+            if weight and weight > 0:
+                state.weight = float(weight)
+            if priority:
+                state.priority.append(item)
+            else:
+                state.queue.append(item)
+            self.queued += 1
+            self._mark_ready(session_id, state)
+
+    def is_full(self, session_id):
+        """
+        判断放入该会话的消息是否会超出排队上限
+        """
+        with self.cond:
+            if self.max_queue > 0 and self.queued >= self.max_queue:
+                return True
+            state = self.sessions.get(session_id)
+            return self.max_session_queue > 0 and state is not None and len(state.queue) >= self.max_session_queue
+
+    def drop_oldest(self, session_id):
+        """
+        丢弃一条最早的普通排队消息，优先丢弃该会话的，该会话没有排队消息时丢弃排队最长的会话的，返回(session_id, item)
+        """
+        with self.cond:
+            state = self.sessions.get(session_id)
+            if state is None or not state.queue:
+                if not self.sessions:
+                    return None
+                session_id, state = max(self.sessions.items(), key=lambda kv: len(kv[1].queue))
+                if not state.queue:
+                    return None
+            item = state.queue.popleft()
+            self.queued -= 1
+            if not state.queue and not state.priority and state.running <= 0:
+                del self.sessions[session_id]
+            return session_id, item
+
+    def get(self, timeout=None):
+        """
+        阻塞直到有会话就绪，返回(session_id, item, priority)，超时返回None
+        取出的消息在处理完毕后必须调用task_done
+        """
+        with self.cond:
+            while True:
+                while not self.priority_ready and not self.fair_ready:
+                    if not self.cond.wait(timeout) and timeout is not None:
+                        return None
+                # 就绪后被取消、丢弃或已达到并发上限的会话直接跳过，task_done时会重新加入就绪队列
+                if self.priority_ready:
+                    session_id = self.priority_ready.popleft()
+                    self.priority_set.discard(session_id)
+                    state = self.sessions.get(session_id)
+                    if state is None or not state.priority:
+                        continue
+                    item, priority = state.priority.popleft(), True
+                else:
+                    tag, _, session_id = heapq.heappop(self.fair_ready)
+                    self.fair_set.discard(session_id)
+                    state = self.sessions.get(session_id)
+                    if state is None or not state.queue or state.priority or state.running >= state.concurrency:
+                        continue
+                    self.vtime = tag
+                    state.finish = tag + 1.0 / state.weight
+                    item, priority = state.queue.popleft(), False
+                break
+            self.queued -= 1
+            state.running += 1
+            self._mark_ready(session_id, state)
+            return session_id, item, priority
+
+    def task_done(self, session_id):
+        with self.cond:
+            state = self.sessions.get(session_id)
+            if state is None:
+                return
+            state.running -= 1
+            if state.queue or state.priority:
+                self._mark_ready(session_id, state)
+            elif state.running <= 0:  # 没有排队和处理中的消息，会话可以删除
+                del self.sessions[session_id]
+
+    def cancel(self, session_id):
+        """
+        清空会话中排队的消息，返回清除的消息数
+        """
+        with self.cond:
+            state = self.sessions.get(session_id)
+            if state is None:
+                return 0
+            cnt = len(state.queue) + len(state.priority)
+            state.queue.clear()
+            state.priority.clear()
+            self.queued -= cnt
+            if state.running <= 0:
+                del self.sessions[session_id]
+            return cnt
+
+    def cancel_all(self):
+        with self.cond:
+            return {session_id: self.cancel(session_id) for session_id in list(self.sessions.keys())}
+
+    def qsize(self, session_id=None):
+        with self.cond:
+            if session_id is None:
+                return self.queued
+            state = self.sessions.get(session_id)
+            return len(state.queue) + len(state.priority) if state else 0
+
+
+if __name__ == "__main__":
+    # 入队到分发的延迟测试: python -m common.session_scheduler
+    import random
+    import time
+
+    session_cnt, msg_cnt = 10000, 100000
+    scheduler = SessionScheduler(concurrency=1)
+    latencies = []
+
+    def consume():
+        for _ in range(msg_cnt):
+            session_id, enqueue_time, _ = scheduler.get()
+            latencies.append(time.perf_counter() - enqueue_time)
+            scheduler.task_done(session_id)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time.perf_counter()
+    for i in range(msg_cnt):
+        scheduler.put("session_{}".format(random.randrange(session_cnt)), time.perf_counter(), priority=(i % 100 == 0))
+    consumer.join()
+    cost = time.perf_counter() - start
+    latencies.sort()
+    print("sessions={}, messages={}, throughput={:.0f} msg/s".format(session_cnt, msg_cnt, msg_cnt / cost))
+    print("p50={:.3f}ms, p99={:.3f}ms".format(latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
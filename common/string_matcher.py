@@ -0,0 +1,97 @@
+"""
+Compiled matchers for prefix and keyword lists, build once and match many times.
+Short lists are matched by a plain loop, which is faster than walking the automaton in pure python.
+"""
+
+LOOP_THRESHOLD = 8
+
+
+class PrefixMatcher:
+    def __init__(self, prefix_list):
+        self.prefix_list = list(prefix_list or [])
+        self.trie = None
+        if len(self.prefix_list) > LOOP_THRESHOLD:
+            self.trie = {}
+            for index, prefix in enumerate(self.prefix_list):
+                node = self.trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                node.setdefault("", index)  # 重复的前缀保留最先出现的位置
+
+    def match(self, content):
+        """
+        返回列表中第一个能匹配content的前缀，与chat_channel.check_prefix的结果一致，没有匹配返回None
+        """
+        if self.trie is None:
+            for prefix in self.prefix_list:
+                if content.startswith(prefix):
+                    return prefix
+            return None
+        best = None
+        node = self.trie
+        if "" in node:
+            best = node[""]
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            if "" in node and (best is None or node[""] < best):
+                best = node[""]
+        return None if best is None else self.prefix_list[best]
+
+
+# Aho-Corasick自动机，判断文本中是否包含任一关键词
+class KeywordMatcher:
+    def __init__(self, keyword_list):
+        self.keyword_list = list(keyword_list or [])
+        self.match_all = "" in self.keyword_list
+        self.goto = None
+        if len(self.keyword_list) > LOOP_THRESHOLD and not self.match_all:
+            self._build()
+
+    def _build(self):
+        self.goto = [{}]  # 每个状态的转移表
+        self.fail = [0]
+        self.output = [False]  # 到达该状态时是否匹配到关键词
+        for keyword in self.keyword_list:
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][ch] = nxt
+                state = nxt
+            self.output[state] = True
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if self.goto[f].get(ch, 0) != nxt else 0
+                self.output[nxt] = self.output[nxt] or self.output[self.fail[nxt]]
+
+    def match(self, content):
+        """
+        content包含任一关键词时返回True，否则返回None，与chat_channel.check_contain的结果一致
+        """
+        if self.match_all:
+            return True
+        if self.goto is None:
+            for keyword in self.keyword_list:
+                if content.find(keyword) != -1:
+                    return True
+            return None
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return None
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from common import metrics
+from common.log import logger
+
+
+# 自适应线程池，空闲线程不足时按需扩容，线程空闲超过idle_timeout后缩容到min_workers
+# 处理耗时较长(如等待LLM接口)时，按排队数量一次性扩容，避免消息长时间排队
+class AdaptiveThreadPool:
+    def __init__(self, name="default", min_workers=2, max_workers=32, idle_timeout=60, slow_threshold=1.0, initializer=None):
+        self.name = name
+        self.min_workers = max(int(min_workers), 0)
+        self.max_workers = max(int(max_workers), 1, self.min_workers)
+        self.idle_timeout = idle_timeout
+        self.slow_threshold = slow_threshold  # 平均处理耗时超过该值(秒)时按排队数量扩容
+        self._initializer = initializer
+        self._shutdown = False
+        self._work_queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self.workers = set()
+        self.idle = 0  # 空闲线程数
+        self.pending = 0  # 排队中的任务数
+        self.latency = 0.0  # 任务处理耗时的指数移动平均值(秒)
+        self.peak_workers = 0
+        self.saturated_cnt = metrics.counter("handler_pool.saturated", pool=name)  # 线程数达到上限仍有任务排队的次数
+        metrics.gauge("handler_pool.workers", lambda: len(self.workers), pool=name)
+        metrics.gauge("handler_pool.busy", lambda: len(self.workers) - self.idle, pool=name)
+        metrics.gauge("handler_pool.queue", lambda: self.pending, pool=name)
+        metrics.gauge("handler_pool.latency_ms", lambda: round(self.latency * 1000, 1), pool=name)
+        self._started = False  # 首次提交任务时才启动min_workers个线程，initializer可以依赖创建线程池之后才准备好的资源
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if not self._started:
+                self._started = True
+                for _ in range(self.min_workers):
+                    self._spawn()
+            self.pending += 1
+            self._work_queue.put((future, fn, args, kwargs))
+            self._adjust()
+        return future
+
+    def _adjust(self):
+        # 需要在self._lock中调用
+        if self.idle >= self.pending:
+            return
+        want = 1
+        if self.latency >= self.slow_threshold:
+            want = self.pending - self.idle
+        while want > 0 and len(self.workers) < self.max_workers:
+            self._spawn()
+            want -= 1
+        if want > 0 and len(self.workers) >= self.max_workers:
+            self.saturated_cnt.inc()
+
+    def _spawn(self):
+        t = threading.Thread(target=self._worker, name="{}-handler-{}".format(self.name, len(self.workers)), daemon=True)
+        self.workers.add(t)
+        self.idle += 1
+        self.peak_workers = max(self.peak_workers, len(self.workers))
+        t.start()
+
+    def _worker(self):
+        if self._initializer:
+            try:
+                self._initializer()
+            except Exception as e:
+                logger.exception("[thread_pool] initializer error: {}".format(e))
+        me = threading.current_thread()
+        while True:
+            try:
+                item = self._work_queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # 超时到加锁之间可能有新任务提交，submit看到本线程空闲就不会扩容，
+                    # 因此只有退出后剩余的空闲线程足够处理排队的任务时才退出
+                    if self._shutdown or (len(self.workers) > self.min_workers and self.idle - 1 >= self.pending):
+                        self.workers.discard(me)
+                        self.idle -= 1
+                        return
+                continue
+            if item is None:  # shutdown
+                with self._lock:
+                    self.workers.discard(me)
+                    self.idle -= 1
+                return
+            future, fn, args, kwargs = item
+            with self._lock:
+                self.pending -= 1
+                self.idle -= 1
+            if future.set_running_or_notify_cancel():
+                start = time.monotonic()
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+                cost = time.monotonic() - start
+            else:
+                cost = None
+            with self._lock:
+                self.idle += 1
+                if cost is not None:
+                    self.latency = cost if self.latency == 0 else self.latency * 0.9 + cost * 0.1
+
+    def stats(self) -> dict:
+        with self._lock:
+            workers = len(self.workers)
+            return {
+                "workers": workers,
+                "busy": workers - self.idle,
+                "queue": self.pending,
+                "saturation": round((workers - self.idle) / self.max_workers, 2),
+                "latency_ms": round(self.latency * 1000, 1),
+                "peak_workers": self.peak_workers,
+                "saturated_cnt": self.saturated_cnt.get(),
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            workers = list(self.workers)
+        for _ in workers:
+            self._work_queue.put(None)
+        if wait:
+            for t in workers:
+                if t is not threading.current_thread():
+                    t.join()
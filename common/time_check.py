@@ -1,8 +1,25 @@
+import functools
 import re
 import time
 import config
 from common.log import logger
 
+TIME_REGEX = re.compile(r"^([01]?[0-9]|2[0-4])(:)([0-5][0-9])$")
+# 定义匹配规则，如果以 #reconf 或者  #更新配置  结尾, 非服务时间可以修改开始/结束时间并重载配置
+RECONF_PATTERN = re.compile(r"^.*#(?:reconf|更新配置)$")
+
+
+@functools.lru_cache(maxsize=16)
+def parse_time_range(chat_start_time, chat_stop_time):
+    """
+    解析服务时间，返回(开始时间, 结束时间)，格式不正确返回None，同一配置只解析一次
+    """
+    if not (TIME_REGEX.match(chat_start_time) and TIME_REGEX.match(chat_stop_time)):
+        return None
+    start = tuple(int(x) for x in chat_start_time.split(":"))
+    stop = tuple(int(x) for x in chat_stop_time.split(":"))
+    return start, stop
+
 
 def time_checker(f):
     def _time_checker(self, *args, **kwargs):
@@ -10,18 +27,14 @@ def time_checker(f):
         chat_time_module = _config.get("chat_time_module", False)
 
         if chat_time_module:
-            chat_start_time = _config.get("chat_start_time", "00:00")
-            chat_stop_time = _config.get("chat_stop_time", "24:00")
-
-            time_regex = re.compile(r"^([01]?[0-9]|2[0-4])(:)([0-5][0-9])$")
-
-            if not (time_regex.match(chat_start_time) and time_regex.match(chat_stop_time)):
+            time_range = parse_time_range(_config.get("chat_start_time", "00:00"), _config.get("chat_stop_time", "24:00"))
+            if time_range is None:
                 logger.warning("时间格式不正确，请在config.json中修改CHAT_START_TIME/CHAT_STOP_TIME。")
                 return None
 
-            now_time = time.strptime(time.strftime("%H:%M"), "%H:%M")
-            chat_start_time = time.strptime(chat_start_time, "%H:%M")
-            chat_stop_time = time.strptime(chat_stop_time, "%H:%M")
+            now = time.localtime()
+            now_time = (now.tm_hour, now.tm_min)
+            chat_start_time, chat_stop_time = time_range
             # 结束时间小于开始时间，跨天了
             if chat_stop_time < chat_start_time and (chat_start_time <= now_time or now_time <= chat_stop_time):
                 f(self, *args, **kwargs)
@@ -29,9 +42,7 @@ def time_checker(f):
             elif chat_start_time < chat_stop_time and chat_start_time <= now_time <= chat_stop_time:
                 f(self, *args, **kwargs)
             else:
-                # 定义匹配规则，如果以 #reconf 或者  #更新配置  结尾, 非服务时间可以修改开始/结束时间并重载配置
-                pattern = re.compile(r"^.*#(?:reconf|更新配置)$")
-                if args and pattern.match(args[0].content):
+                if args and RECONF_PATTERN.match(args[0].content):
                     f(self, *args, **kwargs)
                 else:
                     logger.info("非服务时间内，不接受访问")
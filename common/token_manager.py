@@ -0,0 +1,118 @@
+"""
+共享的access_token缓存，各模块获取有效期较短的凭证时使用，避免每次请求前都重新获取
+    from common import token_manager
+    access_token = token_manager.get("baidu_wenxin", fetch_func, key=api_key)
+fetch_func()返回(token, expires_in秒数)，expires_in为None表示不过期，获取失败时抛出异常
+- token缓存到过期为止，过期前refresh_ahead秒开始在后台线程刷新，期间仍返回当前的token，请求不需要等待
+- 同一个token同时只有一个线程在获取，其它线程等待并直接使用它的结果
+- 上游返回token失效时调用refresh强制刷新，并发调用只刷新一次
+获取次数记录在token_manager.refresh{token, mode, result}，mode为blocking(请求等待获取)或background(后台刷新)
+"""
+
+import threading
+import time
+
+from common import metrics
+from common.log import logger
+
+_lock = threading.Lock()
+_tokens = {}  # (name, key) -> _Token
+
+
+class _Token(object):
+    def __init__(self, name, fetch_func, refresh_ahead):
+        self.name = name
+        self.fetch_func = fetch_func
+        self.refresh_ahead = refresh_ahead
+        self.lock = threading.Lock()  # 获取token时持有，保证同时只有一个线程在获取
+        self.value = None
+        self.expires_at = 0
+        self.refresh_at = 0
+        self.generation = 0  # 每次获取成功加1，用于判断等待锁期间是否已经被其它线程刷新
+        self.refreshing = False
+
+    def get(self):
+        now = time.time()
+        value = self.value
+        if value is not None and now < self.expires_at:
+            if now >= self.refresh_at:
+                self._refresh_in_background()
+            return value
+        with self.lock:
+            if self.value is None or time.time() >= self.expires_at:
+                self._fetch("blocking")
+            return self.value
+
+    def refresh(self):
+        generation = self.generation
+        with self.lock:
+            if self.generation == generation:
+                self._fetch("blocking")
+            return self.value
+
+    def _fetch(self, mode):
+        start = time.time()
+        try:
+            value, expires_in = self.fetch_func()
+            if not value:
+                raise ValueError("empty token")
+        except Exception:
+            metrics.counter("token_manager.refresh", token=self.name, mode=mode, result="error").inc()
+            raise
+        metrics.counter("token_manager.refresh", token=self.name, mode=mode, result="ok").inc()
+        if expires_in is None:
+            self.expires_at = self.refresh_at = float("inf")
+        else:
+            # 从请求发出的时间开始计算有效期，提前一点视为过期，避免token在使用途中过期
+            # 有效期较短的token在剩余20%时开始刷新
+            self.expires_at = start + expires_in - min(60, expires_in * 0.1)
+            self.refresh_at = start + max(expires_in - self.refresh_ahead, expires_in * 0.8)
+        self.value = value
+        self.generation += 1
+        logger.debug("[token_manager] {} refreshed, expires_in={}".format(self.name, expires_in))
+
+    def _refresh_in_background(self):
+        with _lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._background_refresh, name="token-refresh-" + self.name, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self.lock:
+                if time.time() >= self.refresh_at:
+                    self._fetch("background")
+        except Exception as e:
+            # 当前token在过期前仍然可用，下次访问时再重试
+            logger.warning("[token_manager] {} background refresh failed: {}".format(self.name, e))
+        finally:
+            self.refreshing = False
+
+
+def _get_token(name, fetch_func, key, refresh_ahead) -> _Token:
+    token = _tokens.get((name, key))
+    if token is not None:
+        return token
+    with _lock:
+        token = _tokens.get((name, key))
+        if token is None:
+            token = _tokens[(name, key)] = _Token(name, fetch_func, refresh_ahead)
+    return token
+
+
+def get(name, fetch_func, key="", refresh_ahead=300) -> str:
+    """
+    :param name: token的名称，用于日志和统计
+    :param fetch_func: 获取token的函数，返回(token, expires_in秒数)
+    :param key: 区分同一类token的不同凭证(如app_id)，配置修改后使用新的缓存
+    :param refresh_ahead: 过期前多少秒开始后台刷新
+    """
+    return _get_token(name, fetch_func, key, refresh_ahead).get()
+
+
+def refresh(name, fetch_func, key="", refresh_ahead=300) -> str:
+    """
+    上游返回token失效时强制重新获取，等待期间已被其它线程刷新过则直接返回新的token
+    """
+    return _get_token(name, fetch_func, key, refresh_ahead).refresh()
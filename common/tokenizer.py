@@ -0,0 +1,108 @@
+"""
+tiktoken编码器的注册表，模型到编码的映射只解析一次，编码器加载后缓存复用
+    encode_len("hello", "gpt-3.5-turbo") -> 1
+    encode_lens(["hello", "world"], "gpt-4") -> [1, 1]
+启动时调用preload在后台预先加载，避免第一条消息等待BPE文件加载
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from common import metrics
+from common.log import logger
+from config import conf
+
+DEFAULT_ENCODING = "cl100k_base"
+
+_lock = threading.Lock()
+_encodings = {}  # model -> tiktoken.Encoding
+_process_pool = None
+_process_workers = 0
+
+_cache_hit = metrics.counter("tokenizer.cache", result="hit")
+_cache_miss = metrics.counter("tokenizer.cache", result="miss")
+_counts = metrics.meter("tokenizer.counts")
+
+
+def get_encoding(model):
+    """
+    获取模型对应的编码器，未知模型使用cl100k_base
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        _cache_hit.inc()
+        return encoding
+    with _lock:
+        encoding = _encodings.get(model)
+        if encoding is None:
+            _cache_miss.inc()
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logger.debug("Warning: model not found. Using cl100k_base encoding.")
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            _encodings[model] = encoding
+    return encoding
+
+
+def encode_len(text, model, **kwargs):
+    _counts.mark()
+    return len(get_encoding(model).encode(text, **kwargs))
+
+
+def encode_lens(texts, model, **kwargs):
+    """
+    批量计算token数，文本总长度超过tokenizer_process_threshold且配置了tokenizer_process_pool时，分块交给进程池计算
+    """
+    texts = list(texts)
+    encoding = get_encoding(model)
+    pool = _get_process_pool()
+    if pool is not None and len(texts) > 1 and sum(len(text) for text in texts) >= conf().get("tokenizer_process_threshold", 200000):
+        chunk_size = -(-len(texts) // _process_workers)
+        chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        lens = []
+        for chunk_lens in pool.map(_encode_lens, [encoding.name] * len(chunks), chunks, [kwargs] * len(chunks)):
+            lens.extend(chunk_lens)
+    else:
+        lens = [len(encoding.encode(text, **kwargs)) for text in texts]
+    _counts.mark(len(texts))
+    return lens
+
+
+def _encode_lens(encoding_name, texts, kwargs):
+    # 在子进程中执行，tiktoken会缓存加载过的编码器
+    import tiktoken
+
+    encoding = tiktoken.get_encoding(encoding_name)
+    return [len(encoding.encode(text, **kwargs)) for text in texts]
+
+
+def _get_process_pool():
+    global _process_pool, _process_workers
+    workers = conf().get("tokenizer_process_pool", 0)
+    if not workers:
+        return None
+    with _lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=workers)
+            _process_workers = workers
+    return _process_pool
+
+
+def preload(models):
+    """
+    在后台线程中预先加载模型对应的编码器
+    """
+
+    def _preload():
+        for model in models:
+            try:
+                get_encoding(model)
+            except Exception as e:
+                logger.debug("[tokenizer] preload encoding for {} failed: {}".format(model, e))
+                return
+        logger.debug("[tokenizer] preload encodings for {} done".format(models))
+
+    threading.Thread(target=_preload, name="tokenizer-preload", daemon=True).start()
@@ -47,13 +47,52 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "reply_in_order": False,  # 同一会话并发处理多条消息时，是否按消息到达顺序发送回复
+    "handler_pool_min_workers": 2,  # 每个channel处理消息的最少线程数
+    "handler_pool_max_workers": 32,  # 每个channel处理消息的最多线程数，根据排队数量和处理耗时自动扩容
+    "handler_pool_idle_timeout": 60,  # 线程空闲超过该秒数后回收，直到剩余最少线程数
+    "max_queue_size": 0,  # 所有会话排队中的消息总数上限，0表示不限制
+    "max_session_queue_size": 0,  # 单个会话排队中的消息数上限，0表示不限制
+    "overload_policy": "drop_oldest",  # 排队消息超出上限时的处理策略，支持 drop_oldest(丢弃最早的消息), reject(拒绝并提示), degrade(使用overload_degrade_model处理)
+    "overload_reply": "当前消息太多，请稍后再试",  # reject策略的提示语
+    "overload_degrade_model": "",  # degrade策略使用的模型，仅支持按消息指定模型的bot(ChatGPT、智谱)，其它bot按reject处理
+    "session_weights": {"admin": 4, "single": 2, "group": 1},  # 会话调度权重，排队时权重越大的会话分到的处理机会越多
+    "group_weights": {},  # 指定群的调度权重，如 {"ChatGPT测试群": 3}，未配置的群使用session_weights中的group权重
+    "coalesce_window": 0,  # 合并同一用户连续发送的文本消息，收到消息后等待该秒数内的后续消息一起处理，0表示不合并
+    "coalesce_max_wait": 6,  # 合并消息时，第一条消息最多等待的秒数
+    "coalesce_max_messages": 5,  # 最多合并的消息条数
+    "send_retry_times": 2,  # 回复发送失败后的最多重试次数，仍然失败的回复记录到数据目录下的dead_letter.log
+    "send_retry_base_delay": 3,  # 第一次重试前等待的秒数，之后每次翻倍
+    "send_retry_max_delay": 60,  # 重试前最多等待的秒数
+    "send_retry_jitter": 0.1,  # 重试等待时间的随机抖动比例
+    "stream_reply": False,  # 流式回复，支持的bot边生成边发送，能更新消息的channel(终端、飞书、钉钉AI卡片)逐步更新同一条消息，其它channel按句子分段发送。流式发送的内容不经过插件的回复过滤(如敏感词)
+    "stream_min_chars": 50,  # 按句子分段发送时，每段至少的字数
+    "stream_update_interval": 1,  # 更新消息的最小间隔秒数
+    "stream_max_updates": 100,  # 一条消息最多更新的次数，超过后等生成结束再更新
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "",  # 会话的持久化存储，可选sqlite(保存在数据目录的sessions.db)、kv(保存在kv_store中，多进程共享)，为空时会话只保存在内存中，重启后丢失
+    "session_store_flush_interval": 1,  # 会话批量写入存储的间隔秒数
+    "session_memory_budget_mb": 0,  # 内存中会话占用的内存上限(MB，粗略估算，每个bot分别计算)，超出时淘汰最久未访问的会话，0表示不限制
+    # 多进程部署时共享的键值存储，session_store配置为kv时会话也保存在其中，消息去重始终使用该存储
+    "kv_store": "memory",  # 可选memory(进程内)、redis
+    "kv_store_url": "redis://127.0.0.1:6379/0",
+    "kv_store_prefix": "cow:",
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "tokenizer_process_pool": 0,  # 批量计算token数的进程数，0表示在当前线程中计算
+    "tokenizer_process_threshold": 200000,  # 批量计算的文本总字符数超过该值时才交给进程池
+    # 超出conversation_max_tokens的历史对话由一个便宜的模型在后台压缩成摘要，附加在人格描述之后，为空时直接丢弃
+    "session_summary_model": "",  # 如 gpt-4o-mini，使用OpenAI兼容的/chat/completions接口
+    "session_summary_api_base": "",  # 为空时使用open_ai_api_base
+    "session_summary_api_key": "",  # 为空时使用open_ai_api_key
+    "session_summary_max_chars": 300,  # 摘要的最多字数
+    # 相同问题的回复缓存，只对没有历史对话的提问生效
+    "answer_cache_ttl": 0,  # 回复缓存的秒数，0表示不缓存
+    "answer_cache_size": 1000,  # 最多缓存的问题数，超出时淘汰最久未使用的
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
@@ -64,6 +103,12 @@ available_setting = {
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
+    # 共享的HTTP连接池，各模块访问上游接口时复用keep-alive连接
+    "http_pool_connections": 20,  # 缓存连接池的上游host数
+    "http_pool_maxsize": 20,  # 每个host最多保持的连接数，建议不小于处理消息的线程数
+    "http_timeout": 180,  # 未指定超时时间的请求默认的超时秒数
+    "async_reply": False,  # 文本消息使用异步请求调用bot(支持ChatGPT、Moonshot、智谱、Minimax、LinkAI、Claude API)，等待回复时不占用线程，需要安装aiohttp
+    "async_http_max_connections": 1000,  # 异步请求最多同时打开的连接数
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
     "baidu_wenxin_api_key": "",  # Baidu api key
@@ -72,6 +117,8 @@ available_setting = {
     "xunfei_app_id": "",  # 讯飞应用ID
     "xunfei_api_key": "",  # 讯飞 API key
     "xunfei_api_secret": "",  # 讯飞 API secret
+    "xunfei_max_connections": 10,  # 讯飞同时进行的请求数上限，超出的请求等待空闲连接
+    "xunfei_timeout": 30,  # 讯飞等待连接和每一段回复的超时秒数
     # claude 配置
     "claude_api_cookie": "",
     "claude_uuid": "",
@@ -147,6 +194,8 @@ available_setting = {
     "dingtalk_client_id": "",  # 钉钉机器人Client ID
     "dingtalk_client_secret": "",  # 钉钉机器人Client Secret
     "dingtalk_card_enabled": False,
+    "dingtalk_stream_card_template_id": "",  # 流式回复使用的AI卡片模板id，为空时按句子分段发送
+    "dingtalk_stream_card_content_key": "content",  # AI卡片模板中显示回复内容的变量名
 
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
@@ -226,6 +275,10 @@ class Config(dict):
 config = Config()
 
 
+def conf():
+    return config
+
+
 # Function to redact sensitive data
 def drag_sensitive(config):
     try:
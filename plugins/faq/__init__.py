@@ -0,0 +1 @@
+from .faq import *
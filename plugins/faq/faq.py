@@ -0,0 +1,116 @@
+# encoding:utf-8
+
+import atexit
+import hashlib
+import os
+import threading
+import time
+
+import plugins
+from bridge.answer_cache import normalize_query
+from bridge.bridge import Bridge
+from bridge.context import ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.log import logger
+from config import conf, get_appdata_dir
+from plugins import *
+
+from .minhash_index import MinHashIndex
+
+
+@plugins.register(
+    name="FAQ",
+    desire_priority=-10,
+    hidden=True,
+    desc="相似问题直接使用之前的回答，不再调用模型",
+    version="0.1",
+    author="godlockin",
+)
+class FAQ(Plugin):
+    def __init__(self):
+        super().__init__()
+        self.config = super().load_config()
+        if not self.config or not self.config.get("enabled", True):
+            logger.info("[FAQ] no config.json or disabled, ignore")
+            return
+        self.threshold = self.config.get("threshold", 0.7)
+        self.min_length = self.config.get("min_length", 4)
+        self.learn = self.config.get("learn", True)
+        self.index = MinHashIndex(threshold=self.threshold, max_entries=self.config.get("max_entries", 100000))
+        self.index_path = os.path.join(get_appdata_dir(), "faq_index.json")
+        try:
+            self.index.load(self.index_path)
+        except Exception as e:
+            logger.warn("[FAQ] load index from {} failed: {}".format(self.index_path, e))
+        self.faqs = MinHashIndex(threshold=self.threshold)  # 配置的问答对所有人格生效，不保存到磁盘
+        for question, answer in self.config.get("faqs", {}).items():
+            self.faqs.add("", normalize_query(question), answer)
+        self.hit_cnt = metrics.counter("faq.lookup", result="hit")
+        self.miss_cnt = metrics.counter("faq.lookup", result="miss")
+        metrics.gauge("faq.entries", lambda: len(self.index) + len(self.faqs))
+        self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        if self.learn:
+            self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
+            threading.Thread(target=self._save_loop, name="faq-saver", daemon=True).start()
+            atexit.register(self.save)
+        logger.info("[FAQ] inited, {} faqs, {} learned questions".format(len(self.faqs), len(self.index)))
+
+    def on_handle_context(self, e_context: EventContext):
+        context = e_context["context"]
+        if context.type != ContextType.TEXT:
+            return
+        question = normalize_query(context.content)
+        if len(question) < self.min_length or question.startswith("#"):
+            return
+        sessions = getattr(Bridge().get_bot("chat"), "sessions", None)
+        session = sessions.peek_session(context.get("session_id")) if sessions else None
+        if session is not None and sessions.has_history(session):  # 有上下文的提问含义依赖之前的对话，不能直接套用
+            return
+        scope = self._scope(session.system_prompt if session else conf().get("character_desc", ""))
+        start = time.perf_counter()
+        found = self.faqs.search("", question) or self.index.search(scope, question)
+        if not found:
+            self.miss_cnt.inc()
+            context["faq_question"] = (scope, question)
+            return
+        self.hit_cnt.inc()
+        logger.info("[FAQ] hit question={}, similarity={:.2f}, cost={:.2f}ms".format(found[0], found[2], (time.perf_counter() - start) * 1000))
+        if sessions and context.get("session_id") is not None:  # 保持会话完整，后续提问仍能看到这一轮对话
+            sessions.session_query(context.content, context["session_id"])
+            sessions.session_reply(found[1], context["session_id"])
+        e_context["reply"] = Reply(ReplyType.TEXT, found[1])
+        e_context.action = EventAction.BREAK_PASS
+
+    def on_decorate_reply(self, e_context: EventContext):
+        context = e_context["context"]
+        reply = e_context["reply"]
+        question = context.get("faq_question")
+        if not question or not reply or reply.type != ReplyType.TEXT or not reply.content:
+            return
+        # 只记录模型的回答，模型出错时返回的提示不会写入会话
+        sessions = getattr(Bridge().get_bot("chat"), "sessions", None)
+        session = sessions.peek_session(context.get("session_id")) if sessions else None
+        if session is None or not session.messages or reply.content not in session.messages[-1].values():
+            return
+        self.index.add(question[0], question[1], reply.content)
+
+    def _scope(self, system_prompt):
+        # 不同人格的回答互不复用
+        return hashlib.md5((system_prompt or "").encode("utf-8")).hexdigest()[:8]
+
+    def _save_loop(self):
+        while True:
+            time.sleep(self.config.get("save_interval", 60))
+            self.save()
+
+    def save(self):
+        if not self.index.dirty:
+            return
+        try:
+            self.index.save(self.index_path)
+        except Exception as e:
+            logger.warn("[FAQ] save index to {} failed: {}".format(self.index_path, e))
+
+    def get_help_text(self, **kwargs):
+        return "相似的问题会直接使用之前的回答。"
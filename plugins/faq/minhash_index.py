@@ -0,0 +1,170 @@
+# encoding:utf-8
+"""
+基于MinHash LSH的近似重复问题索引
+    每个问题按字符n-gram计算MinHash签名，签名分成bands段，任意一段完全相同的问题作为候选，
+    再计算候选与提问的n-gram Jaccard相似度，不低于threshold时视为同一个问题
+    两个问题的Jaccard相似度为J时，成为候选的概率为1-(1-J^rows)^bands，相似的问题几乎都能找到，不相关的问题很少进入候选，
+    10万条问题时查询仍在1毫秒以内
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+_PRIME = (1 << 61) - 1
+
+
+@lru_cache(maxsize=65536)
+def _gram_hash(gram):
+    return int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def ngrams(text, n=2):
+    """
+    中文按字符切分n-gram，不需要分词
+    """
+    if len(text) <= n:
+        return {text}
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class MinHashIndex(object):
+    def __init__(self, threshold=0.7, bands=8, rows=2, max_entries=100000, ngram=2):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.max_entries = max_entries
+        self.ngram = ngram
+        rand = random.Random(20240501)  # 固定的随机种子，保证重启后签名一致
+        self.permutations = [(rand.randrange(1, _PRIME), rand.randrange(0, _PRIME)) for _ in range(bands * rows)]
+        self.entries = OrderedDict()  # (scope, 问题) -> (回答, 各段签名的hash)，按写入顺序排列，超出数量时淘汰最早的，不同scope(人格)的问题互不匹配
+        self.tables = [dict() for _ in range(bands)]  # 每段签名的hash -> (scope, 问题)，有多个问题时为集合，大部分只有一个，节省内存
+        self.lock = threading.RLock()
+        self.dirty = False
+
+    def _band_keys(self, grams):
+        hashes = [_gram_hash(gram) for gram in grams]
+        signature = [min((a * h + b) % _PRIME for h in hashes) for a, b in self.permutations]
+        return [hash(tuple(signature[i * self.rows : (i + 1) * self.rows])) for i in range(self.bands)]
+
+    def search(self, scope, question):
+        """
+        查找最相似的问题，返回(问题, 回答, 相似度)，没有时返回None
+        """
+        grams = ngrams(question, self.ngram)
+        candidates = set()
+        with self.lock:
+            for table, band_key in zip(self.tables, self._band_keys(grams)):
+                keys = table.get(band_key)
+                if keys is None:
+                    continue
+                for key in keys if isinstance(keys, set) else (keys,):
+                    if key[0] == scope:
+                        candidates.add(key)
+            candidates = [(key[1], self.entries[key][0]) for key in candidates]
+        best = None
+        for candidate, answer in candidates:
+            similarity = jaccard(grams, ngrams(candidate, self.ngram))
+            if similarity >= self.threshold and (best is None or similarity > best[2]):
+                best = (candidate, answer, similarity)
+        return best
+
+    def add(self, scope, question, answer, band_keys=None):
+        key = (scope, question)
+        if band_keys is None:
+            band_keys = self._band_keys(ngrams(question, self.ngram))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                for table, band_key in zip(self.tables, band_keys):
+                    keys = table.get(band_key)
+                    if keys is None:
+                        table[band_key] = key
+                    elif isinstance(keys, set):
+                        keys.add(key)
+                    else:
+                        table[band_key] = {keys, key}
+            self.entries[key] = (answer, band_keys)
+            while len(self.entries) > self.max_entries:
+                self._remove(*self.entries.popitem(last=False))
+            self.dirty = True
+
+    def _remove(self, key, entry):
+        for table, band_key in zip(self.tables, entry[1]):
+            keys = table.get(band_key)
+            if isinstance(keys, set):
+                keys.discard(key)
+                if len(keys) == 1:
+                    table[band_key] = keys.pop()
+            elif keys == key:
+                del table[band_key]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _params(self):
+        return [self.bands, self.rows, self.ngram]
+
+    def save(self, path):
+        # 签名和参数一起保存，加载时不需要重新计算
+        with self.lock:
+            entries = [[scope, question, answer, band_keys] for (scope, question), (answer, band_keys) in self.entries.items()]
+            data = {"params": self._params(), "entries": entries}
+            self.dirty = False
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        reuse = data.get("params") == self._params()  # 参数变化后签名需要重新计算
+        for scope, question, answer, band_keys in data.get("entries", []):
+            self.add(scope, question, answer, band_keys if reuse else None)
+        self.dirty = False
+
+
+if __name__ == "__main__":
+    # 查询耗时和召回测试: python -m plugins.faq.minhash_index
+    import resource
+    import time
+
+    chars = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研至"
+    n = 100000
+    index = MinHashIndex()
+    questions = ["".join(random.choice(chars) for _ in range(random.randint(8, 30))) for _ in range(n)]
+    start = time.perf_counter()
+    for question in questions:
+        index.add("", question, "answer")
+    print("add {} questions: {:.2f}s, max rss={:.0f}MB".format(n, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    variants = []  # 同一问题的变体，替换其中一个字
+    for q in random.sample(questions, 1000):
+        i = random.randrange(len(q))
+        variants.append(q[:i] + random.choice(chars) + q[i + 1 :])
+    randoms = ["".join(random.choice(chars) for _ in range(20)) for _ in range(1000)]  # 不相关的问题
+    start = time.perf_counter()
+    variant_hits = sum(1 for query in variants if index.search("", query))
+    random_hits = sum(1 for query in randoms if index.search("", query))
+    cost = (time.perf_counter() - start) / (len(variants) + len(randoms))
+    print("search: {:.3f}ms/query, variant hits={}/1000, random hits={}/1000".format(cost * 1000, variant_hits, random_hits))
+
+    path = "/tmp/minhash_index.json"
+    index.save(path)
+    start = time.perf_counter()
+    loaded = MinHashIndex()
+    loaded.load(path)
+    print("load {} questions: {:.2f}s".format(len(loaded), time.perf_counter() - start))
+    os.remove(path)
@@ -12,7 +12,7 @@ import plugins
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from common import const
+from common import const, metrics
 from config import conf, load_config, global_config
 from plugins import *
 
@@ -131,6 +131,11 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "stats": {
+        "alias": ["stats", "运行统计"],
+        "args": ["指标前缀(可选)"],
+        "desc": "打印运行指标和各阶段耗时(毫秒)",
+    },
 }
 
 
@@ -353,6 +358,12 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "stats":
+                            ok, result = True, "运行统计：\n"
+                            for key, value in metrics.snapshot(args[0] if args else "").items():
+                                if isinstance(value, dict):
+                                    value = " ".join("{}={}".format(k, v) for k, v in value.items())
+                                result += "{}: {}\n".format(key, value)
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
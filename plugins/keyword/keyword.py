@@ -2,7 +2,7 @@
 
 import json
 import os
-import requests
+from common import http_client
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -69,7 +69,7 @@ class Keyword(Plugin):
                     os.makedirs(file_path)
                 file_name = reply_text.split("/")[-1]  # 获取文件名
                 file_path = os.path.join(file_path, file_name)
-                response = requests.get(reply_text)
+                response = http_client.get(reply_text)
                 with open(file_path, "wb") as f:
                     f.write(response.content)
                 #channel/wechat/wechat_channel.py和channel/wechat_channel.py中缺少ReplyType.FILE类型。
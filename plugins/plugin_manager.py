@@ -6,6 +6,7 @@ import json
 import os
 import sys
 
+from common import metrics
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
@@ -188,7 +189,8 @@ class PluginManager:
                 if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
                     logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
                     instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
+                    with metrics.timer("plugin.handler_ms", plugin=name, event=e_context.event.name):
+                        instance.handlers[e_context.event](e_context, *args, **kwargs)
                     if e_context.is_break():
                         e_context["breaked_by"] = name
                         logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
@@ -0,0 +1,15 @@
+import pytest
+
+import config
+
+
+@pytest.fixture
+def set_conf(monkeypatch):
+    """
+    使用给定的配置项替换全局配置，测试结束后恢复
+    """
+
+    def _set(**kwargs):
+        monkeypatch.setattr(config, "config", config.Config(kwargs))
+
+    return _set
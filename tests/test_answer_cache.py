@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from bot.session_manager import Session, SessionManager
+from bridge.answer_cache import AnswerCache, normalize_query
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+
+
+class DemoSession(Session):
+    def __init__(self, session_id, system_prompt=None, **kwargs):
+        super().__init__(session_id, system_prompt)
+        self.reset()
+
+
+class StubBot(object):
+    def __init__(self):
+        self.sessions = SessionManager(DemoSession)
+        self.calls = 0
+
+    def reply(self, query, context):
+        self.calls += 1
+        session_id = context["session_id"]
+        self.sessions.session_query(query, session_id)
+        content = "answer:" + query
+        self.sessions.session_reply(content, session_id)
+        return Reply(ReplyType.TEXT, content)
+
+
+@pytest.fixture
+def bot(set_conf):
+    set_conf(character_desc="SYS", model="demo", conversation_max_tokens=1000)
+    return StubBot()
+
+
+def _fetch(cache, bot, query, session_id):
+    context = Context(ContextType.TEXT, query, {"session_id": session_id})
+    return cache.fetch("demo", bot, query, context, lambda: bot.reply(query, context))
+
+
+def test_hit_and_miss(bot):
+    cache = AnswerCache(ttl=60)
+    assert _fetch(cache, bot, "怎么用这个机器人？", "u1").content == "answer:怎么用这个机器人？"
+    # 其它用户的同一问题(归一化后相同)直接命中缓存，并写入该用户的会话
+    reply = _fetch(cache, bot, "怎么用这个机器人", "u2")
+    assert reply.content == "answer:怎么用这个机器人？"
+    assert bot.calls == 1
+    assert [m["content"] for m in bot.sessions.build_session("u2").messages[1:]] == ["怎么用这个机器人", "answer:怎么用这个机器人？"]
+    assert cache.hit_cnt.get() == 1 and cache.miss_cnt.get() == 1
+
+
+def test_bypass_when_session_has_history(bot):
+    cache = AnswerCache(ttl=60)
+    _fetch(cache, bot, "hello", "u1")
+    _fetch(cache, bot, "hello", "u1")  # u1已有历史对话，不使用缓存
+    assert bot.calls == 2
+
+
+def test_expired_answer_is_requested_again(bot):
+    cache = AnswerCache(ttl=0.1)
+    _fetch(cache, bot, "hello", "u1")
+    time.sleep(0.2)
+    _fetch(cache, bot, "hello", "u2")
+    assert bot.calls == 2
+
+
+def test_error_reply_is_not_cached(bot):
+    cache = AnswerCache(ttl=60)
+    context = Context(ContextType.TEXT, "hello", {"session_id": "u1"})
+    cache.fetch("demo", bot, "hello", context, lambda: Reply(ReplyType.TEXT, "我现在有点累了，等会再来吧"))
+    _fetch(cache, bot, "hello", "u2")
+    assert bot.calls == 1
+
+
+def test_normalize_query():
+    assert normalize_query("  Hello   World！！ ") == "hello world"
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from bot.bot import Bot
+from bot.session_manager import Session, SessionManager
+from bridge.answer_cache import AnswerCache
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from channel.chat_channel import ChatChannel
+from common import event_loop
+from common.reorder_buffer import ReorderBuffer
+from common.thread_pool import AdaptiveThreadPool
+
+
+class DemoSession(Session):
+    def __init__(self, session_id, system_prompt=None, **kwargs):
+        super().__init__(session_id, system_prompt)
+        self.reset()
+
+
+class RecordingSessions(SessionManager):
+    # 记录会话读写所在的线程
+    def __init__(self):
+        super().__init__(DemoSession)
+        self.threads = []
+
+    def session_query(self, query, session_id):
+        self.threads.append(threading.current_thread())
+        return super().session_query(query, session_id)
+
+    def session_reply(self, reply, session_id, total_tokens=None):
+        self.threads.append(threading.current_thread())
+        return super().session_reply(reply, session_id, total_tokens)
+
+
+class AsyncBot(Bot):
+    def __init__(self):
+        self.sessions = RecordingSessions()
+
+    async def areply(self, query, context=None):
+        session = await self.run_sync(context, self.sessions.session_query, query, context["session_id"])
+        await self.run_sync(context, self.sessions.session_reply, "answer:" + query, session.session_id)
+        return Reply(ReplyType.TEXT, "answer:" + query)
+
+
+def _context(query, executor):
+    return Context(ContextType.TEXT, query, {"session_id": "u1", "executor": executor})
+
+
+def test_session_work_runs_in_channel_executor(set_conf):
+    set_conf(character_desc="SYS", model="demo", conversation_max_tokens=1000)
+    pool = AdaptiveThreadPool(name="test-async", min_workers=1, max_workers=2)
+    bot = AsyncBot()
+    reply = event_loop.run(bot.areply("hi", _context("hi", pool)))
+    assert reply.content == "answer:hi"
+    assert bot.sessions.threads and all(t.name.startswith("test-async") for t in bot.sessions.threads)
+    pool.shutdown()
+
+
+def test_answer_cache_afetch_off_loop_thread(set_conf):
+    set_conf(character_desc="SYS", model="demo", conversation_max_tokens=1000)
+    pool = AdaptiveThreadPool(name="test-cache", min_workers=1, max_workers=2)
+    bot, cache = AsyncBot(), AnswerCache(ttl=60)
+
+    def afetch(query, session_id):
+        context = Context(ContextType.TEXT, query, {"session_id": session_id, "executor": pool})
+        return event_loop.run(cache.afetch("demo", bot, query, context, lambda: bot.areply(query, context)))
+
+    hits = cache.hit_cnt.get()  # 统计是全局的，只比较这个测试中的变化
+    assert afetch("hello", "u1").content == "answer:hello"
+    assert afetch("hello", "u2").content == "answer:hello"  # 命中缓存，在线程池中写入u2的会话
+    assert cache.hit_cnt.get() == hits + 1
+    assert len(bot.sessions.threads) == 4
+    assert all(t.name.startswith("test-cache") for t in bot.sessions.threads)
+    pool.shutdown()
+
+
+class FakeScheduler(object):
+    def task_done(self, session_id):
+        pass
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.handler_pool = AdaptiveThreadPool(name="test-callback", min_workers=1, max_workers=2)
+        self.reorder_buffer = ReorderBuffer()
+        self.scheduler = FakeScheduler()
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.cancel_tokens = {}
+        self.sent = Future()
+
+    def _success_callback(self, session_id, **kwargs):
+        pass
+
+    def _send_reply(self, context, reply):
+        self.sent.set_result(threading.current_thread())
+
+
+def test_ordered_reply_not_sent_on_loop_thread():
+    channel = FakeChannel()
+    context = Context(ContextType.TEXT, "hi", {"session_id": "u1"})
+    context["reply_seq"] = channel.reorder_buffer.acquire("u1")
+
+    added = threading.Event()
+
+    async def handle():
+        # 回调添加后再完成，回调在事件循环线程中调用
+        await asyncio.get_running_loop().run_in_executor(None, added.wait)
+        return Reply(ReplyType.TEXT, "hello")
+
+    future = event_loop.submit(handle())
+    future.add_done_callback(ChatChannel._thread_pool_callback(channel, "u1", context=context))
+    added.set()
+    sender = channel.sent.result(timeout=5)
+    assert sender.name.startswith("test-callback")
+    channel.handler_pool.shutdown()
+
+
+def test_chatgpt_error_clears_session_off_loop_thread(set_conf, monkeypatch):
+    pytest.importorskip("openai")
+    from bot.chatgpt import chat_gpt_bot
+
+    set_conf(character_desc="SYS", model="gpt-3.5-turbo", conversation_max_tokens=1000)
+    pool = AdaptiveThreadPool(name="test-error", min_workers=1, max_workers=2)
+    bot = chat_gpt_bot.ChatGPTBot()
+    cleared = []
+    monkeypatch.setattr(bot.sessions, "clear_session", lambda session_id: cleared.append(threading.current_thread()))
+
+    async def acreate(**kwargs):
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(chat_gpt_bot.openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(chat_gpt_bot.async_http_client, "get_session", lambda: None)
+    reply = event_loop.run(bot.areply("hi", _context("hi", pool)))
+    assert reply.type == ReplyType.ERROR
+    assert cleared and cleared[0].name.startswith("test-error")
+    pool.shutdown()
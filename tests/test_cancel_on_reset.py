@@ -0,0 +1,65 @@
+import pytest
+
+import config
+from bridge.context import Context, ContextType
+from channel.chat_channel import ChatChannel
+
+
+class FakeChannel(object):
+    coalescer = None
+
+    def __init__(self):
+        self.cancelled = []
+        self.enqueued = []
+
+    def _cancel_on_reset(self, context):
+        ChatChannel._cancel_on_reset(self, context)
+
+    def cancel_session(self, session_id):
+        self.cancelled.append(session_id)
+
+    def cancel_all_session(self):
+        self.cancelled.append("*")
+
+    def _enqueue(self, context):
+        # 命令入队时，正在处理的消息已经被取消
+        self.enqueued.append((context.content, list(self.cancelled)))
+
+
+def _produce(channel, content, **kwargs):
+    kwargs.setdefault("session_id", "s1")
+    ChatChannel.produce(channel, Context(ContextType.TEXT, content, kwargs))
+
+
+@pytest.fixture(autouse=True)
+def admin(set_conf, monkeypatch):
+    set_conf(clear_memory_commands=["#清除记忆"])
+    monkeypatch.setitem(config.global_config, "admin_users", ["admin"])
+
+
+@pytest.mark.parametrize("content", ["#清除记忆", "#reset", "#重置会话"])
+def test_reset_cancels_session_on_arrival(content):
+    channel = FakeChannel()
+    _produce(channel, content)
+    assert channel.enqueued == [(content, ["s1"])]
+
+
+@pytest.mark.parametrize("content", ["#清除所有", "#resetall", "#重置所有会话"])
+def test_reset_all_cancels_all_sessions(content):
+    channel = FakeChannel()
+    _produce(channel, content, receiver="admin")
+    assert channel.cancelled == ["*"]
+
+
+def test_reset_all_requires_admin_in_private_chat():
+    channel = FakeChannel()
+    _produce(channel, "#resetall", receiver="user")
+    _produce(channel, "#resetall", receiver="admin", isgroup=True)
+    assert channel.cancelled == []
+
+
+def test_other_messages_do_not_cancel():
+    channel = FakeChannel()
+    _produce(channel, "#help")
+    _produce(channel, "reset")
+    assert channel.cancelled == [] and len(channel.enqueued) == 2
@@ -0,0 +1,107 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from bridge.context import Context, ContextType
+from channel.chat_channel import ChatChannel
+from common import http_client
+from common.cancellation import CancellationToken, acancellable_sleep, cancellable_sleep
+from common.session_scheduler import SessionScheduler
+
+
+def test_callbacks_run_once_on_cancel():
+    token, called = CancellationToken(), []
+
+    def removed():
+        called.append("removed")
+
+    token.register(lambda: called.append("a"))
+    token.register(removed)
+    token.unregister(removed)
+    token.register(lambda: 1 / 0)  # 回调出错不影响其它回调
+    token.register(lambda: called.append("b"))
+    token.cancel()
+    token.cancel()
+    assert called == ["a", "b"]
+    token.register(lambda: called.append("late"))  # 已取消时立即执行
+    assert called == ["a", "b", "late"]
+
+
+def test_sleep_interrupted_by_cancel():
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+    start = time.monotonic()
+    assert cancellable_sleep(token, 5) is True
+    assert time.monotonic() - start < 1
+    assert cancellable_sleep(None, 0.01) is False
+    assert cancellable_sleep(CancellationToken(), 0.01) is False
+
+
+def test_async_sleep_interrupted_by_cancel():
+    async def run():
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel).start()  # 从其它线程取消，唤醒事件循环中的等待
+        start = time.monotonic()
+        assert await acancellable_sleep(token, 5) is True
+        assert time.monotonic() - start < 1
+        assert not token._callbacks
+        assert await acancellable_sleep(CancellationToken(), 0.01) is False
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def silent_server(set_conf):
+    # 接受连接但不返回响应，模拟长时间等待上游回复的请求
+    set_conf()
+    http_client.close()
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    conns = []
+    threading.Thread(target=lambda: conns.append(server.accept()), daemon=True).start()
+    yield "http://127.0.0.1:{}".format(server.getsockname()[1])
+    for conn, _ in conns:
+        conn.close()
+    server.close()
+    http_client.close()
+
+
+def test_cancel_aborts_request_in_flight(silent_server):
+    token = CancellationToken()
+    threading.Timer(0.1, token.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(requests.RequestException):
+        http_client.get(silent_server, cancel_token=token, timeout=10)
+    assert time.monotonic() - start < 5
+
+
+class FakeChannel(object):
+    coalescer = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.cancel_tokens = {}
+        self.scheduler = SessionScheduler()
+
+    def start(self, session_id):
+        context = Context(ContextType.TEXT, "hi", {"session_id": session_id, "cancel_token": CancellationToken()})
+        self.cancel_tokens.setdefault(session_id, set()).add(context["cancel_token"])
+        return context
+
+
+def test_cancel_session_signals_running_tasks():
+    channel = FakeChannel()
+    s1, s2 = channel.start("s1"), channel.start("s2")
+    ChatChannel.cancel_session(channel, "s1")
+    assert ChatChannel._is_cancelled(channel, s1)  # 正在执行的任务收到取消通知，回复会被丢弃
+    assert not ChatChannel._is_cancelled(channel, s2)
+    assert list(channel.cancel_tokens) == ["s2"]
+    ChatChannel.cancel_all_session(channel)
+    assert ChatChannel._is_cancelled(channel, s2)
+    assert channel.cancel_tokens == {}
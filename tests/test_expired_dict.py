@@ -0,0 +1,104 @@
+import pytest
+
+from common import expired_dict
+from common.expired_dict import ExpiredDict
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(expired_dict, "time", clock)
+    return clock
+
+
+def test_keys_expire(clock):
+    d = ExpiredDict(10)
+    d["a"] = 1
+    clock.now += 5
+    d["b"] = 2
+    clock.now += 5
+    assert "a" not in d and d.get("a") is None
+    assert d["b"] == 2
+    assert len(d) == 1
+
+
+def test_sliding_refreshes_on_read(clock):
+    d = ExpiredDict(10)
+    d["a"] = 1
+    for _ in range(5):
+        clock.now += 8
+        assert d["a"] == 1
+    clock.now += 10
+    assert "a" not in d
+
+
+def test_fixed_ttl_not_refreshed_on_read(clock):
+    d = ExpiredDict(10, sliding=False)
+    d["a"] = 1
+    clock.now += 8
+    assert d["a"] == 1
+    clock.now += 2
+    assert "a" not in d
+
+
+def test_rewrite_extends_fixed_ttl(clock):
+    evicted = []
+    d = ExpiredDict(10, sliding=False, on_evict=lambda k, v: evicted.append((k, v)))
+    d["a"] = 1
+    clock.now += 5
+    d["a"] = 2  # 旧的过期记录不会清理新写入的值
+    clock.now += 5
+    assert d.items() == [("a", 2)] and evicted == []
+    clock.now += 5
+    assert len(d) == 0 and evicted == [("a", 2)]
+
+
+def test_expired_keys_swept_in_order(clock):
+    for sliding in [True, False]:
+        evicted = []
+        d = ExpiredDict(10, sliding=sliding, on_evict=lambda k, v: evicted.append(k))
+        for i in range(5):
+            d[i] = i
+            clock.now += 1
+        clock.now += 7
+        assert d.keys() == [3, 4]
+        assert evicted == [0, 1, 2]  # 每个key只回调一次
+
+
+def test_iteration_in_access_order(clock):
+    d = ExpiredDict(None)
+    for key in "abc":
+        d[key] = key
+    d["a"]
+    assert list(d) == ["b", "c", "a"]
+    assert d.popitem() == ("b", "b")  # 最久未访问
+    assert d.popitem(last=True) == ("a", "a")
+    clock.now += 10 ** 6
+    assert d.keys() == ["c"]  # 没有设置过期时间时不过期
+
+
+def test_max_size_evicts_least_recently_used(clock):
+    evicted = []
+    d = ExpiredDict(10, max_size=2, on_evict=lambda k, v: evicted.append(k))
+    d["a"], d["b"] = 1, 2
+    d["a"]
+    d["c"] = 3
+    assert evicted == ["b"] and d.keys() == ["a", "c"]
+
+
+def test_delete_and_clear(clock):
+    d = ExpiredDict(10, sliding=False)
+    d["a"], d["b"] = 1, 2
+    del d["a"]
+    with pytest.raises(KeyError):
+        del d["a"]
+    d.clear()
+    assert len(d) == 0 and not d.expiry_queue
@@ -0,0 +1,48 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from common import http_client
+from common.cancellation import CancellationToken, OperationCancelled
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = (self.headers.get("Cookie") or "").encode()
+        self.send_response(200)
+        if self.path == "/login":
+            self.send_header("Set-Cookie", "sticky=upstream-a; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(set_conf):
+    set_conf()
+    http_client.close()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    http_client.close()
+
+
+def test_cookies_are_not_shared_between_requests(server):
+    res = http_client.get(server + "/login")
+    assert res.cookies.get("sticky") == "upstream-a"  # 响应中的cookie仍然可以读取
+    assert http_client.get(server + "/other").text == ""
+    assert len(http_client.get_session().cookies) == 0
+
+
+def test_cancelled_token_fails_fast(server):
+    token = CancellationToken()
+    token.cancel()
+    with pytest.raises(OperationCancelled):
+        http_client.get(server + "/other", cancel_token=token)
@@ -0,0 +1,44 @@
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from channel.message_coalescer import MessageCoalescer
+
+
+def _context(content, ctype=ContextType.TEXT):
+    return Context(ctype, content, {"session_id": "s1"})
+
+
+def test_merge_messages_in_window():
+    flushed = []
+    coalescer = MessageCoalescer(lambda c: flushed.append(c.content), window=0.05, max_wait=1)
+    coalescer.put("s1", _context("a"))
+    coalescer.put("s1", _context("b"))
+    time.sleep(0.2)
+    assert flushed == ["a\nb"]
+
+
+def test_max_size_flushes_immediately():
+    flushed = []
+    coalescer = MessageCoalescer(lambda c: flushed.append(c.content), window=10, max_size=2)
+    coalescer.put("s1", _context("a"))
+    coalescer.put("s1", _context("b"))
+    assert flushed == ["a\nb"]
+
+
+def test_timer_flush_and_put_flush_keep_order():
+    # 定时器取出合并消息后、处理完成前，put触发的处理不能抢先
+    flushed = []
+    timer_flushing = threading.Event()
+
+    def flush(context):
+        if context.content == "a":
+            timer_flushing.set()
+            time.sleep(0.2)
+        flushed.append(context.content)
+
+    coalescer = MessageCoalescer(flush, window=0.01, max_wait=1)
+    coalescer.put("s1", _context("a"))
+    assert timer_flushing.wait(2)
+    coalescer.put("s1", _context("#清除记忆"))
+    assert flushed == ["a", "#清除记忆"]
@@ -0,0 +1,108 @@
+import importlib.util
+import os
+import random
+
+import pytest
+
+# 直接加载模块文件，plugins.faq包在插件管理器之外导入时会注册失败
+_spec = importlib.util.spec_from_file_location(
+    "faq_minhash_index", os.path.join(os.path.dirname(__file__), "..", "plugins", "faq", "minhash_index.py")
+)
+minhash_index = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(minhash_index)
+MinHashIndex, jaccard, ngrams = minhash_index.MinHashIndex, minhash_index.jaccard, minhash_index.ngrams
+
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    rng = random.Random(0)
+    questions = ["".join(rng.choice(CHARS) for _ in range(rng.randint(15, 30))) for _ in range(3000)]
+    index = MinHashIndex()
+    for question in questions:
+        index.add("", question, "answer:" + question)
+    return rng, questions, index
+
+
+def test_ngrams_and_jaccard():
+    assert ngrams("你好") == {"你好"}
+    assert ngrams("今天天气") == {"今天", "天天", "天气"}
+    assert jaccard({"a", "b"}, {"b", "c"}) == pytest.approx(1 / 3)
+    assert jaccard(set(), set()) == 1.0
+
+
+def test_near_duplicates_recalled(corpus):
+    rng, questions, index = corpus
+    hits = total = 0
+    for question in rng.sample(questions, 300):
+        i = rng.randrange(len(question))
+        variant = question[:i] + rng.choice(CHARS) + question[i + 1 :]  # 替换一个字
+        if jaccard(ngrams(variant), ngrams(question)) < index.threshold:
+            continue
+        total += 1
+        found = index.search("", variant)
+        if found and found[0] == question:
+            hits += 1
+    assert total > 200 and hits >= total * 0.9
+
+
+def test_exact_question_always_found(corpus):
+    rng, questions, index = corpus
+    for question in rng.sample(questions, 200):
+        assert index.search("", question) == (question, "answer:" + question, 1.0)
+
+
+def test_results_respect_threshold(corpus):
+    rng, questions, index = corpus
+    for _ in range(300):
+        query = "".join(rng.choice(CHARS) for _ in range(20))  # 不相关的问题
+        assert index.search("", query) is None
+    for question in rng.sample(questions, 300):
+        query = question[: rng.randint(3, len(question))]
+        found = index.search("", query)
+        if found is not None:
+            assert found[2] == jaccard(ngrams(query), ngrams(found[0])) >= index.threshold
+            assert found[1] == "answer:" + found[0]
+
+
+def test_threshold_boundary():
+    index = MinHashIndex(threshold=0.7)
+    question = "abcdefghijkl"  # 11个2-gram
+    index.add("", question, "a")
+    near, far = question + "m", question[:8] + "xyz"
+    assert jaccard(ngrams(near), ngrams(question)) >= 0.7 > jaccard(ngrams(far), ngrams(question))
+    assert index.search("", near)[0] == question
+    assert index.search("", far) is None
+
+
+def test_scopes_do_not_match():
+    index = MinHashIndex()
+    index.add("persona-a", "今天天气怎么样", "晴")
+    assert index.search("persona-a", "今天天气怎么样")[1] == "晴"
+    assert index.search("persona-b", "今天天气怎么样") is None
+
+
+def test_oldest_entries_evicted():
+    index = MinHashIndex(max_entries=2)
+    for question in ["第一个问题是什么", "第二个问题是什么", "第三个问题是什么"]:
+        index.add("", question, question)
+    assert len(index) == 2
+    assert index.search("", "第一个问题是什么") is None
+    referenced = set()
+    for table in index.tables:
+        for keys in table.values():
+            referenced |= keys if isinstance(keys, set) else {keys}
+    assert referenced == set(index.entries)  # 淘汰的问题从所有分段中移除
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "faq_index.json")
+    index = MinHashIndex()
+    index.add("s", "今天天气怎么样", "晴")
+    index.save(path)
+    assert not index.dirty
+    for loaded in [MinHashIndex(), MinHashIndex(bands=4, rows=4)]:  # 参数变化时重新计算签名
+        loaded.load(path)
+        assert loaded.search("s", "今天天气怎么样啊") == ("今天天气怎么样", "晴", jaccard(ngrams("今天天气怎么样啊"), ngrams("今天天气怎么样")))
+        assert not loaded.dirty
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bot.bot import Bot
+from bridge.bridge import Bridge
+from bridge.context import Context, ContextType
+from channel.overload_policy import DegradePolicy, DropOldestPolicy
+from common.session_scheduler import SessionScheduler
+
+
+def _context(content, session_id="s1"):
+    return Context(ContextType.TEXT, content, {"session_id": session_id})
+
+
+class FakeChannel(object):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.sent = []
+        self.handler_pool = SimpleNamespace(submit=lambda fn: fn())
+
+    def _decorate_reply(self, context, reply):
+        return reply
+
+    def _send_reply(self, context, reply):
+        self.sent.append(reply.content)
+
+
+def test_drop_oldest_keeps_new_message():
+    scheduler = SessionScheduler(max_queue=2)
+    scheduler.put("s1", _context("old"))
+    scheduler.put("s1", _context("mid"))
+    new = _context("new")
+    assert DropOldestPolicy().handle(FakeChannel(scheduler), new) is new
+    assert scheduler.qsize() == 1
+
+
+def test_drop_oldest_sheds_new_message_when_nothing_to_drop():
+    # 队列被管理命令占满时，不能为了接收新消息而超出上限
+    scheduler = SessionScheduler(max_queue=1)
+    scheduler.put("s1", _context("#清除记忆"), priority=True)
+    assert scheduler.is_full("s1")
+    assert DropOldestPolicy().handle(FakeChannel(scheduler), _context("new")) is None
+    assert scheduler.qsize() == 1
+
+
+class PlainBot(Bot):
+    pass
+
+
+class OverridableBot(Bot):
+    supports_model_override = True
+
+
+@pytest.mark.parametrize("bot, degraded", [(OverridableBot(), True), (PlainBot(), False)])
+def test_degrade_only_for_bots_with_model_override(set_conf, bot, degraded):
+    set_conf(overload_degrade_model="small-model", overload_reply="busy")
+    Bridge().bots["chat"] = bot
+    try:
+        scheduler = SessionScheduler(max_queue=1)
+        scheduler.put("s1", _context("old"))
+        channel = FakeChannel(scheduler)
+        context = _context("new")
+        result = DegradePolicy().handle(channel, context)
+        if degraded:
+            assert result is context and context["gpt_model"] == "small-model"
+        else:
+            assert result is None and channel.sent == ["busy"]
+    finally:
+        Bridge().bots.pop("chat", None)
@@ -0,0 +1,67 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.reorder_buffer import ReorderBuffer
+from common.session_scheduler import SessionScheduler
+
+
+def test_released_in_acquire_order():
+    buffer, sent = ReorderBuffer(), []
+    seqs = [buffer.acquire("s1") for _ in range(3)]
+    buffer.release("s1", seqs[2], lambda: sent.append(2))
+    buffer.release("s1", seqs[1], lambda: sent.append(1))
+    assert sent == []  # 等待第一条回复
+    buffer.release("s1", seqs[0], lambda: sent.append(0))
+    assert sent == [0, 1, 2]
+    assert not buffer.pending and not buffer.next_seq  # 全部释放后清理
+
+
+def test_empty_release_and_errors_do_not_block():
+    buffer, sent = ReorderBuffer(), []
+    seqs = [buffer.acquire("s1") for _ in range(3)]
+
+    def fail():
+        raise RuntimeError("send failed")
+
+    buffer.release("s1", seqs[2], lambda: sent.append(2))
+    buffer.release("s1", seqs[0])  # 没有回复的任务也要释放序号
+    buffer.release("s1", seqs[1], fail)
+    assert sent == [2]
+
+
+def test_sessions_are_independent():
+    buffer, sent = ReorderBuffer(), []
+    a0, b0 = buffer.acquire("a"), buffer.acquire("b")
+    a1 = buffer.acquire("a")
+    buffer.release("a", a1, lambda: sent.append("a1"))
+    buffer.release("b", b0, lambda: sent.append("b0"))
+    buffer.release("a", a0, lambda: sent.append("a0"))
+    assert sent == ["b0", "a0", "a1"]
+
+
+def test_concurrent_handlers_reply_in_order():
+    # 会话内并发处理(concurrency_in_session > 1)，处理耗时随机，回复仍按消息到达顺序发送
+    scheduler, buffer = SessionScheduler(concurrency=4), ReorderBuffer()
+    sent = {"s1": [], "s2": []}
+    lock = threading.Lock()
+    for i in range(40):
+        scheduler.put("s%d" % (i % 2 + 1), i)
+
+    def handle(session_id, item, seq):
+        time.sleep(random.uniform(0, 0.01))
+
+        def send():
+            with lock:
+                sent[session_id].append(item)
+
+        buffer.release(session_id, seq, send)
+        scheduler.task_done(session_id)
+
+    with ThreadPoolExecutor(8) as pool:
+        for _ in range(40):
+            session_id, item, _ = scheduler.get(timeout=5)
+            pool.submit(handle, session_id, item, buffer.acquire(session_id))
+    assert sent["s1"] == list(range(0, 40, 2))
+    assert sent["s2"] == list(range(1, 40, 2))
@@ -0,0 +1,98 @@
+import json
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from channel.chat_channel import ChatChannel
+from common.delay_queue import DelayQueue
+from common.retry_scheduler import RetryScheduler
+
+
+class InlineExecutor(object):
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+def test_backoff_is_exponential_and_capped():
+    scheduler = RetryScheduler("test", InlineExecutor(), base_delay=1, max_delay=5, jitter=0.1)
+    for retry_cnt, delay in [(0, 1), (1, 2), (2, 4), (3, 5), (10, 5)]:
+        for _ in range(20):
+            assert delay <= scheduler.backoff(retry_cnt) <= delay * 1.1
+
+
+def test_delay_queue_runs_calls_in_deadline_order():
+    queue, done = DelayQueue("test-delay"), []
+    finished = threading.Event()
+    queue.call_later(0.06, lambda: (done.append("late"), finished.set()))
+    queue.call_later(0.02, done.append, "early")
+    queue.call_later(0.04, done.append, "cancelled").cancel()
+    assert finished.wait(2)
+    assert done == ["early", "late"]
+
+
+def test_retry_until_dead_letter():
+    scheduler = RetryScheduler("test-retry", InlineExecutor(), DelayQueue("test-retry"), max_retries=2, base_delay=0.01)
+    attempts, dead = [], threading.Event()
+
+    def task(retry_cnt):
+        attempts.append(time.monotonic())
+        if not scheduler.retry(retry_cnt, task, retry_cnt + 1):
+            dead.set()
+
+    dead_letters = scheduler.dead_letter_cnt.get()
+    task(0)
+    assert dead.wait(2)
+    assert len(attempts) == 3  # 第一次执行加两次重试
+    assert attempts[2] - attempts[1] >= attempts[1] - attempts[0] >= 0.01  # 退避时间递增
+    assert scheduler.dead_letter_cnt.get() == dead_letters + 1
+
+
+class FailingChannel(object):
+    channel_type = "test"
+
+    def __init__(self, fail_times):
+        self.fail_times = fail_times
+        self.sent = []
+        self.done = threading.Event()
+        self.send_retry = RetryScheduler("test-send", InlineExecutor(), DelayQueue("test-send"), max_retries=2, base_delay=0.01)
+
+    def send(self, reply, context):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise ConnectionError("network down")
+        self.sent.append(reply.content)
+        self.done.set()
+
+    def _send(self, reply, context, retry_cnt=0):
+        ChatChannel._send(self, reply, context, retry_cnt)
+
+    def _dead_letter(self, reply, context, exception):
+        ChatChannel._dead_letter(self, reply, context, exception)
+        self.done.set()
+
+
+def _context():
+    return Context(ContextType.TEXT, "hi", {"session_id": "s1", "receiver": "u1"})
+
+
+def test_send_retried_without_blocking(set_conf, tmp_path):
+    set_conf(appdata_dir=str(tmp_path))
+    channel = FailingChannel(fail_times=1)
+    start = time.monotonic()
+    channel._send(Reply(ReplyType.TEXT, "hello"), _context())
+    assert time.monotonic() - start < 0.5  # 失败后立即返回，等待期间不占用处理消息的线程
+    assert channel.done.wait(2)
+    assert channel.sent == ["hello"]
+    assert not (tmp_path / "dead_letter.log").exists()
+
+
+def test_send_dead_lettered_after_retries(set_conf, tmp_path):
+    set_conf(appdata_dir=str(tmp_path))
+    channel = FailingChannel(fail_times=10)
+    channel._send(Reply(ReplyType.TEXT, "hello"), _context())
+    assert channel.done.wait(2)
+    assert channel.sent == [] and channel.fail_times == 7
+    record = json.loads((tmp_path / "dead_letter.log").read_text(encoding="utf-8"))
+    assert record["session_id"] == "s1" and record["receiver"] == "u1" and record["content"] == "hello"
+    assert record["error"] == "network down"
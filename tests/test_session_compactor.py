@@ -0,0 +1,122 @@
+import contextlib
+import threading
+import time
+
+import pytest
+
+from bot.session_compactor import SessionCompactor
+from bot.session_manager import Session, SessionManager
+
+
+class DemoSession(Session):
+    def __init__(self, session_id, system_prompt=None, **kwargs):
+        super().__init__(session_id, system_prompt)
+        self.reset()
+
+
+@pytest.fixture
+def manager(set_conf):
+    set_conf(session_summary_model="mini", conversation_max_tokens=60, character_desc="SYS")
+    return SessionManager(DemoSession)
+
+
+def _wait_idle(compactor, timeout=5):
+    deadline = time.monotonic() + timeout
+    while compactor.running or compactor.pending:
+        assert time.monotonic() < deadline, "compactor did not finish"
+        time.sleep(0.01)
+
+
+def _chat(manager, session_id, rounds):
+    for i in range(rounds):
+        manager.session_query("question number %d" % i, session_id)
+        manager.session_reply("answer number %d" % i, session_id)
+
+
+def test_discarded_messages_are_summarized(manager):
+    calls = []
+
+    def summarize(previous, messages):
+        calls.append((previous, [m["content"] for m in messages]))
+        return "summary%d" % len(calls)
+
+    manager.compactor.summarize = summarize
+    _chat(manager, "u1", 6)
+    _wait_idle(manager.compactor)
+
+    session = manager.build_session("u1")
+    assert calls, "compaction was not triggered"
+    assert calls[0][1][0] == "question number 0"
+    assert session.get_summary() == "summary%d" % len(calls)
+    assert session.messages[0]["content"].startswith("SYS" + session.summary_prefix)
+    # 摘要不会让会话重新超出上限
+    assert session.calc_tokens() <= 60 + len(session.get_summary()) + len(session.summary_prefix)
+
+
+def test_summary_is_written_under_session_lock(manager):
+    held = threading.local()
+    written = []
+
+    @contextlib.contextmanager
+    def session_lock(session_id):
+        held.value = True
+        try:
+            yield
+        finally:
+            held.value = False
+
+    def set_summary(session, summary):
+        written.append(getattr(held, "value", False))
+        return Session.set_summary(session, summary)
+
+    manager.session_lock = session_lock
+    DemoSession.set_summary = set_summary
+    try:
+        manager.compactor.summarize = lambda previous, messages: "summary"
+        _chat(manager, "u1", 6)
+        _wait_idle(manager.compactor)
+    finally:
+        del DemoSession.set_summary
+    assert written and all(written)
+
+
+def test_summary_dropped_after_session_reset(manager):
+    started = threading.Event()
+    release = threading.Event()
+
+    def summarize(previous, messages):
+        started.set()
+        release.wait(5)
+        return "stale summary"
+
+    manager.compactor.summarize = summarize
+    _chat(manager, "u1", 6)
+    assert started.wait(5)
+    manager.clear_session("u1")
+    manager.session_query("new question", "u1")
+    release.set()
+    _wait_idle(manager.compactor)
+    assert manager.build_session("u1").get_summary() == ""
+
+
+def test_generations_do_not_grow_with_resets():
+    applied = []
+    started, release = threading.Event(), threading.Event()
+
+    def apply(session_id, generation, messages, summarize):
+        started.set()
+        release.wait(5)
+        applied.append((session_id, generation == compactor.generation(session_id)))
+
+    compactor = SessionCompactor(apply)
+    for i in range(100):
+        compactor.cancel("idle%d" % i)  # 没有摘要任务的会话被重置，不留下记录
+    assert compactor.generations == {}
+
+    compactor.submit("u1", [{"role": "user", "content": "hi"}])
+    started.wait(5)
+    compactor.cancel("u1")  # 执行中的任务被重置，结果丢弃
+    release.set()
+    _wait_idle(compactor)
+    assert applied == [("u1", False)]
+    assert compactor.generations == {}
@@ -0,0 +1,75 @@
+from bot import session_store
+from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
+from bot.session_manager import SessionManager
+
+QUERY = "x" * 1000
+
+
+def _manager(set_conf, budget_bytes, **kwargs):
+    set_conf(session_memory_budget_mb=budget_bytes / 1024.0 / 1024.0, conversation_max_tokens=10 ** 6, **kwargs)
+    return SessionManager(BaiduWenxinSession, model="test")
+
+
+def _check_accounting(manager):
+    sizes = {session_id: session.size_bytes() for session_id, session in manager.sessions.items()}
+    assert manager.session_bytes == sizes
+    assert manager.total_bytes == sum(sizes.values())
+
+
+def test_least_recently_used_session_evicted(set_conf):
+    probe = BaiduWenxinSession("probe", model="test")
+    probe.add_query(QUERY)
+    manager = _manager(set_conf, probe.size_bytes() * 3.5)
+    for session_id in ["s1", "s2", "s3"]:
+        manager.session_query(QUERY, session_id)
+    manager.build_session("s1")  # 访问后s2成为最久未访问的会话
+    evicted = manager.evicted.count
+    manager.session_query(QUERY, "s4")
+    assert manager.sessions.keys() == ["s3", "s1", "s4"]
+    assert manager.evicted.count == evicted + 1
+    _check_accounting(manager)
+
+
+def test_growing_session_is_not_evicted(set_conf):
+    manager = _manager(set_conf, 2000)
+    manager.session_query(QUERY, "s1")
+    manager.session_query(QUERY, "s2")
+    for _ in range(5):
+        manager.session_reply(QUERY, "s2")  # 当前会话本身超出预算时只淘汰其它会话
+    assert manager.sessions.keys() == ["s2"]
+    assert manager.total_bytes > manager.memory_budget
+    _check_accounting(manager)
+
+
+def test_clear_and_expiry_release_memory(set_conf):
+    manager = _manager(set_conf, 10 ** 6)
+    manager.session_query(QUERY, "s1")
+    manager.session_query(QUERY, "s2")
+    manager.clear_session("s1")
+    _check_accounting(manager)
+    manager._on_evict("s2", None)  # 会话过期
+    assert manager.session_bytes == {} and manager.total_bytes == 0
+    manager.session_query(QUERY, "s3")
+    manager.clear_all_session()
+    assert manager.session_bytes == {} and manager.total_bytes == 0
+
+
+def test_no_budget_keeps_all_sessions(set_conf):
+    manager = _manager(set_conf, 0)
+    for i in range(20):
+        manager.session_query(QUERY, "s%d" % i)
+    assert len(manager.sessions) == 20
+    _check_accounting(manager)
+
+
+def test_evicted_session_reloaded_from_store(set_conf, tmp_path, monkeypatch):
+    monkeypatch.setattr(session_store, "_stores", {})
+    manager = _manager(set_conf, 2000, session_store="sqlite", appdata_dir=str(tmp_path), session_store_flush_interval=0.01)
+    manager.session_query("hello", "s1")
+    manager.session_query(QUERY, "s2")
+    manager.session_query(QUERY, "s3")
+    assert "s1" not in manager.sessions.keys()
+    assert manager.peek_session("s1").messages == [{"role": "user", "content": "hello"}]
+    assert manager.build_session("s1").messages == [{"role": "user", "content": "hello"}]
+    for store in session_store._stores.values():
+        store.flush()
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from common.session_scheduler import SessionScheduler
+
+
+def test_priority_item_dispatched_while_session_busy():
+    scheduler = SessionScheduler(concurrency=1)
+    scheduler.put("s1", "chat")
+    assert scheduler.get(timeout=0.1) == ("s1", "chat", False)
+    # 会话正在处理消息，管理命令不排在它后面
+    scheduler.put("s1", "#清除记忆", priority=True)
+    scheduler.put("s1", "next")
+    assert scheduler.get(timeout=0.1) == ("s1", "#清除记忆", True)
+    # 普通消息仍受并发上限限制
+    assert scheduler.get(timeout=0.05) is None
+    scheduler.task_done("s1")
+    assert scheduler.get(timeout=0.05) is None
+    scheduler.task_done("s1")
+    assert scheduler.get(timeout=0.1) == ("s1", "next", False)
+
+
+def test_get_wakes_up_on_put():
+    scheduler = SessionScheduler()
+    result = []
+    consumer = threading.Thread(target=lambda: result.append(scheduler.get(timeout=5)))
+    consumer.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    scheduler.put("s1", "hello")
+    consumer.join(5)
+    assert result == [("s1", "hello", False)]
+    assert time.monotonic() - start < 0.5  # 由put唤醒，不等超时或轮询
+
+
+def test_task_done_wakes_up_next_message_of_session():
+    scheduler = SessionScheduler(concurrency=1)
+    scheduler.put("s1", "first")
+    scheduler.put("s1", "second")
+    assert scheduler.get(timeout=0.1) == ("s1", "first", False)
+    result = []
+    consumer = threading.Thread(target=lambda: result.append(scheduler.get(timeout=5)))
+    consumer.start()
+    time.sleep(0.05)
+    assert not result  # 同一会话的上一条消息未处理完
+    scheduler.task_done("s1")
+    consumer.join(5)
+    assert result == [("s1", "second", False)]
+
+
+def test_idle_sessions_are_removed():
+    scheduler = SessionScheduler()
+    scheduler.put("s1", "hello")
+    scheduler.get(timeout=0.1)
+    scheduler.task_done("s1")
+    assert scheduler.sessions == {} and scheduler.qsize() == 0
+
+
+def test_sessions_take_turns():
+    # 一个会话积压了大量消息，其它会话的消息不需要等它处理完
+    scheduler = SessionScheduler(concurrency=1)
+    for i in range(5):
+        scheduler.put("busy", "b%d" % i)
+    scheduler.put("quiet", "q0")
+    order = []
+    for _ in range(6):
+        session_id, item, _ = scheduler.get(timeout=0.1)
+        order.append(item)
+        scheduler.task_done(session_id)
+    assert order.index("q0") <= 1
+
+
+def test_weighted_fair_share():
+    scheduler = SessionScheduler(concurrency=1)
+    for i in range(30):
+        scheduler.put("heavy", i, weight=2)
+        scheduler.put("light", i, weight=1)
+    counts = {"heavy": 0, "light": 0}
+    for _ in range(30):
+        session_id, _, _ = scheduler.get(timeout=0.1)
+        counts[session_id] += 1
+        scheduler.task_done(session_id)
+    assert counts == {"heavy": 20, "light": 10}
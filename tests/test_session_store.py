@@ -0,0 +1,38 @@
+import pytest
+
+from bot import session_store
+from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
+from bot.session_manager import SessionManager
+from bot.session_store import SqliteSessionStore
+
+
+@pytest.fixture
+def sqlite_conf(set_conf, tmp_path, monkeypatch):
+    monkeypatch.setattr(session_store, "_stores", {})
+    set_conf(session_store="sqlite", appdata_dir=str(tmp_path), session_store_flush_interval=0.01, conversation_max_tokens=1000)
+    yield
+    for store in session_store._stores.values():
+        store.flush()
+
+
+def test_query_and_reply_through_session_manager(sqlite_conf):
+    manager = SessionManager(BaiduWenxinSession, model="test")
+    assert isinstance(manager.store, SqliteSessionStore)
+    session = manager.session_query("你好", "user1")
+    manager.session_reply("你好，有什么可以帮你", "user1")
+    assert [m["role"] for m in session.messages] == ["user", "assistant"]
+
+    # 新的SessionManager(如重启后)从存储中恢复会话
+    manager.store.flush()
+    restored = SessionManager(BaiduWenxinSession, model="test").build_session("user1")
+    assert restored.messages == session.messages
+
+
+def test_pending_writes_visible_before_flush(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"), flush_interval=60)
+    store.save("ns", "s1", "prompt", [{"role": "user", "content": "hi"}])
+    assert store.load("ns", "s1") == {"system_prompt": "prompt", "messages": [{"role": "user", "content": "hi"}]}
+    store.delete("ns", "s1")
+    assert store.load("ns", "s1") is None
+    with store.lock("ns", "s1"):
+        pass
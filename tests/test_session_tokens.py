@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_by_character, num_tokens_from_messages
+from bot.session_manager import Session, Tokenizer
+
+
+class CountingTokenizer(Tokenizer):
+    reply_tokens = 3
+
+    def __init__(self):
+        self.counted = 0
+
+    def count(self, message) -> int:
+        self.counted += 1
+        return _tokens(message)
+
+
+def _tokens(message):
+    return len(message["role"]) + len(message["content"].split())
+
+
+def _recount(session):
+    return sum(_tokens(m) for m in session.messages) + session.tokenizer.reply_tokens
+
+
+def _session():
+    session = Session("s1", system_prompt="you are a bot", tokenizer=CountingTokenizer())
+    session.reset()
+    return session
+
+
+def test_each_message_counted_once():
+    session = _session()
+    session.add_query("hello there")
+    session.add_reply("hi how can I help")
+    assert session.calc_tokens() == _recount(session)
+    counted = session.tokenizer.counted
+    session.add_query("tell me a joke")
+    assert session.calc_tokens() == _recount(session)
+    assert session.tokenizer.counted == counted + 1  # 只计算新增的消息
+
+
+def test_modified_message_recounted():
+    session = _session()
+    session.add_query("hello")
+    session.calc_tokens()
+    session.messages[-1]["content"] = "hello with more words"  # 原地修改消息内容
+    assert session.calc_tokens() == _recount(session)
+    session.messages[-1] = {"role": "user", "content": "replaced"}
+    assert session.calc_tokens() == _recount(session)
+
+
+def test_cached_counts_match_recount_while_trimming():
+    rng = random.Random(0)
+    session = _session()
+    for i in range(300):
+        words = " ".join("w%d" % rng.randrange(100) for _ in range(rng.randint(1, 20)))
+        if i % 2 == 0:
+            session.add_query(words)
+        else:
+            session.add_reply(words)
+        max_tokens = rng.randint(20, 200)
+        assert session.discard_exceeding(max_tokens) == _recount(session)
+        assert session.calc_tokens() == _recount(session)
+        assert len(session.token_cache) < 100  # 已丢弃的消息不会一直留在缓存中
+
+
+def test_reset_clears_cache():
+    session = _session()
+    session.add_query("hello")
+    session.calc_tokens()
+    session.reset()
+    assert session.token_cache == {}
+    assert session.calc_tokens() == _recount(session)
+
+
+def test_chatgpt_session_character_models():
+    session = ChatGPTSession("s1", system_prompt="system", model="xunfei")
+    session.add_query("你好")
+    session.add_reply("你好，有什么可以帮你")
+    assert session.calc_tokens() == num_tokens_by_character(session.messages)
+
+
+def test_chatgpt_session_matches_tiktoken():
+    pytest.importorskip("tiktoken")
+    for model in ["gpt-3.5-turbo", "gpt-4"]:
+        session = ChatGPTSession("s1", system_prompt="You are a helpful assistant.", model=model)
+        for i in range(10):
+            session.add_query("question number {}".format(i))
+            session.add_reply("answer number {}".format(i))
+        session.messages.append({"role": "user", "name": "bob", "content": "hi"})
+        assert session.calc_tokens() == num_tokens_from_messages(session.messages, model)
+        assert session.discard_exceeding(60) == num_tokens_from_messages(session.messages, model)
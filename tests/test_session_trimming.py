@@ -0,0 +1,96 @@
+import random
+
+from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
+from bot.minimax.minimax_session import MinimaxSession
+from bot.session_manager import Session
+
+
+def _chat(session, turns):
+    for i in range(turns):
+        session.add_query("q%d" % i)
+        session.add_reply("a%d" % i)
+
+
+def _discard_by_recount(messages, max_tokens, start=1, role_key="role", user_role="user", key="content"):
+    # 逐条pop并重新计算的参考实现
+    def tokens():
+        return sum(len(m[key]) for m in messages)
+
+    while tokens() > max_tokens and len(messages) > start + 1:
+        messages.pop(start)
+        while len(messages) > start + 1 and messages[start][role_key] != user_role:
+            messages.pop(start)
+    return tokens()
+
+
+def test_whole_turns_dropped_and_system_prompt_kept():
+    session = Session("s1", system_prompt="sys")
+    session.reset()
+    _chat(session, 5)
+    session.add_query("q5")
+    assert session.discard_exceeding(13) == 13
+    assert [m["content"] for m in session.messages] == ["sys", "q3", "a3", "q4", "a4", "q5"]
+
+
+def test_multi_message_turn_dropped_together():
+    session = Session("s1", system_prompt="sys")
+    session.reset()
+    session.add_query("q0")
+    session.messages.append({"role": "tool", "content": "t0"})
+    session.add_reply("a0")
+    session.add_query("q1")
+    session.discard_exceeding(8)
+    assert [m["role"] for m in session.messages] == ["system", "user"]  # 回复和工具消息不会留下半轮
+
+
+def test_current_query_never_dropped():
+    session = Session("s1", system_prompt="sys")
+    session.reset()
+    _chat(session, 2)
+    session.add_query("a very long question")
+    assert session.discard_exceeding(5) == len("sys") + len("a very long question")
+    assert [m["content"] for m in session.messages] == ["sys", "a very long question"]
+
+
+def test_discarded_messages_reported():
+    session = Session("s1", system_prompt="sys")
+    session.reset()
+    dropped = []
+    session.on_discard = lambda s, messages: dropped.append([m["content"] for m in messages])
+    _chat(session, 3)
+    session.discard_exceeding(8)
+    assert dropped == [["q0", "a0", "q1", "a1"]]
+    session.discard_exceeding(100)
+    assert len(dropped) == 1  # 没有丢弃时不回调
+
+
+def test_session_without_system_prompt():
+    session = BaiduWenxinSession("s1", model="wenxin")
+    _chat(session, 3)
+    session.add_query("q3")
+    session.discard_exceeding(6)
+    assert [m["content"] for m in session.messages] == ["q2", "a2", "q3"]
+
+
+def test_minimax_role_keys():
+    session = MinimaxSession("s1")
+    _chat(session, 3)
+    session.add_query("q3")
+    session.discard_exceeding(6)
+    assert [m["text"] for m in session.messages] == ["q2", "a2", "q3"]
+
+
+def test_matches_pop_and_recount():
+    rng = random.Random(0)
+    for _ in range(200):
+        session = Session("s1", system_prompt="system")
+        session.reset()
+        for i in range(rng.randint(0, 10)):
+            session.add_query("q" * rng.randint(1, 10))
+            for _ in range(rng.randint(1, 2)):
+                session.add_reply("a" * rng.randint(1, 10))
+        session.add_query("q" * rng.randint(1, 10))
+        expected = list(session.messages)
+        max_tokens = rng.randint(0, 80)
+        assert session.discard_exceeding(max_tokens) == _discard_by_recount(expected, max_tokens)
+        assert session.messages == expected
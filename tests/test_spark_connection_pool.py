@@ -0,0 +1,201 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("websocket")
+
+from bot.xunfei.spark_connection_pool import SparkConnectionPool, SparkError, SparkTimeout
+from common import metrics
+from common.cancellation import CancellationToken, OperationCancelled
+
+
+def _frame(text, status, code=0):
+    message = {"header": {"code": code, "message": "error" if code else "Success", "status": status}}
+    if code == 0:
+        message["payload"] = {"choices": {"status": status, "text": [{"content": text}]}}
+    return json.dumps(message)
+
+
+class FakeSparkServer(object):
+    """
+    模拟星火websocket接口，mode控制服务端的行为：
+        keep: 回答后保持连接  close: 回答后关闭连接  slow: 每帧间隔较长
+        hang: 收到请求后不响应  error: 返回错误帧后关闭连接
+    """
+
+    def __init__(self):
+        self.mode = "keep"
+        self.connections = 0
+        self.active = 0
+        self.peak = 0
+        self.url = None
+
+    def reset(self, mode):
+        self.mode = mode
+        self.connections = self.active = self.peak = 0
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        async for msg in ws:
+            query = json.loads(msg.data)["payload"]["message"]["text"][-1]["content"]
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                if self.mode == "hang":
+                    await asyncio.sleep(5)
+                    continue
+                if self.mode == "error":
+                    await ws.send_str(_frame("", 0, code=10013))
+                    await ws.close()
+                    break
+                for i, part in enumerate(["你好", "，", query]):
+                    await asyncio.sleep(0.2 if self.mode == "slow" else 0.01)
+                    await ws.send_str(_frame(part, 2 if i == 2 else 1))
+            except ConnectionResetError:  # 客户端取消或提前关闭了连接
+                break
+            finally:
+                self.active -= 1
+            if self.mode == "close":
+                await ws.close()
+                break
+        return ws
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            app = web.Application()
+            app.router.add_get("/v3.5/chat", self.handle)
+            runner = web.AppRunner(app)
+            loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            loop.run_until_complete(site.start())
+            self.url = "ws://127.0.0.1:{}/v3.5/chat".format(site._server.sockets[0].getsockname()[1])
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait(5)
+
+
+@pytest.fixture(scope="module")
+def spark_server():
+    server = FakeSparkServer()
+    server.start()
+    return server
+
+
+@pytest.fixture
+def server(spark_server):
+    spark_server.reset("keep")
+    return spark_server
+
+
+def _pool(server, **kwargs):
+    kwargs.setdefault("max_connections", 2)
+    kwargs.setdefault("timeout", 1)
+    return SparkConnectionPool(lambda: server.url, **kwargs)
+
+
+def _ask(pool, query, cancel_token=None):
+    data = {"payload": {"message": {"text": [{"role": "user", "content": query}]}}}
+    return "".join(m["payload"]["choices"]["text"][0]["content"] for m in pool.request(data, cancel_token))
+
+
+def _free_slots(pool):
+    n = 0
+    while pool.semaphore.acquire(blocking=False):
+        n += 1
+    for _ in range(n):
+        pool.semaphore.release()
+    return n
+
+
+def test_connection_reused(server):
+    pool = _pool(server)
+    assert [_ask(pool, "q%d" % i) for i in range(3)] == ["你好，q0", "你好，q1", "你好，q2"]
+    assert server.connections == 1
+    assert _free_slots(pool) == 2
+    pool.close()
+
+
+def test_reconnect_when_server_closed(server):
+    # 服务端回答后关闭连接，复用空闲连接失败时换新连接重试，请求不受影响
+    server.reset("close")
+    pool = _pool(server)
+    reused = metrics.counter("xunfei.connection", result="reused")
+    start = reused.get()
+    for i in range(3):
+        assert _ask(pool, "c%d" % i) == "你好，c%d" % i
+        time.sleep(0.05)
+    assert reused.get() - start == 2  # 后两次请求先尝试了已被关闭的空闲连接
+    assert server.connections == 3
+    pool.close()
+
+
+def test_concurrent_requests_capped(server):
+    server.reset("slow")
+    pool = _pool(server, max_connections=2, timeout=5)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(_ask(pool, "p%d" % i))) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == sorted("你好，p%d" % i for i in range(6))
+    assert server.peak == 2
+    assert _free_slots(pool) == 2
+    pool.close()
+
+
+def test_frame_timeout(server):
+    server.reset("hang")
+    pool = _pool(server, timeout=0.5)
+    start = time.monotonic()
+    with pytest.raises(SparkTimeout):
+        _ask(pool, "h")
+    assert time.monotonic() - start < 2
+    assert _free_slots(pool) == 2 and not pool.idle  # 超时的连接关闭，不放回连接池
+    pool.close()
+
+
+def test_error_frame(server):
+    server.reset("error")
+    pool = _pool(server)
+    with pytest.raises(SparkError) as e:
+        _ask(pool, "e")
+    assert e.value.code == 10013
+    assert _free_slots(pool) == 2 and not pool.idle
+    pool.close()
+
+
+def test_cancel_releases_slot(server):
+    server.reset("slow")
+    pool = _pool(server)
+    cancel_token = CancellationToken()
+    threading.Timer(0.1, cancel_token.cancel).start()
+    start = time.monotonic()
+    with pytest.raises(OperationCancelled):
+        _ask(pool, "x", cancel_token)
+    assert time.monotonic() - start < 1
+    assert _free_slots(pool) == 2 and not pool.idle
+    pool.close()
+
+
+def test_early_close_releases_slot(server):
+    pool = _pool(server)
+    data = {"payload": {"message": {"text": [{"role": "user", "content": "st"}]}}}
+    frames = pool.request(data)
+    next(frames)
+    assert _free_slots(pool) == 1
+    frames.close()  # 调用方提前停止读取，连接上还有未读的帧，不能复用
+    assert _free_slots(pool) == 2 and not pool.idle
+    pool.close()
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType, StreamReply
+from channel.chat_channel import ChatChannel
+from channel.stream_writer import SentenceStreamWriter, StreamWriter
+
+
+class RecordingWriter(StreamWriter):
+    def __init__(self):
+        self.text = ""
+        self.closed = False
+        self.aborted = False
+
+    def write(self, delta):
+        self.text += delta
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeChannel(object):
+    channel_type = "test"
+
+    def __init__(self):
+        self.writer = RecordingWriter()
+        self.create_stream_writer = lambda context: self.writer
+        self._text_affixes = lambda context: ("", "")
+        self._is_cancelled = lambda context: False
+        self._observe_stage = lambda stage, start: None
+
+
+class FakeResponse(dict):
+    # openai的返回值既可以按key访问，也可以按属性访问
+    def __init__(self, content):
+        super().__init__(usage={"total_tokens": 2, "completion_tokens": 1})
+        self.choices = [{"message": {"content": content}}]
+
+
+def _stream(deltas, completed):
+    return StreamReply(deltas, lambda content: completed.append(content))
+
+
+def _failing(*deltas):
+    yield from deltas
+    raise ConnectionError("upstream closed")
+
+
+def test_stream_reply_complete():
+    channel, completed = FakeChannel(), []
+    reply = _stream(iter(["你好", "，世界"]), completed)
+    assert ChatChannel._stream_reply(channel, Context(ContextType.TEXT, "hi"), reply) is reply
+    assert channel.writer.text == "你好，世界" and channel.writer.closed
+    assert completed == ["你好，世界"]
+
+
+def test_stream_reply_error_before_first_delta():
+    channel, completed = FakeChannel(), []
+    result = ChatChannel._stream_reply(channel, Context(ContextType.TEXT, "hi"), _stream(_failing(), completed))
+    assert result.type == ReplyType.ERROR
+    assert channel.writer.aborted and not channel.writer.closed
+    assert completed == []
+
+
+def test_stream_reply_error_midway_is_not_a_complete_reply():
+    channel, completed = FakeChannel(), []
+    reply = _stream(_failing("前半段"), completed)
+    result = ChatChannel._stream_reply(channel, Context(ContextType.TEXT, "hi"), reply)
+    # 已发送的部分结束发送，返回错误提示，不完整的回复不写入会话
+    assert result is not reply and result.type == ReplyType.ERROR
+    assert channel.writer.text == "前半段" and channel.writer.closed
+    assert completed == []
+
+
+def test_chatgpt_stream_fallback_takes_one_rate_limit_token(set_conf, monkeypatch):
+    pytest.importorskip("openai")
+    from bot.chatgpt import chat_gpt_bot
+
+    set_conf(rate_limit_chatgpt=20)
+    bot = chat_gpt_bot.ChatGPTBot()
+    taken = []
+    bot.tb4chatgpt = SimpleNamespace(get_token=lambda: taken.append(1) or True)
+    monkeypatch.setattr(bot, "reply_text_stream", lambda *args, **kwargs: None)
+    monkeypatch.setattr(chat_gpt_bot.openai.ChatCompletion, "create", lambda **kwargs: FakeResponse("ok"))
+    context = Context(ContextType.TEXT, "hi", {"session_id": "s1", "stream": True})
+    assert bot.reply("hi", context).content == "ok"
+    assert len(taken) == 1
+
+
+def test_sentence_writer_keeps_order_after_send_failure():
+    sent, fallback = [], []
+
+    def send(text):
+        if text.startswith("第二句"):
+            raise ConnectionError("send failed")
+        sent.append(text)
+
+    writer = SentenceStreamWriter(send, min_chars=4, fallback_func=fallback.append)
+    for delta in ["第一句话。", "第二句话。", "第三句话。", "第四句"]:
+        writer.write(delta)
+    writer.close()
+    # 发送失败后不再分段发送，失败的分段和后面的内容在结束时作为一条消息发送
+    assert sent == ["第一句话。"]
+    assert fallback == ["第二句话。第三句话。第四句"]
@@ -0,0 +1,43 @@
+import random
+import threading
+import time
+
+from common.thread_pool import AdaptiveThreadPool
+
+
+def test_initializer_runs_in_prestarted_workers():
+    # 创建线程池之后才准备好的资源，min_workers个线程也能在initializer中拿到
+    resource = {}
+    seen = []
+    local = threading.local()
+
+    def initializer():
+        local.value = resource.get("loop")
+
+    pool = AdaptiveThreadPool(name="test-init", min_workers=2, max_workers=2, initializer=initializer)
+    resource["loop"] = "loop"
+    futures = [pool.submit(lambda: seen.append(local.value) or time.sleep(0.05)) for _ in range(4)]
+    for future in futures:
+        future.result(timeout=5)
+    pool.shutdown()
+    assert seen == ["loop"] * 4
+
+
+def test_idle_workers_shrink_to_min():
+    pool = AdaptiveThreadPool(name="test-shrink", min_workers=1, max_workers=4, idle_timeout=0.05, slow_threshold=0)
+    futures = [pool.submit(time.sleep, 0.05) for _ in range(4)]
+    for future in futures:
+        future.result(timeout=5)
+    assert pool.stats()["peak_workers"] == 4
+    time.sleep(0.3)
+    assert pool.stats()["workers"] == 1
+    pool.shutdown()
+
+
+def test_submit_while_worker_exits_is_not_lost():
+    # 在空闲线程超时退出的同时提交任务，任务仍然会被及时执行，而不是留在队列中等下一次提交
+    pool = AdaptiveThreadPool(name="test-race", min_workers=0, max_workers=2, idle_timeout=0.005)
+    for i in range(1000):
+        assert pool.submit(lambda x: x, i).result(timeout=0.5) == i
+        time.sleep(random.uniform(0.004, 0.006))
+    pool.shutdown()
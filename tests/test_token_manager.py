@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from common import token_manager
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class Fetcher(object):
+    def __init__(self, expires_in=100, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.calls = 0
+        self.error = None
+        self.fetched = threading.Event()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        self.calls += 1
+        try:
+            if self.error:
+                raise self.error
+            return "token-%d" % self.calls, self.expires_in
+        finally:
+            self.fetched.set()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(token_manager, "time", clock)
+    monkeypatch.setattr(token_manager, "_tokens", {})
+    return clock
+
+
+def _concurrently(func, n=20):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func())) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_get_fetches_once(clock):
+    fetch = Fetcher(delay=0.2)
+    results = _concurrently(lambda: token_manager.get("test", fetch))
+    assert results == ["token-1"] * 20
+    assert fetch.calls == 1
+    assert token_manager.get("test", fetch) == "token-1"
+
+
+def test_keys_cached_separately(clock):
+    fetch = Fetcher()
+    assert token_manager.get("test", fetch, key="a") == "token-1"
+    assert token_manager.get("test", fetch, key="b") == "token-2"
+    assert token_manager.get("test", fetch, key="a") == "token-1"
+
+
+def test_refreshed_in_background_before_expiry(clock):
+    fetch = Fetcher(expires_in=100)  # 80秒后开始后台刷新，90秒后过期
+    token_manager.get("test", fetch)
+    clock.now += 79
+    assert token_manager.get("test", fetch) == "token-1" and fetch.calls == 1
+    fetch.fetched.clear()
+    clock.now += 2
+    assert token_manager.get("test", fetch) == "token-1"  # 刷新期间仍返回当前的token，不需要等待
+    assert fetch.fetched.wait(5)
+    for _ in range(100):
+        if token_manager.get("test", fetch) == "token-2":
+            break
+        time.sleep(0.01)
+    assert token_manager.get("test", fetch) == "token-2" and fetch.calls == 2
+
+
+def test_expired_token_fetched_blocking(clock):
+    fetch = Fetcher(expires_in=100)
+    token_manager.get("test", fetch)
+    clock.now += 90
+    assert token_manager.get("test", fetch) == "token-2"
+
+
+def test_background_failure_keeps_current_token(clock):
+    fetch = Fetcher(expires_in=100)
+    token_manager.get("test", fetch)
+    fetch.error, fetch.fetched = RuntimeError("upstream down"), threading.Event()
+    clock.now += 85
+    assert token_manager.get("test", fetch) == "token-1"
+    assert fetch.fetched.wait(5)
+    fetch.error = None
+    clock.now += 10  # 过期后同步获取
+    assert token_manager.get("test", fetch) == "token-3"
+
+
+def test_fetch_error_raised_and_retried(clock):
+    fetch = Fetcher()
+    fetch.error = RuntimeError("upstream down")
+    with pytest.raises(RuntimeError):
+        token_manager.get("test", fetch)
+    fetch.error = None
+    assert token_manager.get("test", fetch) == "token-2"
+
+
+def test_concurrent_refresh_fetches_once(clock):
+    fetch = Fetcher(delay=0.2)
+    token_manager.get("test", fetch)
+    results = _concurrently(lambda: token_manager.refresh("test", fetch))
+    assert results == ["token-2"] * 20  # 上游返回token失效时，并发的请求只刷新一次
+    assert fetch.calls == 2
+
+
+def test_token_without_expiry(clock):
+    fetch = Fetcher(expires_in=None)
+    token_manager.get("test", fetch)
+    clock.now += 10 ** 9
+    assert token_manager.get("test", fetch) == "token-1" and fetch.calls == 1
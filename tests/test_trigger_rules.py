@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+import config
+from channel.chat_channel import check_contain, check_prefix
+from channel.trigger_rules import get_rules
+from common.string_matcher import LOOP_THRESHOLD, KeywordMatcher, PrefixMatcher
+
+
+def _words(rng, count, max_len=4):
+    # 小字母表生成大量重叠的前缀和关键词，覆盖自动机的失败跳转
+    return ["".join(rng.choice("abc@") for _ in range(rng.randint(0, max_len))) for _ in range(count)]
+
+
+@pytest.mark.parametrize("count", [0, 1, LOOP_THRESHOLD, LOOP_THRESHOLD + 1, 50])
+def test_matchers_agree_with_linear_scan(count):
+    rng = random.Random(count)
+    for _ in range(200):
+        words = _words(rng, count)
+        if rng.random() < 0.5:
+            words = [w for w in words if w]  # 大部分配置不包含空字符串
+        prefix_matcher, keyword_matcher = PrefixMatcher(words), KeywordMatcher(words)
+        for content in _words(rng, 20, max_len=12):
+            assert prefix_matcher.match(content) == check_prefix(content, words), (words, content)
+            assert keyword_matcher.match(content) == check_contain(content, words), (words, content)
+
+
+def test_none_config():
+    assert PrefixMatcher(None).match("hello") is None
+    assert KeywordMatcher(None).match("hello") is None
+
+
+def test_rules_recompiled_after_config_reload(set_conf):
+    set_conf(group_chat_prefix=["@bot"], group_name_white_list=["g1"])
+    rules = get_rules()
+    assert get_rules() is rules  # 配置没有变化时复用编译好的规则
+    assert rules.group_chat_prefix.match("@bot hi") == "@bot"
+    assert rules.is_group_enabled("g1") and not rules.is_group_enabled("g2")
+    set_conf(group_chat_prefix=["bot"], group_name_white_list=["ALL_GROUP"])
+    rules = get_rules()
+    assert rules.group_chat_prefix.match("@bot hi") is None
+    assert rules.is_group_enabled("g2")
+    assert rules.config is config.conf()
@@ -14,6 +14,7 @@ import re
 import time
 
 from bridge.reply import Reply, ReplyType
+from common import token_manager
 from common.log import logger
 from voice.voice import Voice
 from voice.ali.ali_api import AliyunTokenGenerator
@@ -31,8 +32,6 @@ class AliVoice(Voice):
             config_path = os.path.join(curdir, "config.json")
             with open(config_path, "r") as fr:
                 config = json.load(fr)
-            self.token = None
-            self.token_expire_time = 0
             # 默认复用阿里云千问的 access_key 和 access_secret
             self.api_url = config.get("api_url")
             self.app_key = config.get("app_key")
@@ -67,15 +66,11 @@ class AliVoice(Voice):
 
         :return: 返回有效的token字符串。
         """
-        current_time = time.time()
-        if self.token is None or current_time >= self.token_expire_time:
-            get_token = AliyunTokenGenerator(self.access_key_id, self.access_key_secret)
-            token_str = get_token.get_token()
-            token_data = json.loads(token_str)
-            self.token = token_data["Token"]["Id"]
-            # 将过期时间减少一小段时间（例如5分钟），以避免在边界条件下的过期
-            self.token_expire_time = token_data["Token"]["ExpireTime"] - 300
-            logger.debug(f"新获取的阿里云token：{self.token}")
-        else:
-            logger.debug("使用缓存的token")
-        return self.token
+        return token_manager.get("ali_voice", self._create_token, key=self.access_key_id)
+
+    def _create_token(self):
+        get_token = AliyunTokenGenerator(self.access_key_id, self.access_key_secret)
+        token_str = get_token.get_token()
+        token_data = json.loads(token_str)
+        logger.debug(f"新获取的阿里云token：{token_data['Token']['Id']}")
+        return token_data["Token"]["Id"], token_data["Token"]["ExpireTime"] - time.time()